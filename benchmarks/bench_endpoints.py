@@ -0,0 +1,310 @@
+""" latency and memory benchmark for every route in app.wsgi against a seeded local Mongo
+
+Seeds synthetic fees, addresses, offer_hash, blocks and transactions into a
+local mongod, stubs the Neo RPC, Neoscan and Switcheo HTTP dependencies, then
+drives every route through the Flask test client and reports p50/p99 latency,
+peak traced memory, peak RSS and response size per endpoint.  Results are
+written to benchmarks/results/<commit>-<scale>.json for comparison.
+
+    python benchmarks/bench_endpoints.py --fills 100000 --addresses 10000
+    python benchmarks/bench_endpoints.py --skip-seed --compare benchmarks/results/abc1234-100000x10000.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+from datetime import timezone
+from types import SimpleNamespace
+from pymongo import MongoClient
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+results_dir = os.path.join(root_dir, 'benchmarks', 'results')
+sys.path.insert(0, os.path.join(root_dir, 'flask_modules'))
+
+assets = ['SWTH', 'NEO', 'GAS', 'NOS', 'MCT', 'ASA', 'TKY', 'PHX', 'EFX', 'SOUL']
+trade_pairs = [asset + '_NEO' for asset in assets if asset != 'NEO'] + ['NEO_SWTH', 'GAS_NEO']
+batch_size = 10000
+
+
+def synthetic_address(i):
+    return 'A' + format(i, '033d')
+
+
+def insert_batches(collection, documents):
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def fee_documents(fills, addresses, rng):
+    now_epoch = int(time.time())
+    start_epoch = int(datetime.datetime(2018, 1, 1, tzinfo=timezone.utc).timestamp())
+    for i in range(fills):
+        block_time = rng.randint(start_epoch, now_epoch)
+        v3 = block_time > now_epoch - 365 * 86400
+        fee = {
+            'block_time': block_time,
+            'block_date': datetime.datetime.fromtimestamp(block_time, tz=timezone.utc).strftime('%Y-%m-%d'),
+            'contract_hash_version': 'V3' if v3 else 'V2',
+            'fee_asset_name': rng.choice(assets),
+            'fee_amount': rng.randint(1, 10 ** 10),
+            'maker_address': synthetic_address(rng.randrange(addresses)),
+            'taker_address': synthetic_address(rng.randrange(addresses)),
+        }
+        if v3:
+            fee['taker_fee_asset_name'] = rng.choice(['SWTH', 'SWTH', rng.choice(assets)])
+            fee['taker_fee_burn'] = rng.random() < 0.5
+            fee['taker_fee_burn_amount'] = rng.randint(1, 10 ** 9) if fee['taker_fee_burn'] else None
+        yield fee
+
+
+def asset_map(rng, extra=None):
+    asset_dict = dict((asset, rng.randint(1, 10 ** 6)) for asset in rng.sample(assets, rng.randint(1, 5)))
+    if extra:
+        asset_dict.update(extra)
+    return asset_dict
+
+
+def address_documents(addresses, rng):
+    for i in range(addresses):
+        address = {
+            '_id': synthetic_address(i),
+            'fees_paid': asset_map(rng),
+            'takes': asset_map(rng, {'wants': {}, 'offers': {}}),
+            'makes': asset_map(rng, {'wants': {}, 'offers': {}}),
+            'trade_count': asset_map(rng),
+            'total_amount_traded': asset_map(rng),
+        }
+        # the address bench_requests looks up always holds SWTH, so its rank request is not a 404
+        if rng.random() < 0.3 or i == 1:
+            smart_contract = rng.randint(0, 10 ** 12)
+            on_chain = rng.randint(0, 10 ** 12)
+            address['rich_list'] = {'smart_contract': smart_contract, 'on_chain': on_chain,
+                                    'total': smart_contract + on_chain}
+        yield address
+
+
+def offer_documents(offers, addresses, rng):
+    for i in range(offers):
+        base, quote = rng.choice(trade_pairs).split('_')
+        offer_asset, want_asset = (base, quote) if rng.random() < 0.5 else (quote, base)
+        yield {
+            '_id': 'offer' + str(i),
+            'status': 'open' if rng.random() < 0.2 else 'filled',
+            'maker_address': synthetic_address(rng.randrange(addresses)),
+            'amount_filled': 0,
+            'offer_asset_name': offer_asset,
+            'offer_amount_fixed8': rng.randint(1, 10 ** 12),
+            'want_asset_name': want_asset,
+            'want_amount_fixed8': rng.randint(1, 10 ** 12),
+        }
+
+
+def seed(mongo_db, fills, addresses, offers, blocks, seed_value):
+    rng = random.Random(seed_value)
+    for collection in ['fees', 'addresses', 'offer_hash', 'blocks', 'transactions', 'fees_daily', 'rollup_state']:
+        mongo_db[collection].drop()
+    insert_batches(mongo_db['fees'], fee_documents(fills, addresses, rng))
+    insert_batches(mongo_db['addresses'], address_documents(addresses, rng))
+    insert_batches(mongo_db['offer_hash'], offer_documents(offers, addresses, rng))
+    insert_batches(mongo_db['blocks'], ({'_id': 2000000 + i} for i in range(blocks)))
+    insert_batches(mongo_db['transactions'], ({'_id': 'tx' + str(i)} for i in range(blocks * 2)))
+
+
+def stub_dependencies(wsgi, mongo_db):
+    """ point the app at the seeded database and replace every outbound RPC/HTTP call with a local answer """
+    wsgi.connections.mongo_db = lambda: mongo_db
+    wsgi.connections.contract = lambda: SimpleNamespace(
+        get_neo_block_height=lambda: 2000000 + mongo_db['blocks'].estimated_document_count() + 10,
+        is_trading_active=lambda: True,
+        neo_trade_pair_list=trade_pairs
+    )
+    wsgi.neoscan_client.get_balance = lambda address: {
+        'address': address, 'balance': [{'asset': 'Switcheo', 'asset_symbol': 'SWTH', 'amount': 1000000.0}]
+    }
+    wsgi.balance_lookup.fetch_balance = lambda network, address, timeout: {
+        'confirmed': {'SWTH': '100000000'}, 'confirming': {}, 'locked': {}
+    }
+
+
+def bench_requests():
+    address = synthetic_address(1)
+    return [
+        '/switcheo/balance?address=' + address,
+        '/switcheo/balances?addresses=' + ','.join(synthetic_address(i) for i in range(50)),
+        '/switcheo/status',
+        '/neo/blockheight',
+        '/switcheo/ingested',
+        '/switcheo/ingested/blockheight',
+        '/switcheo/ingested/transactions',
+        '/switcheo/ingested/fills',
+        '/switcheo/fee/amount',
+        '/switcheo/burnt',
+        '/switcheo/fee/count',
+        '/switcheo/fee/amount/graph',
+        '/switcheo/fee/amount/graph?asset=SWTH&format=columnar',
+        '/switcheo/fee/series?granularity=day',
+        '/switcheo/fee/series?granularity=hour&asset=SWTH',
+        '/switcheo/fee/series?granularity=month&from=2018-01-01',
+        '/switcheo/addresses/fees',
+        '/switcheo/addresses/fees?asset=SWTH&limit=100',
+        '/switcheo/addresses/takes',
+        '/switcheo/addresses/makes',
+        '/switcheo/addresses/trades/count',
+        '/switcheo/addresses/trades/amount',
+        '/switcheo/offers/open',
+        '/switcheo/offers/open?trade_pair=SWTH_NEO',
+        '/switcheo/richlist',
+        '/switcheo/richlist?limit=100',
+        '/switcheo/richlist/rank?address=' + address,
+        '/switcheo/address/profile?address=' + address,
+        '/batch?metrics=status,blockheight,ingested_blockheight,fee_amount,fee_count,burnt,fee_graph,addresses_fees',
+        '/cache/stats',
+        '/metrics',
+        '/ready',
+    ]
+
+
+def uncovered_routes(wsgi, paths):
+    covered = set(path.split('?')[0] for path in paths)
+    # /live streams until LIVE_MAX_SECONDS, so it has no per-request latency to measure
+    skipped = {'/', '/<path:path>', '/static/<path:filename>', '/live'}
+    return sorted(rule.rule for rule in wsgi.app.url_map.iter_rules()
+                  if rule.rule not in covered and rule.rule not in skipped)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def bench_endpoint(client, path, iterations, warmup):
+    for _ in range(warmup):
+        client.get(path).get_data()
+
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = client.get(path)
+        body = response.get_data()
+        latencies.append(time.perf_counter() - started)
+
+    # one separate traced request, so tracing overhead stays out of the latencies
+    tracemalloc.start()
+    client.get(path).get_data()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'status': response.status_code,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'traced_peak_kb': round(traced_peak / 1024.0, 1),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'result_bytes': len(body),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root_dir).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print('\n{:<58} {:>12} {:>12} {:>9}'.format('endpoint', 'base p50', 'p50', 'change'))
+    for path, endpoint in results['endpoints'].items():
+        base_endpoint = baseline['endpoints'].get(path)
+        if base_endpoint is None:
+            continue
+        change = (endpoint['p50_ms'] - base_endpoint['p50_ms']) / max(base_endpoint['p50_ms'], 0.001) * 100
+        print('{:<58} {:>12} {:>12} {:>8.1f}%'.format(path, base_endpoint['p50_ms'], endpoint['p50_ms'], change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark every app.wsgi route against a seeded local Mongo.')
+    parser.add_argument('--mongo-uri', default=os.environ.get('BENCH_MONGODB_URI', 'mongodb://127.0.0.1:27017'))
+    parser.add_argument('--db', default='switcheolytics_bench')
+    parser.add_argument('--fills', type=int, default=10000, help='synthetic fees documents (10k to 10M)')
+    parser.add_argument('--addresses', type=int, default=1000, help='synthetic addresses (1k to 1M)')
+    parser.add_argument('--offers', type=int, default=None, help='offer_hash documents, default fills / 10')
+    parser.add_argument('--blocks', type=int, default=None, help='blocks documents, default fills / 5')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skip-seed', action='store_true', help='reuse the data already in --db')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--only', default=None, help='only benchmark paths containing this string')
+    parser.add_argument('--compare', default=None, help='earlier results file to compare p50 latencies against')
+    args = parser.parse_args(argv)
+
+    mongo_db = MongoClient(args.mongo_uri)[args.db]
+    if not args.skip_seed:
+        started = time.time()
+        seed(mongo_db, args.fills, args.addresses, args.offers or max(args.fills // 10, 1),
+             args.blocks or max(args.fills // 5, 1), args.seed)
+        print('seeded in ' + str(round(time.time() - started, 1)) + 's')
+
+    # measure the computation itself, not the shared response cache
+    os.environ['RESPONSE_CACHE_ENABLED'] = 'false'
+    os.environ.setdefault('RESPONSE_CACHE_PATH', os.path.join(tempfile.mkdtemp(), 'cache.sqlite'))
+    # every request measures the live computation, not a snapshot page
+    os.environ['SNAPSHOT_BUILD'] = 'false'
+    os.environ.setdefault('SNAPSHOT_DIR', tempfile.mkdtemp())
+    # large seeds would otherwise run into the request deadlines
+    os.environ['LIMITS_ENABLED'] = 'false'
+
+    from app import wsgi
+    stub_dependencies(wsgi, mongo_db)
+    client = wsgi.app.test_client()
+
+    paths = bench_requests()
+    for rule in uncovered_routes(wsgi, paths):
+        print('warning: no benchmark request for ' + rule)
+    if args.only:
+        paths = [path for path in paths if args.only in path]
+
+    results = {
+        'commit': git_commit(),
+        'created': datetime.datetime.now(timezone.utc).isoformat(),
+        'scale': {'fills': args.fills, 'addresses': args.addresses},
+        'endpoints': {}
+    }
+    print('{:<58} {:>6} {:>10} {:>10} {:>12} {:>12} {:>12}'.format(
+        'endpoint', 'status', 'p50 ms', 'p99 ms', 'traced kb', 'rss kb', 'bytes'))
+    for path in paths:
+        endpoint = bench_endpoint(client, path, args.iterations, args.warmup)
+        results['endpoints'][path] = endpoint
+        print('{:<58} {:>6} {:>10} {:>10} {:>12} {:>12} {:>12}'.format(
+            path, endpoint['status'], endpoint['p50_ms'], endpoint['p99_ms'],
+            endpoint['traced_peak_kb'], endpoint['peak_rss_kb'], endpoint['result_bytes']))
+
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+    results_path = os.path.join(results_dir, results['commit'] + '-' + str(args.fills) + 'x' +
+                                str(args.addresses) + '.json')
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('results written to ' + results_path)
+
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
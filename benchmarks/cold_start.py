@@ -0,0 +1,89 @@
+""" cold-start time of app.wsgi: importing the app and serving its first request, for this tree and a git revision
+
+Each run starts a fresh interpreter in flask_modules, imports app.wsgi and
+sends one request through the Flask test client.  Passing --rev also measures
+that revision's flask_modules, exported with git archive, so the same command
+shows the time before and after a change:
+
+    python benchmarks/cold_start.py --rev HEAD~1 --runs 5 --path /ready
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+probe = '''
+import json, time
+started = time.time()
+imported = None
+try:
+    from app import wsgi
+    imported = time.time()
+    status = wsgi.app.test_client().get({path!r}).status_code
+    error = None
+except BaseException as e:
+    status = None
+    error = repr(e)
+finished = time.time()
+print(json.dumps({{
+    'import_seconds': None if imported is None else imported - started,
+    'first_request_seconds': None if imported is None or error else finished - imported,
+    'status': status,
+    'error': error
+}}))
+'''
+
+
+def measure(flask_dir, path, runs, timeout):
+    samples = []
+    for _ in range(runs):
+        try:
+            output = subprocess.run([sys.executable, '-c', probe.format(path=path)], cwd=flask_dir,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout).stdout
+            samples.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+        except (subprocess.TimeoutExpired, ValueError, IndexError):
+            samples.append({'import_seconds': None, 'first_request_seconds': None, 'status': None,
+                            'error': 'no result within ' + str(timeout) + 's'})
+
+    def median(key):
+        values = [sample[key] for sample in samples if sample[key] is not None]
+        return round(statistics.median(values), 3) if values else None
+
+    return {
+        'import_seconds': median('import_seconds'),
+        'first_request_seconds': median('first_request_seconds'),
+        'statuses': sorted(set(str(sample['status']) for sample in samples)),
+        'errors': sorted(set(sample['error'] for sample in samples if sample['error']))
+    }
+
+
+def export_revision(rev, directory):
+    archive = subprocess.run(['git', 'archive', rev, 'flask_modules'], cwd=root_dir,
+                             stdout=subprocess.PIPE, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', directory], input=archive, check=True)
+    return os.path.join(directory, 'flask_modules')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rev', help='git revision to measure alongside the working tree')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--path', default='/ready')
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args(argv)
+
+    results = {'working tree': measure(os.path.join(root_dir, 'flask_modules'), args.path, args.runs, args.timeout)}
+    if args.rev:
+        with tempfile.TemporaryDirectory() as directory:
+            results[args.rev] = measure(export_revision(args.rev, directory), args.path, args.runs, args.timeout)
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
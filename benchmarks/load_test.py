@@ -0,0 +1,131 @@
+""" compare sync (gunicorn) and async (uvicorn) serving throughput against a slow local Neo RPC stand-in
+
+Both servers are started from flask_modules with the same env, pointed at a
+stub JSON-RPC server that answers getblockcount after --delay seconds, and
+driven with --concurrency parallel clients on /neo/blockheight.
+
+    python benchmarks/load_test.py --requests 400 --concurrency 100 --delay 0.2
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import requests
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+flask_dir = os.path.join(root_dir, 'flask_modules')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def rpc_stub(delay):
+    class RpcHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            time.sleep(delay)
+            payload = json.dumps({'jsonrpc': '2.0', 'id': body.get('id', 1), 'result': 5000000}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    return RpcHandler
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start: ' + url)
+
+
+def drive(url, total, concurrency):
+    latencies = []
+    errors = [0]
+
+    def one(_):
+        started = time.time()
+        try:
+            requests.get(url, timeout=60).raise_for_status()
+            latencies.append(time.time() - started)
+        except requests.RequestException:
+            errors[0] += 1
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total)))
+    elapsed = time.time() - started
+    latencies.sort()
+    return {
+        'requests': total,
+        'errors': errors[0],
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1) if latencies else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--delay', type=float, default=0.2, help='seconds the RPC stand-in takes to answer')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--path', default='/neo/blockheight')
+    args = parser.parse_args(argv)
+
+    rpc_server = ThreadingHTTPServer(('127.0.0.1', 0), rpc_stub(args.delay))
+    threading.Thread(target=rpc_server.serve_forever, daemon=True).start()
+
+    env = dict(os.environ)
+    env.update({
+        'NEO_RPC_HOSTNAME': '127.0.0.1',
+        'NEO_RPC_PORT': str(rpc_server.server_address[1]),
+        'MONGODB_USER': env.get('MONGODB_USER', 'bench'),
+        'MONGODB_PASSWORD': env.get('MONGODB_PASSWORD', 'bench'),
+        'MONGODB_HOSTNAME': env.get('MONGODB_HOSTNAME', '127.0.0.1'),
+        'MONGODB_PORT': env.get('MONGODB_PORT', '27017'),
+        'MONGODB_DB': env.get('MONGODB_DB', 'switcheolytics_bench'),
+    })
+    modes = [
+        ('sync', ['gunicorn', '--bind', '127.0.0.1:18081', '--workers', str(args.workers), 'app.wsgi:app'], 18081),
+        ('async', ['uvicorn', 'app.asgi:app', '--host', '127.0.0.1', '--port', '18082',
+                   '--workers', str(args.workers)], 18082),
+    ]
+
+    results = {}
+    for mode, command, port in modes:
+        server = subprocess.Popen(command, cwd=flask_dir, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            url = 'http://127.0.0.1:' + str(port) + args.path
+            wait_for(url)
+            results[mode] = drive(url, args.requests, args.concurrency)
+        finally:
+            server.terminate()
+            server.wait()
+
+    rpc_server.shutdown()
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
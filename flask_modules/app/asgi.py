@@ -0,0 +1,214 @@
+""" ASGI serving mode exposing the same routes as app.wsgi on an event loop
+
+The readiness check, the ingestion counters and the Neo RPC height are
+answered on the loop through motor and httpx, so one process can hold
+hundreds of slow upstream calls.  Every other route is dispatched to its view
+in app.wsgi on a worker thread, so it goes through the same ETag validators,
+snapshots, response cache, limits and deadlines as in the sync app, and its
+body is streamed back to the loop chunk by chunk.
+
+    uvicorn app.asgi:app --host 0.0.0.0 --port 8080 --workers 4
+    gunicorn --config gunicorn_asgi.conf app.asgi:app
+"""
+import os
+import asyncio
+import threading
+import concurrent.futures
+import httpx
+from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.applications import Starlette
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from app import wsgi
+from app.ingestion import block_height_offset
+from app.responses import dumps
+
+dist_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dist')
+rpc_url = '{}://{}:{}'.format('https' if wsgi.rpc_tls else 'http', wsgi.rpc_hostname, wsgi.rpc_port)
+# created on startup, inside the server's event loop
+clients = {}
+
+# routes answered by their view in app.wsgi; they compress their own bodies
+wsgi_paths = [
+    '/metrics',
+    '/cache/stats',
+    '/batch',
+    '/switcheo/balance',
+    '/switcheo/balances',
+    '/switcheo/status',
+    '/switcheo/ingested',
+    '/switcheo/fee/amount',
+    '/switcheo/burnt',
+    '/switcheo/fee/count',
+    '/switcheo/fee/amount/graph',
+    '/switcheo/fee/series',
+    '/switcheo/addresses/fees',
+    '/switcheo/addresses/takes',
+    '/switcheo/addresses/makes',
+    '/switcheo/addresses/trades/count',
+    '/switcheo/addresses/trades/amount',
+    '/switcheo/offers/open',
+    '/switcheo/richlist',
+    '/switcheo/richlist/rank',
+    '/switcheo/address/profile',
+]
+
+
+class AsyncRoutesGZipMiddleware(GZipMiddleware):
+    """ gzip the routes answered on the loop, but not /live, whose events must reach the client as they are sent """
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and (scope['path'] == '/live' or scope['path'] in wsgi_paths):
+            await self.app(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
+
+
+class BodyClosed(Exception):
+    """ the client went away before the whole body was sent """
+
+
+def wsgi_response(method, path, query_string, headers, body):
+    """ the wsgi app's response to one request, with its request hooks run and its body not yet read """
+    with wsgi.app.test_request_context(path, method=method, query_string=query_string, headers=headers, data=body):
+        try:
+            return wsgi.app.full_dispatch_request()
+        except Exception as e:
+            return wsgi.app.handle_exception(e)
+
+
+def run_wsgi_view(loop, queue, closed, *request_args):
+    """ dispatch one request and send its status, headers and chunks to queue, all from this thread
+
+    Streamed bodies keep the request context of the thread that started them, so the body
+    is read on the thread that ran the view rather than hopping between pool threads.
+    """
+    def put(item):
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while not closed.is_set():
+            try:
+                return future.result(timeout=1)
+            except concurrent.futures.TimeoutError:
+                continue
+        future.cancel()
+        raise BodyClosed()
+
+    try:
+        response = wsgi_response(*request_args)
+        try:
+            put((response.status_code, response.headers.to_wsgi_list()))
+            for chunk in response.iter_encoded():
+                put(chunk)
+        finally:
+            # releases the route's slot and records the request's metrics
+            response.close()
+        put(None)
+    except BodyClosed:
+        pass
+    except Exception as e:
+        if not closed.is_set():
+            asyncio.run_coroutine_threadsafe(queue.put(e), loop)
+
+
+async def wsgi_route(request):
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(maxsize=8)
+    closed = threading.Event()
+    loop.run_in_executor(None, run_wsgi_view, loop, queue, closed, request.method, request.url.path,
+                         request.url.query, list(request.headers.items()), await request.body())
+    start = await queue.get()
+    if isinstance(start, Exception):
+        closed.set()
+        raise start
+    status, headers = start
+
+    async def chunks():
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            closed.set()
+
+    response = StreamingResponse(chunks(), status_code=status)
+    response.raw_headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    return response
+
+
+async def open_clients():
+    clients['mongo'] = AsyncIOMotorClient(wsgi.connections.uri, **dict(
+        wsgi.connections.client_options, maxPoolSize=int(os.environ.get('ASGI_MONGODB_POOL_SIZE', 100))))
+    clients['mongo_db'] = clients['mongo'][wsgi.connections.database_name]
+    clients['http'] = httpx.AsyncClient(timeout=float(os.environ.get('ASGI_HTTP_TIMEOUT', 10)))
+
+
+async def close_clients():
+    await clients['http'].aclose()
+    clients['mongo'].close()
+
+
+def json_body(obj):
+    return Response(dumps(obj), media_type='application/json')
+
+
+async def index(request):
+    return FileResponse(os.path.join(dist_dir, 'index.html'))
+
+
+async def ready(request):
+    status = {'pid': os.getpid(), 'mongo': 'ok'}
+    try:
+        await clients['mongo_db'].command('ping')
+    except Exception as e:
+        status['mongo'] = str(e)
+    status['ready'] = status['mongo'] == 'ok'
+    return Response(dumps(status), status_code=200 if status['ready'] else 503, media_type='application/json')
+
+
+async def neo_block_height(request):
+    r = await clients['http'].post(rpc_url, json={'jsonrpc': '2.0', 'method': 'getblockcount', 'params': [], 'id': 1})
+    r.raise_for_status()
+    return json_body({'neo_blockheight': r.json()['result']})
+
+
+async def switcheo_block_height(request):
+    count = await clients['mongo_db']['blocks'].estimated_document_count()
+    return json_body({'switcheo_blockheight': count + block_height_offset})
+
+
+async def switcheo_transaction_height(request):
+    return json_body({'switcheo_txn_height': await clients['mongo_db']['transactions'].estimated_document_count()})
+
+
+async def switcheo_fills_height(request):
+    return json_body({'switcheo_fee_height': await clients['mongo_db']['fees'].estimated_document_count()})
+
+
+async def live(request):
+    last_event_id = request.headers.get('last-event-id', request.query_params.get('last_event_id'))
+    return StreamingResponse(wsgi.live_state.astream(last_event_id), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+routes = [
+    Route('/', index),
+    Route('/ready', ready),
+    Route('/live', live),
+    Route('/neo/blockheight', neo_block_height),
+    Route('/switcheo/ingested/blockheight', switcheo_block_height),
+    Route('/switcheo/ingested/transactions', switcheo_transaction_height),
+    Route('/switcheo/ingested/fills', switcheo_fills_height),
+] + [Route(path, wsgi_route, methods=['GET', 'POST']) for path in wsgi_paths] + [
+    Route('/{path:path}', index),
+]
+
+app = Starlette(routes=routes, on_startup=[open_clients], on_shutdown=[close_clients])
+app.add_middleware(AsyncRoutesGZipMiddleware, minimum_size=1024)
+app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['GET', 'POST'])
@@ -0,0 +1,130 @@
+""" pooled SwitcheoClient instances and concurrent batch balance lookups """
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextlib import contextmanager
+from requests.exceptions import Timeout
+from switcheo.switcheo_client import SwitcheoClient
+from app.deadlines import bounded_call, call_timeout, remaining
+from app.metrics import metrics
+
+
+class SwitcheoClientPool(object):
+    """ up to max_size reusable clients per network, so HTTP connections survive between requests """
+
+    def __init__(self, max_size=8, acquire_timeout=10):
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.idle = {}
+        self.created = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def client(self, network):
+        with self.lock:
+            idle = self.idle.setdefault(network, queue.Queue())
+            create = idle.empty() and self.created.get(network, 0) < self.max_size
+            if create:
+                self.created[network] = self.created.get(network, 0) + 1
+        if create:
+            try:
+                sc = SwitcheoClient(switcheo_network=network)
+            except Exception:
+                with self.lock:
+                    self.created[network] -= 1
+                raise
+        else:
+            sc = idle.get(timeout=self.acquire_timeout)
+        try:
+            yield sc
+        finally:
+            idle.put(sc)
+
+
+class BalanceLookup(object):
+    """ balance_by_contract fanned out over a bounded thread pool, with a short per-address TTL cache
+
+    Every HTTP call a lookup makes times out after `timeout` seconds, or sooner
+    if the request's deadline is nearer, so a hung call frees its thread.  A
+    batch waits on its lookups until the request's deadline.  Cached balances are
+    kept in fetch order, so expired entries are dropped from the front on every
+    store, and the oldest go first once cache_max are held.
+    """
+
+    def __init__(self, pool, max_workers=None, timeout=None, ttl=None, max_addresses=None, cache_max=None):
+        self.pool = pool
+        self.timeout = timeout or float(os.environ.get('BALANCE_TIMEOUT', 10))
+        self.ttl = ttl if ttl is not None else int(os.environ.get('BALANCE_TTL', 15))
+        self.max_addresses = max_addresses or int(os.environ.get('BALANCE_MAX_ADDRESSES', 500))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or int(os.environ.get('BALANCE_WORKERS', 8)))
+        self.cache_max = cache_max or int(os.environ.get('BALANCE_CACHE_MAX', 10000))
+        self.balances = OrderedDict()
+        self.lock = threading.Lock()
+
+    def fetch_balance(self, network, address, timeout):
+        with self.pool.client(network) as sc, metrics.timed('switcheo', 'balance_by_contract'):
+            # the client's Request passes its timeout to each requests call it makes
+            sc.request.timeout = timeout
+            balance = sc.balance_by_contract(address)
+        self.store(network, address, balance)
+        return balance
+
+    def store(self, network, address, balance):
+        now = time.time()
+        with self.lock:
+            self.balances.pop((network, address), None)
+            self.balances[(network, address)] = (now, balance)
+            while self.balances:
+                fetched_at, _ = next(iter(self.balances.values()))
+                if now - fetched_at < self.ttl and len(self.balances) <= self.cache_max:
+                    break
+                self.balances.popitem(last=False)
+
+    def cached_balance(self, network, address):
+        cached = self.balances.get((network, address))
+        if cached is not None and time.time() - cached[0] < self.ttl:
+            return cached[1]
+        return None
+
+    def get_balance(self, network, address):
+        balance = self.cached_balance(network, address)
+        if balance is None:
+            # balance_by_contract makes several calls, so the lookup as a whole is also waited on within the deadline
+            timeout = call_timeout(self.timeout)
+            balance = bounded_call(self.executor, lambda: self.fetch_balance(network, address, timeout), self.timeout)
+        return balance
+
+    def get_balances(self, network, addresses):
+        """ {'balances': {address: balance}, 'errors': {address: reason}}; failures never fail the batch """
+        balances_dict = {'balances': {}, 'errors': {}}
+        timeout = call_timeout(self.timeout)
+        futures = {}
+        for address in addresses[:self.max_addresses]:
+            if address in balances_dict['balances'] or address in futures:
+                continue
+            balance = self.cached_balance(network, address)
+            if balance is not None:
+                balances_dict['balances'][address] = balance
+            else:
+                futures[address] = self.executor.submit(self.fetch_balance, network, address, timeout)
+        for address in addresses[self.max_addresses:]:
+            balances_dict['errors'][address] = 'over the ' + str(self.max_addresses) + ' address limit'
+
+        left = remaining()
+        give_up = time.time() + left if left is not None else None
+        for address, future in futures.items():
+            try:
+                balances_dict['balances'][address] = future.result(
+                    timeout=max(give_up - time.time(), 0) if give_up is not None else None)
+            except TimeoutError:
+                future.cancel()
+                balances_dict['errors'][address] = 'deadline exceeded'
+            except Timeout:
+                balances_dict['errors'][address] = 'timed out after ' + str(round(timeout, 3)) + 's'
+            except Exception as e:
+                balances_dict['errors'][address] = str(e) or e.__class__.__name__
+
+        return balances_dict
@@ -0,0 +1,114 @@
+""" several metrics in one request, computed concurrently on a bounded thread pool """
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from app import deadlines
+from app.metrics import metrics
+from app.responses import materialize
+
+
+def coerce(value, kind):
+    if kind is bool and isinstance(value, str):
+        return value.lower() == 'true'
+    return kind(value)
+
+
+def item_key(item, position):
+    """ where a malformed item's error is reported: its id, its name, or its position in the list """
+    if isinstance(item, str):
+        return item
+    if isinstance(item, dict):
+        return str(item.get('id', item.get('name', position)))
+    return str(position)
+
+
+class BatchRunner(object):
+    """ named get_* functions run concurrently, each bounded by its own timeout; failures never fail the batch
+
+    functions maps a metric name to (function, {parameter: type}); parameters are the
+    function's keyword arguments and anything else in an item is rejected.
+    """
+
+    def __init__(self, functions, max_workers=None, timeout=None, max_items=None):
+        self.functions = functions
+        self.timeout = timeout or float(os.environ.get('BATCH_TIMEOUT', 10))
+        self.max_items = max_items or int(os.environ.get('BATCH_MAX_ITEMS', 20))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or int(os.environ.get('BATCH_WORKERS', 8)))
+
+    def parse(self, item):
+        """ (id, name, keyword arguments, timeout) for one requested item; raises ValueError if it is malformed """
+        if isinstance(item, str):
+            item = {'name': item}
+        if not isinstance(item, dict) or not isinstance(item.get('name'), str):
+            raise ValueError('each item needs a metric name')
+        name = item['name']
+        if name not in self.functions:
+            raise ValueError('unknown metric ' + repr(name))
+        parameter_types = self.functions[name][1]
+        params = item.get('params') or {}
+        if not isinstance(params, dict):
+            raise ValueError('params must be an object')
+        kwargs = {}
+        for param, value in params.items():
+            if param not in parameter_types:
+                raise ValueError(name + ' does not accept ' + repr(param))
+            if value is not None:
+                try:
+                    kwargs[param] = coerce(value, parameter_types[param])
+                except (TypeError, ValueError):
+                    raise ValueError(param + ' must be ' + parameter_types[param].__name__)
+        timeout = self.timeout
+        if item.get('timeout') is not None:
+            try:
+                timeout = min(float(item['timeout']), self.timeout)
+            except (TypeError, ValueError):
+                raise ValueError('timeout must be a number')
+        return str(item.get('id', name)), name, kwargs, timeout
+
+    def compute(self, name, kwargs, timeout):
+        started = time.time()
+        status = 'ok'
+        try:
+            # generators and cursors are drained here, inside the item's time budget, which its queries inherit
+            with deadlines.deadline(timeout):
+                return materialize(self.functions[name][0](**kwargs))
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            metrics.observe('switcheolytics_batch_item_duration_seconds', time.time() - started,
+                            metric=name, status=status)
+
+    def run(self, items):
+        """ {'results': {id: value}, 'errors': {id: reason}}; an item's id defaults to its metric name """
+        batch_dict = {'results': {}, 'errors': {}}
+        futures = {}
+        started = time.time()
+        for position, item in enumerate(items):
+            try:
+                item_id, name, kwargs, timeout = self.parse(item)
+            except ValueError as e:
+                batch_dict['errors'][item_key(item, position)] = str(e)
+                continue
+            if item_id in futures or item_id in batch_dict['errors']:
+                batch_dict['errors'][item_id] = 'duplicate id'
+                continue
+            if len(futures) >= self.max_items:
+                batch_dict['errors'][item_id] = 'over the ' + str(self.max_items) + ' item limit'
+                continue
+            left = deadlines.remaining()
+            if left is not None:
+                timeout = max(min(timeout, left), 0)
+            futures[item_id] = (self.executor.submit(self.compute, name, kwargs, timeout), timeout)
+
+        for item_id, (future, timeout) in futures.items():
+            try:
+                batch_dict['results'][item_id] = future.result(timeout=max(started + timeout - time.time(), 0))
+            except TimeoutError:
+                future.cancel()
+                batch_dict['errors'][item_id] = 'timed out after ' + str(round(timeout, 3)) + 's'
+            except Exception as e:
+                batch_dict['errors'][item_id] = str(e) or e.__class__.__name__
+
+        return batch_dict
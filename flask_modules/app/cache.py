@@ -0,0 +1,134 @@
+""" block-height keyed response cache shared across gunicorn workers through sqlite """
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from functools import wraps
+from flask import Response, request
+
+from logger.logger import get_root_logger
+
+logger = get_root_logger('response_cache')
+
+
+class ResponseCache(object):
+    """ LRU response store in a local sqlite file, so one worker's computation serves every worker
+
+    Entries are keyed by endpoint, query arguments and the current ingested
+    block height, so a new block makes every older entry unreachable; those
+    age out through the per-endpoint TTL caps and the size-bounded eviction.
+    """
+
+    def __init__(self, version, path=None, max_bytes=None):
+        self.version = version
+        self.path = path or os.environ.get('RESPONSE_CACHE_PATH',
+                                           os.path.join(tempfile.gettempdir(), 'switcheolytics_cache.sqlite'))
+        self.max_bytes = max_bytes or int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+        self.enabled = os.environ.get('RESPONSE_CACHE_ENABLED', 'true').lower() != 'false'
+        self.local = threading.local()
+
+    def connection(self):
+        # sqlite connections must not cross threads or forked workers
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'key TEXT PRIMARY KEY, endpoint TEXT, body BLOB, mimetype TEXT, '
+                         'size INTEGER, created REAL, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def key(self, endpoint, args):
+        query = '&'.join(name + '=' + value for name, value in sorted(args.items(multi=True)))
+        raw_key = endpoint + '?' + query + '@' + str(self.version())
+        return hashlib.sha1(raw_key.encode('utf-8')).hexdigest()
+
+    def count(self, name):
+        conn = self.connection()
+        conn.execute('INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)', (name,))
+        conn.execute('UPDATE counters SET value = value + 1 WHERE name = ?', (name,))
+
+    def get(self, key, ttl):
+        conn = self.connection()
+        now = time.time()
+        row = conn.execute('SELECT body, mimetype FROM responses WHERE key = ? AND created >= ?',
+                           (key, now - ttl)).fetchone()
+        if row is not None:
+            conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        return row
+
+    def put(self, key, endpoint, body, mimetype):
+        conn = self.connection()
+        now = time.time()
+        conn.execute('INSERT OR REPLACE INTO responses (key, endpoint, body, mimetype, size, created, accessed) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)', (key, endpoint, body, mimetype, len(body), now, now))
+        self.evict()
+
+    def evict(self):
+        conn = self.connection()
+        total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        while total_bytes > self.max_bytes:
+            oldest = conn.execute('SELECT key, size FROM responses ORDER BY accessed LIMIT 16').fetchall()
+            if not oldest:
+                break
+            conn.executemany('DELETE FROM responses WHERE key = ?', [(key,) for key, _ in oldest])
+            total_bytes -= sum(size for _, size in oldest)
+
+    def store_streamed(self, key, endpoint, chunks, mimetype):
+        """ pass a streamed body through unchanged and cache it once it has been sent in full """
+        body = []
+        for chunk in chunks:
+            body.append(chunk)
+            yield chunk
+        try:
+            self.put(key, endpoint, b''.join(body), mimetype)
+        except sqlite3.Error:
+            logger.exception('response cache write failed for ' + endpoint)
+
+    def stats(self):
+        conn = self.connection()
+        stats_dict = {'endpoints': {}}
+        for name, value in conn.execute('SELECT name, value FROM counters'):
+            counter, endpoint = name.split(':', 1)
+            stats_dict['endpoints'].setdefault(endpoint, {'hits': 0, 'misses': 0})[counter] = value
+        entries, total_bytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        stats_dict['entries'] = entries
+        stats_dict['bytes'] = total_bytes
+        stats_dict['max_bytes'] = self.max_bytes
+        return stats_dict
+
+    def cached(self, ttl):
+        """ serve the view from the cache for at most ttl seconds at the same block height """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return view(*args, **kwargs)
+                endpoint = request.path
+                try:
+                    key = self.key(endpoint, request.args)
+                    row = self.get(key, ttl)
+                    self.count(('hits:' if row is not None else 'misses:') + endpoint)
+                except sqlite3.Error:
+                    logger.exception('response cache unavailable for ' + endpoint)
+                    return view(*args, **kwargs)
+
+                if row is not None:
+                    response = Response(row[0], mimetype=row[1])
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                response = view(*args, **kwargs)
+                if not isinstance(response, Response):
+                    response = Response(response)
+                if response.status_code == 200:
+                    response.response = self.store_streamed(key, endpoint, response.iter_encoded(), response.mimetype)
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return decorator
@@ -0,0 +1,43 @@
+""" ETag validators derived from ingestion progress, checked before any query runs """
+import hashlib
+from functools import wraps
+from flask import Response, g, request
+
+
+def make_etag(endpoint, args, version):
+    query = '&'.join(name + '=' + value for name, value in sorted(args.items(multi=True)))
+    return hashlib.sha1((endpoint + '?' + query + '@' + str(version)).encode('utf-8')).hexdigest()
+
+
+def conditional(version, max_age):
+    """ answer If-None-Match with 304 while version() is unchanged; version is the cheap ingestion counter
+
+    A view serving a body computed at an older count (a snapshot) sets g.served_version, and the
+    validator is made from that instead, so it never vouches for data the body does not have.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = make_etag(request.path, request.args, version())
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = view(*args, **kwargs)
+                if not isinstance(response, Response):
+                    response = Response(response)
+                if response.status_code != 200:
+                    return response
+                served_version = g.pop('served_version', None)
+                if served_version is not None:
+                    etag = make_etag(request.path, request.args, served_version)
+                    if request.if_none_match.contains_weak(etag):
+                        # the client already holds this older body
+                        response.close()
+                        response = Response(status=304)
+            # weak, since the same representation may be sent gzip or brotli encoded
+            response.set_etag(etag, weak=True)
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,134 @@
+""" per-process Mongo client and SwitcheoSmartContract, built on first use
+
+Nothing connects at import, so workers boot without waiting on Mongo, the Neo
+RPC node or the Switcheo API, and the app can be imported without them.  Both
+are rebuilt in any process whose pid differs from the one that built them, so
+a client created before a gunicorn fork (preload_app) is never shared with the
+workers; gunicorn.conf also resets them in post_fork.
+"""
+import os
+import threading
+from urllib.parse import quote_plus
+from pymongo import MongoClient
+
+from logger.logger import get_root_logger
+
+logger = get_root_logger('connections')
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in [None, ''] else default
+
+
+class ConnectionProvider(object):
+    """ lazily built, fork-aware Mongo database handle and SwitcheoSmartContract """
+
+    def __init__(self, rpc_hostname, rpc_port, rpc_tls, mongodb_protocol, mongodb_user, mongodb_password,
+                 mongodb_hostname, mongodb_port, mongodb_db, database_name='neo'):
+        self.rpc_hostname = rpc_hostname
+        self.rpc_port = rpc_port
+        self.rpc_tls = rpc_tls
+        self.mongodb_protocol = mongodb_protocol
+        self.mongodb_user = mongodb_user
+        self.mongodb_password = mongodb_password
+        self.mongodb_hostname = mongodb_hostname
+        self.mongodb_port = mongodb_port
+        self.mongodb_db = mongodb_db
+        # NeoIngest authenticates against mongodb_db but always reads the neo database
+        self.database_name = database_name
+        self.client_options = {
+            'maxPoolSize': env_int('MONGODB_MAX_POOL_SIZE', 100),
+            'minPoolSize': env_int('MONGODB_MIN_POOL_SIZE', 0),
+            'connectTimeoutMS': env_int('MONGODB_CONNECT_TIMEOUT_MS', 5000),
+            'serverSelectionTimeoutMS': env_int('MONGODB_SERVER_SELECTION_TIMEOUT_MS', 5000),
+            'socketTimeoutMS': env_int('MONGODB_SOCKET_TIMEOUT_MS', None),
+            'waitQueueTimeoutMS': env_int('MONGODB_WAIT_QUEUE_TIMEOUT_MS', None),
+        }
+        self.connect_callbacks = []
+        self.reset()
+
+    @property
+    def uri(self):
+        credentials = ''
+        if self.mongodb_user:
+            credentials = quote_plus(self.mongodb_user) + ':' + quote_plus(self.mongodb_password) + '@'
+        return '{}://{}{}:{}/{}'.format(self.mongodb_protocol, credentials, self.mongodb_hostname,
+                                        self.mongodb_port, self.mongodb_db)
+
+    def reset(self):
+        """ forget this process's connections; called after fork, where the parent's client must not be reused """
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.client = None
+        self.database = None
+        self.ssc = None
+
+    def on_connect(self, callback):
+        """ run callback(mongo_db) once per process, after its client is created """
+        self.connect_callbacks.append(callback)
+
+    def current(self):
+        if self.pid != os.getpid():
+            self.reset()
+
+    def mongo_db(self):
+        self.current()
+        database = self.database
+        if database is not None:
+            return database
+        with self.lock:
+            if self.database is not None:
+                return self.database
+            self.client = MongoClient(self.uri, **self.client_options)
+            self.database = database = self.client[self.database_name]
+        for callback in self.connect_callbacks:
+            callback(database)
+        return database
+
+    def contract(self):
+        """ the SwitcheoSmartContract for this process, sharing the provider's Mongo client """
+        self.current()
+        if self.ssc is not None:
+            return self.ssc
+        mongo_db = self.mongo_db()
+        with self.lock:
+            if self.ssc is None:
+                # imported here so web3 and the rest of blockchain-etl stay out of worker boot
+                from blockchain.neo.switcheo import SwitcheoSmartContract
+                ssc = SwitcheoSmartContract(rpc_hostname=self.rpc_hostname,
+                                            rpc_port=self.rpc_port,
+                                            rpc_tls=self.rpc_tls,
+                                            mongodb_protocol=self.mongodb_protocol,
+                                            mongodb_user=self.mongodb_user,
+                                            mongodb_password=self.mongodb_password,
+                                            mongodb_hostname=self.mongodb_hostname,
+                                            mongodb_port=self.mongodb_port,
+                                            mongodb_db=self.mongodb_db)
+                # NeoIngest builds a client with default pool and timeouts; swap in the configured one
+                ssc.ni.mongo_client.close()
+                ssc.ni.mongo_client = self.client
+                ssc.ni.mongo_db = mongo_db
+                self.ssc = ssc
+                logger.info('connected SwitcheoSmartContract in pid ' + str(self.pid))
+        return self.ssc
+
+    def ready(self):
+        """ readiness of this process: Mongo answers a ping, and whether the contract has been loaded """
+        status = {'pid': os.getpid(), 'mongo': 'ok', 'contract': 'loaded' if self.ssc is not None else 'lazy'}
+        try:
+            self.mongo_db().command('ping')
+        except Exception as e:
+            status['mongo'] = str(e)
+        status['ready'] = status['mongo'] == 'ok'
+        return status
+
+
+class ContractProxy(object):
+    """ stands in for the SwitcheoSmartContract, building it on first attribute access """
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def __getattr__(self, name):
+        return getattr(self.provider.contract(), name)
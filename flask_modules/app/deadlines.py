@@ -0,0 +1,93 @@
+""" per-request time budgets, passed on to Mongo as maxTimeMS and to Neo RPC and HTTP calls as timeouts
+
+A deadline is set for the current thread when a request starts and cleared
+when it ends.  Query helpers ask for the remaining budget as they issue each
+command, so a request that has run out of time fails with DeadlineExceeded
+(or Mongo's ExecutionTimeout) instead of holding its worker.  Threads without a
+deadline, such as the snapshot builder, run unbounded as before.
+"""
+import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import TimeoutError
+
+local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def set_deadline(seconds):
+    local.deadline = time.time() + seconds if seconds is not None else None
+
+
+def clear_deadline():
+    local.deadline = None
+
+
+def current():
+    """ this thread's deadline as an epoch time, or None """
+    return getattr(local, 'deadline', None)
+
+
+@contextmanager
+def until(epoch):
+    """ run the block with the deadline at epoch, or at the enclosing deadline if that is sooner """
+    previous = current()
+    local.deadline = min(epoch, previous) if None not in (epoch, previous) else epoch or previous
+    try:
+        yield
+    finally:
+        local.deadline = previous
+
+
+def deadline(seconds):
+    """ run the block within seconds, or within the enclosing deadline if that is sooner """
+    return until(time.time() + seconds)
+
+
+def remaining():
+    """ seconds left in this thread's budget, or None without a deadline """
+    epoch = current()
+    return None if epoch is None else epoch - time.time()
+
+
+def check():
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded('deadline exceeded')
+    return left
+
+
+def call_timeout(default):
+    """ a timeout for one outbound call: default, cut to what is left of the deadline """
+    left = check()
+    return default if left is None else min(default, left)
+
+
+def max_time_ms():
+    """ the remaining budget for a find cursor's max_time_ms, or None without a deadline """
+    left = check()
+    return None if left is None else max(int(left * 1000), 1)
+
+
+def mongo_options():
+    """ keyword arguments adding maxTimeMS to aggregate, distinct and count commands, when there is a deadline """
+    ms = max_time_ms()
+    return {} if ms is None else {'maxTimeMS': ms}
+
+
+def bounded_call(executor, function, default_timeout):
+    """ run function on executor and wait for it at most call_timeout(default_timeout)
+
+    For clients that take no timeout of their own; the call keeps running in the
+    executor after a timeout, but the request stops waiting on it.
+    """
+    wait = call_timeout(default_timeout)
+    future = executor.submit(function)
+    try:
+        return future.result(timeout=wait)
+    except TimeoutError:
+        future.cancel()
+        raise DeadlineExceeded('no answer within ' + str(round(wait, 3)) + 's')
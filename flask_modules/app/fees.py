@@ -0,0 +1,65 @@
+""" single-pass multi-window aggregations over the fees collection """
+import time
+import datetime
+from datetime import timezone
+
+from app.deadlines import mongo_options
+
+rolling_windows = [
+    ('day_epoch', 1),
+    ('week_epoch', 7),
+    ('thirty_epoch', 30),
+    ('sixty_epoch', 60),
+    ('ninety_epoch', 90),
+]
+
+
+def get_time_dict(now=None):
+    """ window start epochs; rolling windows count back from an aware UTC now, so the host timezone never shifts them """
+    now = now or datetime.datetime.now(timezone.utc)
+    time_dict = {}
+    for key, days in rolling_windows:
+        time_dict[key] = int((now - datetime.timedelta(days=days)).timestamp())
+    time_dict['august_epoch'] = int(datetime.datetime(2018, 8, 1, tzinfo=timezone.utc).timestamp())
+    time_dict['january_epoch'] = int(datetime.datetime(2018, 1, 1, tzinfo=timezone.utc).timestamp())
+    return time_dict
+
+
+def fee_windows_pipeline(time_dict, now_epoch, amount_field='fee_amount', asset_field='fee_asset_name'):
+    """ one $group with a conditional sum and count per window, so every window shares a single scan """
+    group = {'_id': '$' + asset_field}
+    for key in time_dict:
+        in_window = {'$gte': ['$block_time', time_dict[key]]}
+        group[key + '_amount'] = {'$sum': {'$cond': [in_window, '$' + amount_field, 0]}}
+        group[key + '_count'] = {'$sum': {'$cond': [in_window, 1, 0]}}
+
+    return [
+        {
+            '$match': {
+                '$and': [
+                    {amount_field: {'$ne': None}},
+                    {'block_time': {'$gte': min(time_dict.values()), '$lte': now_epoch}}
+                ]
+            }
+        }, {
+            '$group': group
+        }
+    ]
+
+
+def aggregate_fee_windows(mongo_db, time_dict, now_epoch=None):
+    """ per-window, per-asset fee amounts and counts from one pass over fees """
+    if now_epoch is None:
+        now_epoch = int(time.time())
+    windows_dict = {
+        'amount': {key: {} for key in time_dict},
+        'count': {key: {} for key in time_dict},
+    }
+
+    for fee_asset in mongo_db['fees'].aggregate(fee_windows_pipeline(time_dict, now_epoch), **mongo_options()):
+        for key in time_dict:
+            if fee_asset[key + '_count'] > 0:
+                windows_dict['amount'][key][fee_asset['_id']] = fee_asset[key + '_amount']
+                windows_dict['count'][key][fee_asset['_id']] = fee_asset[key + '_count']
+
+    return windows_dict
@@ -0,0 +1,253 @@
+""" indexes required by the analytics query shapes, and explain() profiling of the queries that run
+
+Every index is declared next to the query shape it serves.  They are verified
+(or created, with MONGODB_INDEXES=create) when the app starts, and can be
+checked or built by hand:
+
+    python -m app.indexes verify    # report missing indexes, exit 1 if any
+    python -m app.indexes create    # create the missing indexes
+    python -m app.indexes explain   # explain each endpoint's query shape, flagging scans and in-memory sorts
+
+With QUERY_PROFILE=true every distinct aggregate/find/count/distinct shape the
+app sends is explained once per worker on a background thread, and plans that
+scan the collection or sort in memory are logged and counted on /metrics.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bson.son import SON
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+from app.fees import fee_windows_pipeline, get_time_dict
+from app.leaderboard import leaderboard_pipeline
+from app.metrics import metrics
+from app.offers import open_offers_pipeline
+from app.ranks import ranks_collection
+from app.richlist import richlist_filter, richlist_projection
+from app.rollup import day_seconds, fee_graph_pipeline, hourly_collection, rollup_collection, rollup_pipeline
+from logger.logger import get_root_logger
+
+logger = get_root_logger('indexes')
+
+required_indexes = [
+    # fee windows, rollup high-water updates and each window's partial first day are block_time ranges
+    ('fees', 'block_time_1', [('block_time', 1)]),
+    # rollup windows and the fee graph filter fees_daily on a block_date range, optionally by asset and version
+    (rollup_collection, 'block_date_1_asset_name_1_contract_hash_version_1',
+     [('block_date', 1), ('asset_name', 1), ('contract_hash_version', 1)]),
+    # hourly fee series read fees_hourly on a block_hour range, optionally by asset and version
+    (hourly_collection, 'block_hour_1_asset_name_1_contract_hash_version_1',
+     [('block_hour', 1), ('asset_name', 1), ('contract_hash_version', 1)]),
+    # open offers are always status = open, optionally for one maker or one pair in either direction
+    ('offer_hash', 'status_1_maker_address_1', [('status', 1), ('maker_address', 1)]),
+    ('offer_hash', 'status_1_offer_asset_name_1_want_asset_name_1',
+     [('status', 1), ('offer_asset_name', 1), ('want_asset_name', 1)]),
+    # the richlist sort and the rank count of totals above an address
+    ('addresses', 'rich_list.total_-1__id_1', [('rich_list.total', -1), ('_id', 1)]),
+    # address ranks shift the rows between two values of one board, and profiles read one address's rows
+    (ranks_collection, 'metric_1_asset_1_value_-1', [('metric', 1), ('asset', 1), ('value', -1)]),
+    (ranks_collection, 'address_1', [('address', 1)]),
+    # rank updates find the addresses touched by transactions since their high-water mark
+    ('transactions', 'block_time_1', [('block_time', 1)]),
+]
+profiled_commands = ['aggregate', 'find', 'count', 'distinct']
+
+
+def ensure_indexes(mongo_db, create=False):
+    """ one row per required index with its status: present, created or missing """
+    report = []
+    for collection, name, keys in required_indexes:
+        existing = [[tuple(key) for key in index['key']] for index in mongo_db[collection].index_information().values()]
+        if keys in existing:
+            status = 'present'
+        elif create:
+            mongo_db[collection].create_index(keys, name=name, background=True)
+            status = 'created'
+        else:
+            status = 'missing'
+        report.append({'collection': collection, 'name': name, 'keys': keys, 'status': status})
+    return report
+
+
+def startup_indexes(mongo_db, mode=None):
+    """ verify or create the required indexes as configured by MONGODB_INDEXES (verify, create or off) """
+    mode = mode or os.environ.get('MONGODB_INDEXES', 'verify')
+    if mode == 'off':
+        return []
+    try:
+        report = ensure_indexes(mongo_db, create=mode == 'create')
+    except PyMongoError as e:
+        logger.warning('could not check indexes: ' + str(e))
+        return []
+    for row in report:
+        if row['status'] != 'present':
+            logger.warning(row['status'] + ' index ' + row['collection'] + '.' + row['name'])
+    return report
+
+
+def plan_stages(plan):
+    """ every stage name in a winning plan tree, parents first """
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def find_key(document, key):
+    """ every value stored under key anywhere in an explain document """
+    found = []
+    if isinstance(document, dict):
+        for k, value in document.items():
+            if k == key:
+                found.append(value)
+            else:
+                found.extend(find_key(value, key))
+    elif isinstance(document, list):
+        for value in document:
+            found.extend(find_key(value, key))
+    return found
+
+
+def plan_summary(explain):
+    """ stages, scan and sort flags, and docs examined against docs returned for one explain() result """
+    stages = []
+    for winning_plan in find_key(explain, 'winningPlan'):
+        stages.extend(plan_stages(winning_plan))
+    pipeline_stages = [name for stage in explain.get('stages', []) for name in stage if name != '$cursor']
+
+    docs_examined = keys_examined = returned = 0
+    for stats in find_key(explain, 'executionStats'):
+        docs_examined += stats.get('totalDocsExamined', 0)
+        keys_examined += stats.get('totalKeysExamined', 0)
+        returned += stats.get('nReturned', 0)
+    return {
+        'stages': stages,
+        'pipeline': pipeline_stages,
+        'collscan': 'COLLSCAN' in stages,
+        'in_memory_sort': 'SORT' in stages or '$sort' in pipeline_stages,
+        'docs_examined': docs_examined,
+        'keys_examined': keys_examined,
+        'returned': returned,
+        'examined_per_returned': round(docs_examined / float(returned), 2) if returned else None
+    }
+
+
+def explain_command(mongo_db, command):
+    """ run a read command under explain with execution stats; the command's first key names it """
+    return mongo_db.command(SON([('explain', command), ('verbosity', 'executionStats')]))
+
+
+def command_shape(document):
+    """ the command with every value replaced, so queries differing only in their arguments share a shape """
+    if isinstance(document, dict):
+        return dict((key, command_shape(value)) for key, value in document.items())
+    if isinstance(document, list):
+        return [command_shape(value) for value in document]
+    return 1
+
+
+class QueryProfiler(monitoring.CommandListener):
+    """ explains each distinct read command shape once, off the request thread """
+
+    def __init__(self):
+        self.mongo_db = None
+        self.shapes = set()
+        self.plans = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def started(self, event):
+        if event.command_name not in profiled_commands or self.mongo_db is None:
+            return
+        if event.database_name != self.mongo_db.name:
+            return
+        command = SON((key, value) for key, value in event.command.items()
+                      if not key.startswith('$') and key not in ['lsid', 'txnNumber'])
+        shape = json.dumps(command_shape(command), sort_keys=True, default=str)
+        with self.lock:
+            if shape in self.shapes:
+                return
+            self.shapes.add(shape)
+        self.executor.submit(self.profile, command, shape)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def profile(self, command, shape):
+        collection = command[next(iter(command))]
+        try:
+            summary = plan_summary(explain_command(self.mongo_db, command))
+        except PyMongoError as e:
+            logger.warning('explain failed for ' + str(collection) + ': ' + str(e))
+            return
+        summary['collection'] = collection
+        summary['command'] = next(iter(command))
+        self.plans[shape] = summary
+        for flag in ['collscan', 'in_memory_sort']:
+            if summary[flag]:
+                metrics.inc('switcheolytics_query_plan_flags_total', collection=collection, flag=flag)
+        if summary['collscan'] or summary['in_memory_sort']:
+            logger.warning(json.dumps(dict(summary, shape=json.loads(shape)), default=str))
+
+
+query_profiler = QueryProfiler()
+if os.environ.get('QUERY_PROFILE', 'false').lower() == 'true':
+    monitoring.register(query_profiler)
+
+
+def representative_commands(trade_pair_list):
+    """ one explainable command per query shape the endpoints send """
+    now_epoch = int(time.time())
+    return [
+        ('fee windows', SON([('aggregate', 'fees'), ('cursor', {}),
+                             ('pipeline', fee_windows_pipeline(get_time_dict(), now_epoch))])),
+        ('rollup update', SON([('aggregate', 'fees'), ('cursor', {}),
+                               ('pipeline', rollup_pipeline(now_epoch - day_seconds))])),
+        ('fee graph', SON([('aggregate', rollup_collection), ('cursor', {}),
+                           ('pipeline', fee_graph_pipeline(asset_name='SWTH'))])),
+        ('open offers', SON([('aggregate', 'offer_hash'), ('cursor', {}),
+                             ('pipeline', open_offers_pipeline(trade_pair_list))])),
+        ('open offers by pair', SON([('aggregate', 'offer_hash'), ('cursor', {}),
+                                     ('pipeline', open_offers_pipeline(trade_pair_list, trade_pair='SWTH_NEO'))])),
+        ('fee leaderboard', SON([('aggregate', 'addresses'), ('cursor', {}),
+                                 ('pipeline', leaderboard_pipeline('fees_paid', asset='SWTH', limit=100))])),
+        ('richlist', SON([('find', 'addresses'), ('filter', richlist_filter),
+                          ('projection', dict((field, 1) for field in richlist_projection)),
+                          ('sort', SON([('rich_list.total', -1), ('_id', 1)])), ('limit', 100)])),
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Verify, create or profile the indexes behind the analytics queries.')
+    parser.add_argument('command', choices=['verify', 'create', 'explain'])
+    args = parser.parse_args(argv)
+
+    from app.wsgi import connections, ssc
+    mongo_db = connections.mongo_db()
+    if args.command == 'explain':
+        for label, command in representative_commands(list(ssc.neo_trade_pair_list)):
+            print(json.dumps(dict(plan_summary(explain_command(mongo_db, command)), query=label), default=str))
+        return 0
+
+    report = ensure_indexes(mongo_db, create=args.command == 'create')
+    for row in report:
+        print(row['status'] + ' ' + row['collection'] + '.' + row['name'])
+    return 1 if any(row['status'] == 'missing' for row in report) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
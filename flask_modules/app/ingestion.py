@@ -0,0 +1,45 @@
+""" cheap ingestion progress counters from collection metadata """
+import os
+import time
+import threading
+
+from app.deadlines import mongo_options
+
+# the ingested blocks collection starts at NEO block 2,000,000
+block_height_offset = 2000000
+
+
+class IngestionCounters(object):
+    """ collection sizes from estimated_document_count, which reads collection metadata instead of counting
+
+    Each count is also memoized for ttl seconds per process, so a burst of
+    polls costs a single metadata lookup.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else float(os.environ.get('INGESTION_COUNT_TTL', 2))
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def count(self, mongo_db, collection):
+        cached = self.counts.get(collection)
+        if cached is not None and time.time() - cached[0] < self.ttl:
+            return cached[1]
+        collection_count = mongo_db[collection].estimated_document_count(**mongo_options())
+        with self.lock:
+            self.counts[collection] = (time.time(), collection_count)
+        return collection_count
+
+    def block_height(self, mongo_db):
+        return self.count(mongo_db, 'blocks') + block_height_offset
+
+    def summary(self, mongo_db, neo_block_height=None):
+        summary_dict = {
+            'switcheo_blockheight': self.block_height(mongo_db),
+            'switcheo_txn_height': self.count(mongo_db, 'transactions'),
+            'switcheo_fee_height': self.count(mongo_db, 'fees')
+        }
+        if neo_block_height is not None:
+            summary_dict['neo_blockheight'] = neo_block_height
+            summary_dict['blockheight_lag'] = neo_block_height - summary_dict['switcheo_blockheight']
+        return summary_dict
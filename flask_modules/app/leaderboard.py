@@ -0,0 +1,102 @@
+""" per-asset address leaderboards sorted and paginated inside Mongo """
+from itertools import groupby, islice
+
+from app.deadlines import mongo_options
+
+
+def leaderboard_pipeline(key_name, exclude_keys=[], asset=None, limit=None, offset=0):
+    """ flatten the per-asset map under key_name into one row per (asset, address), highest value first """
+    pipeline = [
+        {
+            '$match': {key_name: {'$ne': None}}
+        }, {
+            '$project': {'entries': {'$objectToArray': '$' + key_name}}
+        }, {
+            '$unwind': '$entries'
+        }, {
+            '$match': {'entries.k': {'$nin': exclude_keys} if asset is None else {'$eq': asset, '$nin': exclude_keys}}
+        }
+    ]
+
+    if asset is not None:
+        # a single asset is sliced server side, so only the requested page leaves Mongo
+        pipeline.append({'$sort': {'entries.v': -1, '_id': 1}})
+        if offset:
+            pipeline.append({'$skip': offset})
+        if limit is not None:
+            pipeline.append({'$limit': limit})
+    else:
+        pipeline.append({'$sort': {'entries.k': 1, 'entries.v': -1, '_id': 1}})
+
+    pipeline.append({
+        '$project': {
+            '_id': 0,
+            'asset': '$entries.k',
+            'address': '$_id',
+            'value': '$entries.v'
+        }
+    })
+    return pipeline
+
+
+def leaderboard_assets_pipeline(key_name, exclude_keys=[]):
+    """ every asset on the leaderboard, in the order leaderboard_pipeline lists them """
+    return leaderboard_pipeline(key_name, exclude_keys=exclude_keys)[:-2] + [
+        {
+            '$group': {'_id': '$entries.k'}
+        }, {
+            '$sort': {'_id': 1}
+        }
+    ]
+
+
+def leaderboard_pages_pipeline(key_name, assets, exclude_keys=[], limit=None, offset=0):
+    """ one document holding each asset's page, under its position in assets, from a single pass over the addresses
+
+    Each facet sorts and slices its own asset, so Mongo keeps at most offset + limit rows per asset.
+    """
+    pages = {}
+    for i, asset in enumerate(assets):
+        pages[str(i)] = leaderboard_pipeline(key_name, exclude_keys=exclude_keys, asset=asset, limit=limit,
+                                             offset=offset)[3:]
+    return leaderboard_pipeline(key_name, exclude_keys=exclude_keys)[:3] + [{'$facet': pages}]
+
+
+def iter_leaderboard(mongo_db, collection, key_name, sort_key, exclude_keys=[], asset=None, limit=None, offset=0):
+    """ yield (asset, rows) pairs straight off the sorted cursor; each rows iterator is one asset's page """
+    if limit is not None and limit <= 0:
+        limit = None
+    offset = max(offset or 0, 0)
+
+    if asset is None and limit is not None:
+        assets = [row['_id'] for row in mongo_db[collection].aggregate(
+            leaderboard_assets_pipeline(key_name, exclude_keys=exclude_keys), allowDiskUse=True, **mongo_options())]
+        if not assets:
+            return
+        pages = next(mongo_db[collection].aggregate(
+            leaderboard_pages_pipeline(key_name, assets, exclude_keys=exclude_keys, limit=limit, offset=offset),
+            allowDiskUse=True, **mongo_options()))
+        for i, row_asset in enumerate(assets):
+            yield row_asset, ({'address': row['address'], sort_key: row['value']} for row in pages[str(i)])
+        return
+
+    cursor = mongo_db[collection].aggregate(leaderboard_pipeline(key_name=key_name,
+                                                                 exclude_keys=exclude_keys,
+                                                                 asset=asset,
+                                                                 limit=limit,
+                                                                 offset=offset), allowDiskUse=True,
+                                           **mongo_options())
+    for row_asset, rows in groupby(cursor, key=lambda row: row['asset']):
+        if asset is None:
+            # without a limit every asset arrives in one sorted stream; skip to each asset's offset
+            rows = islice(rows, offset, None if limit is None else offset + limit)
+        yield row_asset, ({'address': row['address'], sort_key: row['value']} for row in rows)
+
+
+def sort_dicts(mongo_db, collection, key_name, sort_key, exclude_keys=[], asset=None, limit=None, offset=0):
+    """ {asset: [{'address': ..., sort_key: ...}]} sorted descending, paginated per asset """
+    collection_dict = {}
+    for row_asset, rows in iter_leaderboard(mongo_db, collection, key_name, sort_key, exclude_keys=exclude_keys,
+                                            asset=asset, limit=limit, offset=offset):
+        collection_dict[row_asset] = list(rows)
+    return collection_dict
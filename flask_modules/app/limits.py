@@ -0,0 +1,179 @@
+""" per-route deadlines, concurrency caps shared by all gunicorn workers, and load shedding
+
+Every request runs under LIMITS_DEADLINE seconds (see app.deadlines).  Routes
+in a limited class also take one of the class's slots for as long as they
+compute and stream, so heavy analytics can occupy at most `slots` workers
+however many requests arrive.  Slots are flock'd files under LIMITS_DIR, so the
+cap holds across workers and threads.  A request finding every slot taken
+waits for one in a queue of `queue` places for at most `queue_timeout`
+seconds; when the queue is full, or the wait runs out, it is answered straight
+away with 503 and Retry-After.  Keep slots + queue below workers x threads, so
+cheap routes always find a free worker.
+"""
+import os
+import time
+import fcntl
+import random
+import tempfile
+from functools import wraps
+from flask import Response, g, jsonify, make_response, request
+from pymongo.errors import ExecutionTimeout
+
+from app.deadlines import DeadlineExceeded, clear_deadline, current, remaining, set_deadline, until
+from app.metrics import metrics
+from logger.logger import get_root_logger
+
+logger = get_root_logger('limits')
+
+poll_interval = 0.02
+
+
+class RouteClass(object):
+    """ the slots, queue and deadline shared by a group of routes """
+
+    def __init__(self, name, directory, slots, queue, queue_timeout, deadline):
+        self.name = name
+        self.directory = directory
+        self.slots = slots
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.deadline = deadline
+
+    def try_lock(self, prefix, count):
+        """ an open file holding one of count flocks, or None if all are held """
+        for position in random.sample(range(count), count):
+            lock_file = open(os.path.join(self.directory, self.name + '-' + prefix + '-' + str(position)), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except BlockingIOError:
+                lock_file.close()
+        return None
+
+    def acquire(self):
+        """ (slot, None) once a slot is held, or (None, reason) when the request should be shed """
+        slot = self.try_lock('slot', self.slots)
+        if slot is not None:
+            return slot, None
+        place = self.try_lock('queue', self.queue) if self.queue > 0 else None
+        if place is None:
+            return None, 'queue_full'
+        try:
+            wait = self.queue_timeout
+            left = remaining()
+            if left is not None:
+                wait = min(wait, left)
+            give_up = time.time() + wait
+            while time.time() < give_up:
+                time.sleep(poll_interval)
+                slot = self.try_lock('slot', self.slots)
+                if slot is not None:
+                    return slot, None
+            return None, 'queue_timeout'
+        finally:
+            place.close()
+
+
+class ReleasingBody(object):
+    """ response iterable that gives up its slot once the body has been sent or closed
+
+    The request's deadline has been cleared by the time a streamed body is sent,
+    so it is restored around the iteration, where lazily issued queries run.
+    """
+
+    def __init__(self, body, slot, deadline):
+        self.body = body
+        self.slot = slot
+        self.deadline = deadline
+
+    def __iter__(self):
+        try:
+            with until(self.deadline):
+                for chunk in self.body:
+                    yield chunk
+        finally:
+            self.slot.close()
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+        self.slot.close()
+
+
+class RouteLimits(object):
+    """ request deadlines for every route, and slots for the route classes declared with add_class """
+
+    def __init__(self, directory=None, deadline=None, retry_after=None):
+        self.directory = directory or os.environ.get('LIMITS_DIR',
+                                                     os.path.join(tempfile.gettempdir(), 'switcheolytics_limits'))
+        self.deadline = deadline or float(os.environ.get('LIMITS_DEADLINE', 10))
+        self.retry_after = retry_after or int(os.environ.get('LIMITS_RETRY_AFTER', 5))
+        self.enabled = os.environ.get('LIMITS_ENABLED', 'true').lower() != 'false'
+        self.classes = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def add_class(self, name, slots, queue=0, queue_timeout=1.0, deadline=None):
+        """ declare a route class; LIMITS_<NAME>_SLOTS, _QUEUE, _QUEUE_TIMEOUT and _DEADLINE override its settings """
+        prefix = 'LIMITS_' + name.upper() + '_'
+        self.classes[name] = RouteClass(name, self.directory,
+                                        slots=int(os.environ.get(prefix + 'SLOTS', slots)),
+                                        queue=int(os.environ.get(prefix + 'QUEUE', queue)),
+                                        queue_timeout=float(os.environ.get(prefix + 'QUEUE_TIMEOUT', queue_timeout)),
+                                        deadline=float(os.environ.get(prefix + 'DEADLINE', deadline or self.deadline)))
+
+    def unavailable(self, error):
+        response = make_response(jsonify({'error': error}), 503)
+        response.headers['Retry-After'] = str(self.retry_after)
+        return response
+
+    def deadline_exceeded(self, error):
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        logger.warning('deadline exceeded on ' + route + ': ' + str(error))
+        metrics.inc('switcheolytics_deadline_exceeded_total', route=route)
+        return self.unavailable('Deadline exceeded')
+
+    def request_started(self):
+        set_deadline(self.deadline if self.enabled else None)
+
+    def request_teardown(self, exception):
+        clear_deadline()
+
+    def init_app(self, app):
+        """ start each request's deadline and answer exhausted deadlines, here or in Mongo, with 503 """
+        app.before_request(self.request_started)
+        app.teardown_request(self.request_teardown)
+        app.register_error_handler(DeadlineExceeded, self.deadline_exceeded)
+        app.register_error_handler(ExecutionTimeout, self.deadline_exceeded)
+
+    def limited(self, name):
+        """ run the view in one of the class's slots under the class's deadline, or shed the request with 503 """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                route_class = self.classes[name]
+                if not self.enabled:
+                    return view(*args, **kwargs)
+                started = time.time()
+                slot, reason = route_class.acquire()
+                metrics.observe('switcheolytics_limit_wait_seconds', time.time() - started, route_class=name)
+                if slot is None:
+                    metrics.inc('switcheolytics_shed_total', route_class=name, reason=reason)
+                    return self.unavailable('Too busy, retry later')
+                try:
+                    # the class's deadline replaces the default one, less the time spent queueing, unless
+                    # the caller (a /batch item) set a sooner one of its own
+                    seconds = route_class.deadline - (time.time() - started)
+                    if g.get('outer_deadline') is not None:
+                        seconds = min(seconds, g.outer_deadline - time.time())
+                    set_deadline(seconds)
+                    response = view(*args, **kwargs)
+                    if not isinstance(response, Response):
+                        response = make_response(response)
+                except Exception:
+                    slot.close()
+                    raise
+                # streamed bodies are still being computed as they are sent, so the slot goes with the body
+                response.response = ReleasingBody(response.response, slot, current())
+                return response
+            return wrapper
+        return decorator
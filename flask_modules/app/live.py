@@ -0,0 +1,181 @@
+""" block height and trading status pushed as Server-Sent Events from one poller per process
+
+The poller calls every source once per LIVE_POLL_INTERVAL while anyone is
+subscribed, and records an event for each value that changed.  Subscribers
+never call RPC themselves; they wait on a shared condition and send whatever
+was recorded after the last event they saw.  Event ids are millisecond
+timestamps; a client reconnecting with Last-Event-ID to the same worker is
+sent the events it missed while they are still buffered, and any other
+client is sent the full state.
+"""
+import os
+import json
+import time
+import asyncio
+import threading
+from collections import deque
+
+from app.metrics import metrics
+from logger.logger import get_root_logger
+
+logger = get_root_logger('live')
+
+
+def sse(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append('id: ' + str(event_id))
+    lines.append('event: ' + event)
+    lines.append('data: ' + json.dumps(data))
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+def parse_event_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class LiveState(object):
+    """ the latest value of each source, a buffer of recent changes, and the poller that fills them """
+
+    def __init__(self, sources, interval=None, heartbeat=None, history=None, max_seconds=None):
+        self.sources = sources
+        self.interval = interval or float(os.environ.get('LIVE_POLL_INTERVAL', 5))
+        self.heartbeat = heartbeat or float(os.environ.get('LIVE_HEARTBEAT', 15))
+        # a stream is closed after this long, so it does not hold a sync worker forever; clients reconnect
+        self.max_seconds = max_seconds or float(os.environ.get('LIVE_MAX_SECONDS', 300))
+        self.events = deque(maxlen=history or int(os.environ.get('LIVE_HISTORY', 256)))
+        self.state = {}
+        self.last_id = 0
+        self.subscribers = 0
+        self.pid = None
+        self.condition = threading.Condition()
+        self.wakeup = threading.Event()
+
+    def ensure_poller(self):
+        # one poller per process, restarted in a forked worker
+        with self.condition:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        threading.Thread(target=self.run, name='live-poller', daemon=True).start()
+
+    def run(self):
+        while True:
+            if self.subscribers > 0:
+                self.poll()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def poll(self):
+        changed = {}
+        for name, source in self.sources.items():
+            try:
+                value = source()
+            except Exception as e:
+                logger.warning('live source ' + name + ' failed: ' + str(e))
+                continue
+            if self.state.get(name) != value or name not in self.state:
+                changed[name] = value
+        if not changed:
+            return
+        with self.condition:
+            for name, value in changed.items():
+                # strictly increasing, and comparable across workers to the millisecond
+                self.last_id = max(int(time.time() * 1000), self.last_id + 1)
+                self.state[name] = value
+                self.events.append((self.last_id, name, value))
+            self.condition.notify_all()
+        metrics.inc('switcheolytics_live_events_total', value=len(changed))
+
+    def subscribe(self):
+        self.ensure_poller()
+        with self.condition:
+            self.subscribers += 1
+            first = not self.state
+        metrics.gauge_add('switcheolytics_live_subscribers', 1)
+        if first or time.time() * 1000 - self.last_id > self.interval * 1000:
+            self.wakeup.set()
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+        metrics.gauge_add('switcheolytics_live_subscribers', -1)
+
+    def since(self, last_id):
+        """ the events after last_id, or None unless last_id is this process's latest or still buffered """
+        with self.condition:
+            if last_id == self.last_id:
+                return []
+            # an id from another worker, or one that has left the buffer, cannot be resumed from exactly
+            if not any(event[0] == last_id for event in self.events):
+                return None
+            return [event for event in self.events if event[0] > last_id]
+
+    def opening(self, last_id):
+        """ the first chunks of a stream: the missed events when resuming, the full state otherwise """
+        chunks = [('retry: ' + str(int(self.interval * 1000)) + '\n\n').encode('utf-8')]
+        missed = self.since(last_id)
+        if missed is not None:
+            chunks.extend(sse(name, {name: value}, event_id) for event_id, name, value in missed)
+            return chunks, missed[-1][0] if missed else last_id
+        with self.condition:
+            state, current_id = dict(self.state), self.last_id
+        if state:
+            chunks.append(sse('state', state, current_id))
+        return chunks, current_id
+
+    def stream(self, last_event_id=None):
+        """ SSE chunks for one client until max_seconds, with a comment line every heartbeat seconds of quiet """
+        self.subscribe()
+        try:
+            chunks, last_id = self.opening(parse_event_id(last_event_id))
+            for chunk in chunks:
+                yield chunk
+            started = time.time()
+            while time.time() - started < self.max_seconds:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.last_id > last_id, timeout=self.heartbeat)
+                events = self.since(last_id)
+                if events is None:
+                    # fell behind the buffer; start over from the full state
+                    chunks, last_id = self.opening(None)
+                    for chunk in chunks[1:]:
+                        yield chunk
+                elif events:
+                    for event_id, name, value in events:
+                        yield sse(name, {name: value}, event_id)
+                    last_id = events[-1][0]
+                else:
+                    yield b': heartbeat\n\n'
+        finally:
+            self.unsubscribe()
+
+    async def astream(self, last_event_id=None, check_interval=0.25):
+        """ stream() for an event loop: checks for new events every check_interval instead of blocking a thread """
+        self.subscribe()
+        try:
+            chunks, last_id = self.opening(parse_event_id(last_event_id))
+            for chunk in chunks:
+                yield chunk
+            started = quiet = time.time()
+            while time.time() - started < self.max_seconds:
+                await asyncio.sleep(check_interval)
+                if self.last_id > last_id:
+                    events = self.since(last_id)
+                    if events is None:
+                        chunks, last_id = self.opening(None)
+                        for chunk in chunks[1:]:
+                            yield chunk
+                    else:
+                        for event_id, name, value in events:
+                            yield sse(name, {name: value}, event_id)
+                        last_id = events[-1][0] if events else last_id
+                    quiet = time.time()
+                elif time.time() - quiet >= self.heartbeat:
+                    yield b': heartbeat\n\n'
+                    quiet = time.time()
+        finally:
+            self.unsubscribe()
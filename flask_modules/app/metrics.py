@@ -0,0 +1,278 @@
+""" request, Mongo and upstream call instrumentation exposed in Prometheus text format
+
+Every worker keeps its metrics in memory and periodically writes a snapshot to
+METRICS_DIR; /metrics merges the snapshots of all workers, so any worker can
+answer for the whole gunicorn process group.  Mongo commands are timed through
+a pymongo command listener, which has to be registered before the client is
+created, so import this module before building SwitcheoSmartContract.
+"""
+import os
+import json
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+from flask import request
+from pymongo import monitoring
+
+from logger.logger import get_root_logger
+
+metrics_dir = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'switcheolytics_metrics'))
+time_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+size_buckets = [1024, 10240, 102400, 1048576, 10485760, 104857600]
+flush_interval = 1.0
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for name, value in labels) + '}'
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class Metrics(object):
+    """ counters, gauges and histograms keyed by (name, sorted label pairs) """
+
+    def __init__(self, directory=metrics_dir):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.last_flush = 0
+        self.local = threading.local()
+        self.slow_request_seconds = float(os.environ.get('SLOW_REQUEST_SECONDS', 0) or 0)
+        self.slow_logger = get_root_logger('slow_requests') if self.slow_request_seconds > 0 else None
+
+    def key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge_add(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        buckets = size_buckets if name.endswith('_bytes') else time_buckets
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': buckets, 'counts': [0] * (len(buckets) + 1),
+                                                    'sum': 0, 'count': 0}
+            position = len(buckets)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    position = i
+                    break
+            histogram['counts'][position] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timed(self, upstream, call):
+        """ time one outbound HTTP or RPC call """
+        started = time.time()
+        status = 'ok'
+        try:
+            yield
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            self.observe('switcheolytics_upstream_duration_seconds', time.time() - started,
+                         upstream=upstream, call=call, status=status)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'gauges': [[name, list(labels), value] for (name, labels), value in self.gauges.items()],
+                'histograms': [[name, list(labels), histogram] for (name, labels), histogram in self.histograms.items()],
+            }
+
+    def flush(self, force=False):
+        now = time.time()
+        if not force and now - self.last_flush < flush_interval:
+            return
+        self.last_flush = now
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, 'metrics-' + str(os.getpid()) + '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def worker_snapshots(self):
+        snapshots = []
+        for filename in os.listdir(self.directory):
+            if not filename.startswith('metrics-') or not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self):
+        """ every worker's metrics merged into the Prometheus text exposition format """
+        self.flush(force=True)
+        counters, gauges, histograms = {}, {}, {}
+        for snapshot in self.worker_snapshots():
+            alive = pid_alive(snapshot['pid'])
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in snapshot['gauges']:
+                if alive:
+                    key = (name, tuple(tuple(label) for label in labels))
+                    gauges[key] = gauges.get(key, 0) + value
+            for name, labels, histogram in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                merged = histograms.setdefault(key, {'buckets': histogram['buckets'],
+                                                     'counts': [0] * len(histogram['counts']), 'sum': 0, 'count': 0})
+                merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+                merged['sum'] += histogram['sum']
+                merged['count'] += histogram['count']
+
+        lines = []
+        for metric_type, series in [('counter', counters), ('gauge', gauges)]:
+            for name in sorted(set(name for name, _ in series)):
+                lines.append('# TYPE ' + name + ' ' + metric_type)
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name == name:
+                        lines.append(name + format_labels(labels) + ' ' + repr(value))
+        for name in sorted(set(name for name, _ in histograms)):
+            lines.append('# TYPE ' + name + ' histogram')
+            for (series_name, labels), histogram in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram['buckets'] + [float('inf')], histogram['counts']):
+                    cumulative += count
+                    lines.append(name + '_bucket' + format_labels(labels + (('le', format_bound(bound)),)) +
+                                 ' ' + str(cumulative))
+                lines.append(name + '_sum' + format_labels(labels) + ' ' + repr(histogram['sum']))
+                lines.append(name + '_count' + format_labels(labels) + ' ' + str(histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def request_started(self):
+        self.local.started = time.time()
+        self.local.mongo_seconds = 0
+        self.local.mongo_calls = 0
+        self.local.route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        self.gauge_add('switcheolytics_requests_in_flight', 1, route=self.local.route)
+
+    def request_info(self, status):
+        route = self.local.route
+        self.local.route = None
+        return dict(route=route, method=request.method, status=status, started=self.local.started,
+                    args=request.query_string.decode('utf-8', 'replace'),
+                    mongo_seconds=self.local.mongo_seconds, mongo_calls=self.local.mongo_calls)
+
+    def request_finished(self, response):
+        if getattr(self.local, 'route', None) is not None:
+            response.response = MeasuredBody(self, response.response, **self.request_info(response.status_code))
+        return response
+
+    def request_teardown(self, exception):
+        # unhandled errors become a bare 500 without running after_request hooks
+        if getattr(self.local, 'route', None) is not None:
+            self.record_response(size=0, **self.request_info(500))
+
+    def record_response(self, route, method, status, started, size, args, mongo_seconds, mongo_calls):
+        duration = time.time() - started
+        self.gauge_add('switcheolytics_requests_in_flight', -1, route=route)
+        self.inc('switcheolytics_requests_total', route=route, method=method, status=status)
+        self.observe('switcheolytics_request_duration_seconds', duration, route=route, method=method)
+        self.observe('switcheolytics_response_size_bytes', size, route=route)
+        if self.slow_logger is not None and duration >= self.slow_request_seconds:
+            self.slow_logger.warning(json.dumps({
+                'route': route, 'method': method, 'status': status, 'args': args,
+                'duration_ms': round(duration * 1000, 1), 'bytes': size,
+                'mongo_ms': round(mongo_seconds * 1000, 1), 'mongo_calls': mongo_calls
+            }))
+        self.flush()
+
+    def init_app(self, app):
+        """ register the request hooks; call before hooks that rewrite the body, so sizes are the bytes sent """
+        app.before_request(self.request_started)
+        app.after_request(self.request_finished)
+        app.teardown_request(self.request_teardown)
+
+
+class MeasuredBody(object):
+    """ response iterable that records duration and size once the body has been sent or closed """
+
+    def __init__(self, metrics, body, **request_info):
+        self.metrics = metrics
+        self.body = body
+        self.request_info = request_info
+        self.size = 0
+        self.recorded = False
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+        self.record()
+
+    def record(self):
+        if not self.recorded:
+            self.recorded = True
+            self.metrics.record_response(size=self.size, **self.request_info)
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+        self.record()
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """ times every Mongo command by name and collection, and adds it to the current request's totals """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self.collections[event.request_id] = collection if isinstance(collection, str) else ''
+
+    def succeeded(self, event):
+        self.record(event, 'ok')
+
+    def failed(self, event):
+        self.record(event, 'error')
+
+    def record(self, event, status):
+        seconds = event.duration_micros / 1000000.0
+        self.metrics.observe('switcheolytics_mongo_duration_seconds', seconds, command=event.command_name,
+                             collection=self.collections.pop(event.request_id, ''), status=status)
+        local = self.metrics.local
+        if getattr(local, 'route', None) is not None:
+            local.mongo_seconds += seconds
+            local.mongo_calls += 1
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+metrics = Metrics()
+monitoring.register(MongoCommandTimer(metrics))
@@ -0,0 +1,126 @@
+""" pooled, cached and circuit-broken Neoscan balance lookups """
+import os
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.deadlines import call_timeout
+from app.metrics import metrics
+from logger.logger import get_root_logger
+
+logger = get_root_logger('neoscan')
+
+
+class NeoscanUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """ opens after consecutive failures and lets a single trial call through once reset_timeout has passed """
+
+    def __init__(self, failure_threshold=3, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_timeout:
+                # half open: push the next trial out so only one caller probes the upstream
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
+class NeoscanClient(object):
+    """ balance lookups served from a TTL cache with stale-while-revalidate refreshes
+
+    A cached balance younger than ttl is served as is.  An older one is still
+    served immediately while a background thread refreshes it; past max_stale
+    the refresh happens inline, and the last known value is returned if that
+    fails or the circuit breaker is open.
+    """
+
+    def __init__(self, base_url=None, ttl=None, max_stale=None, timeout=None, pool_size=4):
+        self.base_url = base_url or os.environ.get('NEOSCAN_URL', 'https://api.neoscan.io/api/main_net/v1/')
+        self.ttl = ttl if ttl is not None else int(os.environ.get('NEOSCAN_TTL', 60))
+        self.max_stale = max_stale if max_stale is not None else int(os.environ.get('NEOSCAN_MAX_STALE', 3600))
+        self.timeout = timeout or (3, float(os.environ.get('NEOSCAN_TIMEOUT', 10)))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.breaker = CircuitBreaker()
+        self.balances = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def fetch_balance(self, address):
+        if not self.breaker.allow():
+            raise NeoscanUnavailable('circuit open for ' + self.base_url)
+        try:
+            with metrics.timed('neoscan', 'get_balance'):
+                r = self.session.get(url=self.base_url + 'get_balance/' + address,
+                                     timeout=tuple(call_timeout(part) for part in self.timeout))
+                r.raise_for_status()
+                balance = r.json()
+        except (requests.RequestException, ValueError):
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        with self.lock:
+            self.balances[address] = (time.time(), balance)
+        return balance
+
+    def refresh(self, address):
+        try:
+            self.fetch_balance(address)
+        except (NeoscanUnavailable, requests.RequestException, ValueError) as e:
+            logger.warning('neoscan refresh failed for ' + address + ': ' + str(e))
+        finally:
+            with self.lock:
+                self.refreshing.discard(address)
+
+    def refresh_in_background(self, address):
+        with self.lock:
+            if address in self.refreshing:
+                return
+            self.refreshing.add(address)
+        threading.Thread(target=self.refresh, args=(address,), daemon=True).start()
+
+    def get_balance(self, address):
+        cached = self.balances.get(address)
+        if cached is None:
+            return self.fetch_balance(address)
+
+        fetched_at, balance = cached
+        age = time.time() - fetched_at
+        if age < self.ttl:
+            return balance
+        if age < self.max_stale or self.breaker.is_open():
+            self.refresh_in_background(address)
+            return balance
+        try:
+            return self.fetch_balance(address)
+        except (NeoscanUnavailable, requests.RequestException, ValueError) as e:
+            logger.warning('serving ' + str(int(age)) + 's old neoscan balance for ' + address + ': ' + str(e))
+            return balance
@@ -0,0 +1,89 @@
+""" open order book read from offer_hash with filters, projection and price sorting pushed into Mongo """
+from app.deadlines import mongo_options
+from app.metrics import metrics
+from logger.logger import get_root_logger
+
+logger = get_root_logger('offers')
+
+offer_fields = ['maker_address', 'amount_filled', 'offer_asset_name', 'offer_amount_fixed8',
+                'want_asset_name', 'want_amount_fixed8']
+
+
+def trade_pair_lookup(trade_pair_list):
+    """ {(offer_asset_name, want_asset_name): trade_pair} for both sides of every listed pair """
+    pair_lookup = {}
+    for trade_pair in trade_pair_list:
+        base, _, quote = trade_pair.partition('_')
+        pair_lookup[(base, quote)] = trade_pair
+    for trade_pair in trade_pair_list:
+        base, _, quote = trade_pair.partition('_')
+        pair_lookup.setdefault((quote, base), trade_pair)
+    return pair_lookup
+
+
+def open_offers_pipeline(trade_pair_list, trade_pair=None, address=None):
+    match = {'status': 'open', '_id': {'$ne': None}}
+    if address is not None:
+        match['maker_address'] = address
+    if trade_pair is not None:
+        base, _, quote = trade_pair.partition('_')
+        match['$or'] = [
+            {'offer_asset_name': base, 'want_asset_name': quote},
+            {'offer_asset_name': quote, 'want_asset_name': base}
+        ]
+
+    # price is quote per base: selling the base asset is want/offer, buying it is offer/want
+    sells_base = {'$in': [{'$concat': ['$offer_asset_name', '_', '$want_asset_name']}, trade_pair_list]}
+    return [
+        {
+            '$match': match
+        }, {
+            '$project': dict((field, 1) for field in offer_fields)
+        }, {
+            '$addFields': {
+                'price': {
+                    '$cond': [
+                        sells_base,
+                        {'$cond': [{'$eq': ['$offer_amount_fixed8', 0]}, None,
+                                   {'$divide': ['$want_amount_fixed8', '$offer_amount_fixed8']}]},
+                        {'$cond': [{'$eq': ['$want_amount_fixed8', 0]}, None,
+                                   {'$divide': ['$offer_amount_fixed8', '$want_amount_fixed8']}]}
+                    ]
+                }
+            }
+        }, {
+            '$sort': {'price': 1, '_id': 1}
+        }
+    ]
+
+
+def iter_open_offers(mongo_db, trade_pair_list, pair_lookup, trade_pair=None, address=None):
+    """ yield open offers one at a time; offers on unknown trade pairs are skipped, logged and counted
+
+    The response is already streaming by the time the last offer is read, so the count goes to
+    switcheolytics_offers_skipped_total{trade_pair} rather than into the body.
+    """
+    skipped = {}
+    for offer in mongo_db['offer_hash'].aggregate(open_offers_pipeline(trade_pair_list, trade_pair=trade_pair,
+                                                                       address=address), allowDiskUse=True,
+                                                  **mongo_options()):
+        offer_pair = pair_lookup.get((offer['offer_asset_name'], offer['want_asset_name']))
+        if offer_pair is None:
+            unknown_pair = str(offer['offer_asset_name']) + '_' + str(offer['want_asset_name'])
+            skipped[unknown_pair] = skipped.get(unknown_pair, 0) + 1
+            continue
+        yield {
+            'address': offer['maker_address'],
+            'amount_filled': offer['amount_filled'],
+            'trade_pair': offer_pair,
+            'offer_amount': offer['offer_amount_fixed8'],
+            'offer_asset_name': offer['offer_asset_name'],
+            'want_amount': offer['want_amount_fixed8'],
+            'want_asset_name': offer['want_asset_name']
+        }
+
+    if skipped:
+        logger.warning('skipped ' + str(sum(skipped.values())) + ' open offers with unknown trade pairs: ' +
+                       ', '.join(pair + ' x' + str(count) for pair, count in sorted(skipped.items())))
+        for unknown_pair, count in skipped.items():
+            metrics.inc('switcheolytics_offers_skipped_total', value=count, trade_pair=unknown_pair)
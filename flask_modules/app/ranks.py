@@ -0,0 +1,295 @@
+""" per-address ranks in every leaderboard and the richlist, maintained incrementally in address_ranks
+
+Each address_ranks row holds one address's value in one (metric, asset)
+leaderboard and its rank there: one plus the number of addresses with a
+greater value, so ties share a rank.  When an address's value changes only
+the rows between its old and new value move, by one, in a single update_many,
+so a profile lookup reads ranks instead of sorting every address.
+
+Addresses are re-read when a transaction touching them (as depositor,
+withdrawer, maker or taker) lands after the stored high-water mark.  The
+address statistics are written by a separate ingestion step, so each update
+also re-reads the addresses touched in the ADDRESS_RANKS_LOOKBACK seconds
+before the mark, and `rebuild` recomputes everything from scratch.  One
+process at a time updates, under a lease in rollup_state.  Requests only read
+the ranks: updates run in the snapshot builder's leader or from `update`, and
+until `rebuild` has run, profiles list every rank as null.
+
+    python -m app.ranks rebuild   # recompute every rank from addresses
+    python -m app.ranks update    # apply changes since the high-water mark
+    python -m app.ranks check     # compare the stored ranks with a fresh computation
+"""
+import os
+import sys
+import time
+import json
+import argparse
+from pymongo import InsertOne
+
+from app.deadlines import max_time_ms
+from app.leaderboard import leaderboard_pipeline
+from app.richlist import richlist_filter
+from app.rollup import acquire_lease, release_lease, state_collection
+
+ranks_collection = 'address_ranks'
+totals_collection = 'address_rank_totals'
+# leaderboard metric: keys of its per-asset map that are not assets
+ranked_metrics = [
+    ('fees_paid', []),
+    ('takes', ['wants', 'offers']),
+    ('makes', ['wants', 'offers']),
+    ('trade_count', []),
+    ('total_amount_traded', []),
+]
+# the richlist is ranked as one more leaderboard, of SWTH totals
+richlist_metric = ('rich_list', 'SWTH')
+transaction_addresses = ['deposit_address', 'withdraw_address', 'maker_address', 'taker_address']
+
+
+def row_id(metric, asset, address):
+    return metric + '|' + str(asset) + '|' + address
+
+
+def address_entries(address_doc):
+    """ {(metric, asset): value} for every leaderboard an addresses document appears on """
+    entries = {}
+    for metric, exclude_keys in ranked_metrics:
+        for asset, value in (address_doc.get(metric) or {}).items():
+            if asset not in exclude_keys and value is not None:
+                entries[(metric, asset)] = value
+    rich_list = address_doc.get('rich_list')
+    if rich_list is not None and rich_list.get('total') is not None:
+        entries[richlist_metric] = rich_list['total']
+    return entries
+
+
+def ranked_rows(mongo_db):
+    """ every (metric, asset, address, value, rank) from full sorts, as rebuild writes and check compares them """
+    def ranked(metric, rows):
+        previous_key = previous_value = None
+        position = rank = 0
+        for asset, address, value in rows:
+            if (metric, asset) != previous_key:
+                previous_key, position, previous_value = (metric, asset), 0, None
+            position += 1
+            if value != previous_value:
+                rank, previous_value = position, value
+            yield metric, asset, address, value, rank
+
+    for metric, exclude_keys in ranked_metrics:
+        cursor = mongo_db['addresses'].aggregate(leaderboard_pipeline(key_name=metric, exclude_keys=exclude_keys),
+                                                 allowDiskUse=True)
+        for row in ranked(metric, ((row['asset'], row['address'], row['value']) for row in cursor)):
+            yield row
+
+    cursor = mongo_db['addresses'].find(richlist_filter, projection=['rich_list.total'])
+    cursor = cursor.sort([('rich_list.total', -1), ('_id', 1)])
+    for row in ranked(richlist_metric[0], ((richlist_metric[1], address['_id'], address['rich_list']['total'])
+                                           for address in cursor if address['rich_list'].get('total') is not None)):
+        yield row
+
+
+def rebuild_address_ranks(mongo_db, batch_size=1000):
+    """ recompute every rank into a fresh collection and swap it in; returns the number of rows written """
+    if not acquire_lease(mongo_db, ranks_collection):
+        return 0
+    latest = mongo_db['transactions'].find_one({'block_time': {'$ne': None}}, projection={'block_time': True},
+                                               sort=[('block_time', -1)])
+    build = mongo_db[ranks_collection + '_build']
+    build.drop()
+    build.create_index([('metric', 1), ('asset', 1), ('value', -1)])
+    build.create_index('address')
+    totals = {}
+    written = 0
+    batch = []
+    try:
+        for metric, asset, address, value, rank in ranked_rows(mongo_db):
+            batch.append(InsertOne({'_id': row_id(metric, asset, address), 'metric': metric, 'asset': asset,
+                                    'address': address, 'value': value, 'rank': rank}))
+            totals[(metric, asset)] = totals.get((metric, asset), 0) + 1
+            if len(batch) >= batch_size:
+                build.bulk_write(batch, ordered=False)
+                written += len(batch)
+                batch = []
+        if batch:
+            build.bulk_write(batch, ordered=False)
+            written += len(batch)
+        build.rename(ranks_collection, dropTarget=True)
+        mongo_db[totals_collection].drop()
+        if totals:
+            mongo_db[totals_collection].insert_many([{'_id': row_id(metric, asset, ''), 'holders': holders}
+                                                     for (metric, asset), holders in totals.items()])
+    except BaseException:
+        release_lease(mongo_db, ranks_collection)
+        raise
+    release_lease(mongo_db, ranks_collection, {'block_time': latest['block_time'] if latest is not None else None,
+                                               'rebuilt': int(time.time()), 'updated': int(time.time())})
+    return written
+
+
+def apply_change(mongo_db, metric, asset, address, old, new):
+    """ move one address from old to new (None when absent) and shift the ranks in between by one """
+    ranks = mongo_db[ranks_collection]
+    board = {'metric': metric, 'asset': asset}
+    others = dict(board, address={'$ne': address})
+    if old is None:
+        ranks.update_many(dict(board, value={'$lt': new}), {'$inc': {'rank': 1}})
+        holders = 1
+    elif new is None:
+        ranks.update_many(dict(others, value={'$lt': old}), {'$inc': {'rank': -1}})
+        holders = -1
+    elif new > old:
+        ranks.update_many(dict(others, value={'$gte': old, '$lt': new}), {'$inc': {'rank': 1}})
+        holders = 0
+    else:
+        ranks.update_many(dict(others, value={'$gte': new, '$lt': old}), {'$inc': {'rank': -1}})
+        holders = 0
+
+    if new is None:
+        ranks.delete_one({'_id': row_id(metric, asset, address)})
+    else:
+        rank = ranks.count_documents(dict(others, value={'$gt': new})) + 1
+        ranks.replace_one({'_id': row_id(metric, asset, address)},
+                          dict(board, address=address, value=new, rank=rank), upsert=True)
+    if holders:
+        mongo_db[totals_collection].update_one({'_id': row_id(metric, asset, '')}, {'$inc': {'holders': holders}},
+                                               upsert=True)
+
+
+def update_address(mongo_db, address):
+    """ bring one address's rows in line with its addresses document; returns the number of changed entries """
+    address_doc = mongo_db['addresses'].find_one({'_id': address}) or {}
+    new_entries = address_entries(address_doc)
+    old_entries = dict(((row['metric'], row['asset']), row['value'])
+                       for row in mongo_db[ranks_collection].find({'address': address}))
+    changed = 0
+    for key in set(old_entries) | set(new_entries):
+        old, new = old_entries.get(key), new_entries.get(key)
+        if old != new:
+            apply_change(mongo_db, key[0], key[1], address, old, new)
+            changed += 1
+    return changed
+
+
+def touched_addresses(mongo_db, from_epoch):
+    """ every address named by, or making an offer filled by, a transaction at or after from_epoch """
+    addresses = set()
+    offer_hashes = set()
+    projection = transaction_addresses + ['offer_hash', 'switcheo_transaction_type']
+    for txn in mongo_db['transactions'].find({'block_time': {'$gte': from_epoch}}, projection=projection):
+        addresses.update(txn[field] for field in transaction_addresses if txn.get(field))
+        if txn.get('switcheo_transaction_type') == 'fillOffer' and txn.get('offer_hash'):
+            offer_hashes.add(txn['offer_hash'])
+    if offer_hashes:
+        for offer in mongo_db['offer_hash'].find({'_id': {'$in': list(offer_hashes)}}, projection=['maker_address']):
+            if offer.get('maker_address'):
+                addresses.add(offer['maker_address'])
+    return addresses
+
+
+def update_address_ranks(mongo_db, interval=None, lookback=None):
+    """ apply the changes of recently touched addresses, at most once per interval; returns the entries changed
+
+    Returns None while the ranks have never been built, and 0 straight away while
+    another process holds the lease or the last update is recent.
+    """
+    interval = interval if interval is not None else float(os.environ.get('ADDRESS_RANKS_INTERVAL', 60))
+    lookback = lookback if lookback is not None else float(os.environ.get('ADDRESS_RANKS_LOOKBACK', 3600))
+    state = mongo_db[state_collection].find_one({'_id': ranks_collection}) or {}
+    if 'rebuilt' not in state:
+        return None
+    if time.time() - state.get('updated', 0) < interval or not acquire_lease(mongo_db, ranks_collection):
+        return 0
+
+    high_water = state.get('block_time')
+    latest = mongo_db['transactions'].find_one({'block_time': {'$ne': None}}, projection={'block_time': True},
+                                               sort=[('block_time', -1)])
+    changed = 0
+    try:
+        if latest is not None:
+            from_epoch = (high_water or latest['block_time']) - lookback
+            for address in touched_addresses(mongo_db, from_epoch):
+                changed += update_address(mongo_db, address)
+    finally:
+        release_lease(mongo_db, ranks_collection,
+                      {'block_time': latest['block_time'] if latest is not None else high_water,
+                       'updated': int(time.time())})
+    return changed
+
+
+def address_profile(mongo_db, address):
+    """ the address's value, rank, holders and percentile in every leaderboard and the richlist, or None """
+    address_doc = mongo_db['addresses'].find_one({'_id': address}, max_time_ms=max_time_ms())
+    if address_doc is None:
+        return None
+    ranks = {}
+    holders = {}
+    state = mongo_db[state_collection].find_one({'_id': ranks_collection}, projection=['rebuilt', 'updated'],
+                                                max_time_ms=max_time_ms()) or {}
+    # ranks that were never built stay null rather than being built on the request path
+    if 'rebuilt' in state:
+        ranks = dict(((row['metric'], row['asset']), row)
+                     for row in mongo_db[ranks_collection].find({'address': address}, max_time_ms=max_time_ms()))
+        holders = dict((row['_id'], row['holders']) for row in mongo_db[totals_collection].find(
+            {'_id': {'$in': [row_id(metric, asset, '') for metric, asset in ranks]}}, max_time_ms=max_time_ms()))
+
+    def ranked(metric, asset, value):
+        entry = {'value': value, 'rank': None, 'holders': None, 'percentile': None}
+        row = ranks.get((metric, asset))
+        board_holders = holders.get(row_id(metric, asset, ''))
+        if row is not None and board_holders:
+            entry.update(rank=row['rank'], holders=board_holders,
+                         percentile=100.0 * (board_holders - row['rank'] + 1) / board_holders)
+        return entry
+
+    profile = {'address': address, 'ranks_updated': state.get('updated')}
+    for (metric, asset), value in sorted(address_entries(address_doc).items(), key=lambda item: str(item[0])):
+        if (metric, asset) == richlist_metric:
+            profile[metric] = dict(ranked(metric, asset, value),
+                                   smart_contract=address_doc['rich_list'].get('smart_contract'),
+                                   on_chain=address_doc['rich_list'].get('on_chain'))
+        else:
+            profile.setdefault(metric, {})[asset] = ranked(metric, asset, value)
+    return profile
+
+
+def check_address_ranks(mongo_db):
+    """ every stored row whose value or rank differs from a fresh computation, and every missing or extra row """
+    stored = dict((row['_id'], (row['value'], row['rank'])) for row in mongo_db[ranks_collection].find())
+    mismatches = []
+    for metric, asset, address, value, rank in ranked_rows(mongo_db):
+        key = row_id(metric, asset, address)
+        found = stored.pop(key, None)
+        if found != (value, rank):
+            mismatches.append({'row': key, 'expected': [value, rank], 'stored': found})
+    for key, found in stored.items():
+        mismatches.append({'row': key, 'expected': None, 'stored': found})
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain the per-address leaderboard and richlist ranks.')
+    parser.add_argument('command', choices=['rebuild', 'update', 'check'])
+    args = parser.parse_args(argv)
+
+    from app.wsgi import connections
+    mongo_db = connections.mongo_db()
+    if args.command == 'rebuild':
+        print('rebuilt ' + str(rebuild_address_ranks(mongo_db)) + ' ' + ranks_collection + ' rows')
+    elif args.command == 'update':
+        changed = update_address_ranks(mongo_db, interval=0)
+        if changed is None:
+            print(ranks_collection + ' has not been built; run rebuild')
+        else:
+            print('updated ' + str(changed) + ' ' + ranks_collection + ' entries')
+    else:
+        mismatches = check_address_ranks(mongo_db)
+        for mismatch in mismatches:
+            print(json.dumps(mismatch, default=str))
+        print(str(len(mismatches)) + ' mismatches')
+        return 1 if mismatches else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+""" streamed JSON responses with negotiated gzip/brotli compression """
+import json
+import zlib
+import types
+from flask import Response, request, stream_with_context
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+chunk_size = 64 * 1024
+compress_min_size = 1024
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj).encode('utf-8')
+
+
+class StreamedObject(object):
+    """ a JSON object whose (key, value) pairs are produced lazily, e.g. one per asset off a sorted cursor """
+
+    def __init__(self, items):
+        self.items = items
+
+
+def json_key(key):
+    if isinstance(key, str):
+        return key
+    # the same key coercion json.dumps applies
+    return json.dumps(key) if key is None or isinstance(key, bool) else str(key)
+
+
+def iter_json(obj):
+    """ yield the JSON encoding of obj in pieces; generators and StreamedObjects are never materialized """
+    if isinstance(obj, StreamedObject) or isinstance(obj, dict):
+        items = obj.items if isinstance(obj, StreamedObject) else obj.items()
+        yield b'{'
+        separator = b''
+        for key, value in items:
+            yield separator + dumps(json_key(key)) + b':'
+            for chunk in iter_json(value):
+                yield chunk
+            separator = b','
+        yield b'}'
+    elif isinstance(obj, (list, tuple, types.GeneratorType)) or hasattr(obj, '__next__'):
+        yield b'['
+        separator = b''
+        for item in obj:
+            if isinstance(item, (StreamedObject, types.GeneratorType)):
+                yield separator
+                for chunk in iter_json(item):
+                    yield chunk
+            else:
+                yield separator + dumps(item)
+            separator = b','
+        yield b']'
+    else:
+        yield dumps(obj)
+
+
+def materialize(obj):
+    """ the plain dict/list equivalent of a streamed structure """
+    if isinstance(obj, StreamedObject) or isinstance(obj, dict):
+        items = obj.items if isinstance(obj, StreamedObject) else obj.items()
+        return dict((key, materialize(value)) for key, value in items)
+    if isinstance(obj, (list, tuple, types.GeneratorType)) or hasattr(obj, '__next__'):
+        return [materialize(item) for item in obj]
+    return obj
+
+
+def buffered(chunks):
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def json_response(obj, status=200):
+    return Response(stream_with_context(buffered(iter_json(obj))), status=status, mimetype='application/json')
+
+
+def accepted_encoding():
+    """ the client's highest weighted encoding we can produce, br on ties; q=0 rules an encoding out """
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def compress_chunks(chunks, encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor()
+        for chunk in chunks:
+            compressed = compressor.process(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+
+def compress_response(response):
+    """ after_request hook: compress JSON bodies, streamed ones included, for clients that accept it """
+    if response.mimetype != 'application/json' or response.direct_passthrough or \
+            response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding()
+    if encoding is None:
+        return response
+    if response.is_sequence and len(response.get_data()) < compress_min_size:
+        return response
+
+    response.response = compress_chunks(response.iter_encoded(), encoding)
+    response.headers.pop('Content-Length', None)
+    response.headers['Content-Encoding'] = encoding
+    return response
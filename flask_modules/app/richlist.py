@@ -0,0 +1,44 @@
+""" SWTH richlist sorted, paginated and ranked inside Mongo """
+from app.deadlines import max_time_ms, mongo_options
+
+richlist_filter = {'rich_list': {'$exists': True}}
+richlist_projection = ['rich_list.smart_contract', 'rich_list.on_chain', 'rich_list.total']
+
+
+def iter_richlist(mongo_db, limit=None, offset=0):
+    """ richlist rows by total descending """
+    cursor = mongo_db['addresses'].find(richlist_filter, projection=richlist_projection, max_time_ms=max_time_ms())
+    cursor = cursor.sort([('rich_list.total', -1), ('_id', 1)])
+    if offset is not None and offset > 0:
+        cursor = cursor.skip(offset)
+    if limit is not None and limit > 0:
+        cursor = cursor.limit(limit)
+
+    for address in cursor:
+        yield {
+            'address': address['_id'],
+            'smart_contract': address['rich_list']['smart_contract'],
+            'on_chain': address['rich_list']['on_chain'],
+            'total': address['rich_list']['total']
+        }
+
+
+def richlist_rank(mongo_db, address):
+    """ rank and percentile of one address from two indexed counts, or None if it is not on the richlist """
+    row = mongo_db['addresses'].find_one({'_id': address, 'rich_list': {'$exists': True}},
+                                         projection=richlist_projection, max_time_ms=max_time_ms())
+    if row is None:
+        return None
+
+    total = row['rich_list']['total']
+    ahead = mongo_db['addresses'].count_documents({'rich_list.total': {'$gt': total}}, **mongo_options())
+    holders = mongo_db['addresses'].count_documents(richlist_filter, **mongo_options())
+    return {
+        'address': address,
+        'smart_contract': row['rich_list']['smart_contract'],
+        'on_chain': row['rich_list']['on_chain'],
+        'total': total,
+        'rank': ahead + 1,
+        'holders': holders,
+        'percentile': 100.0 * (holders - ahead) / holders
+    }
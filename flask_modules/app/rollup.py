@@ -0,0 +1,437 @@
+""" incrementally maintained per-day fee rollup over the fees collection
+
+Each rollup row holds the fee_amount and taker_fee_burn_amount sums and counts
+for one (block_date, asset_name, contract_hash_version) in fees_daily, or one
+(block_hour, asset_name, contract_hash_version) in fees_hourly.  A rollup is
+brought up to date from a stored high-water mark by recomputing the buckets from
+that mark onward, by one process at a time under a lease in rollup_state, in
+the snapshot builder's leader or from `update`.  Requests only read: until
+`rebuild` has set the first mark, fee endpoints roll fees up on the fly in a
+single aggregation instead.
+
+    python -m app.rollup rebuild   # drop and backfill both rollups from raw fees
+    python -m app.rollup update    # roll up fees past the high-water marks
+    python -m app.rollup check     # compare the rollups against raw aggregations
+"""
+import sys
+import time
+import json
+import argparse
+import datetime
+from datetime import timezone
+from pymongo import ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+from app.deadlines import max_time_ms, mongo_options
+from app.fees import aggregate_fee_windows, get_time_dict
+from app.metrics import metrics
+from logger.logger import get_root_logger
+
+logger = get_root_logger('rollup')
+
+rollup_collection = 'fees_daily'
+hourly_collection = 'fees_hourly'
+state_collection = 'rollup_state'
+rollup_sums = [
+    ('fee_amount', 'fee_count'),
+    ('taker_fee_burn_amount', 'taker_fee_burn_count'),
+]
+rollup_fields = [field for pair in rollup_sums for field in pair]
+day_seconds = 86400
+hour_seconds = 3600
+lease_seconds = 600
+# bucket name: (collection, bucket field, bucket seconds)
+rollup_buckets = {
+    'day': (rollup_collection, 'block_date', day_seconds),
+    'hour': (hourly_collection, 'block_hour', hour_seconds),
+}
+
+
+def day_start(epoch):
+    return epoch - epoch % day_seconds
+
+
+def epoch_date(epoch):
+    return datetime.datetime.fromtimestamp(epoch, tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+def fee_entry_stages():
+    """ split every fill into a fee entry and a taker burn entry so both roll up per asset in one pass """
+    return [
+        {
+            '$project': {
+                'block_date': 1,
+                'block_time': 1,
+                'contract_hash_version': 1,
+                'entries': [
+                    {
+                        'asset_name': '$fee_asset_name',
+                        'fee_amount': '$fee_amount'
+                    }, {
+                        'asset_name': '$taker_fee_asset_name',
+                        'taker_fee_burn_amount': {
+                            '$cond': [{'$eq': ['$taker_fee_burn', True]}, '$taker_fee_burn_amount', None]
+                        }
+                    }
+                ]
+            }
+        }, {
+            '$unwind': '$entries'
+        }
+    ]
+
+
+def sum_entries(amount_field, condition=None):
+    value = '$entries.' + amount_field
+    present = {'$ne': [{'$ifNull': [value, None]}, None]}
+    if condition is not None:
+        present = {'$and': [condition, present]}
+    return {'$sum': {'$cond': [present, value, 0]}}, {'$sum': {'$cond': [present, 1, 0]}}
+
+
+def rollup_pipeline(from_epoch=None, bucket='day'):
+    _, bucket_field, bucket_seconds = rollup_buckets[bucket]
+    if from_epoch is None:
+        match = {'block_time': {'$ne': None}}
+    else:
+        match = {'block_time': {'$gte': from_epoch}}
+
+    group = {
+        '_id': {
+            bucket_field: '$block_date' if bucket == 'day' else {
+                '$subtract': ['$block_time', {'$mod': ['$block_time', bucket_seconds]}]
+            },
+            'asset_name': '$entries.asset_name',
+            'contract_hash_version': '$contract_hash_version'
+        }
+    }
+    for amount_field, count_field in rollup_sums:
+        group[amount_field], group[count_field] = sum_entries(amount_field)
+
+    return [{'$match': match}] + fee_entry_stages() + [
+        {
+            '$group': group
+        }, {
+            '$match': {
+                '$or': [
+                    {'fee_count': {'$gt': 0}},
+                    {'taker_fee_burn_count': {'$gt': 0}}
+                ]
+            }
+        }
+    ]
+
+
+def rollup_document(row, bucket='day'):
+    bucket_field = rollup_buckets[bucket][1]
+    key = row['_id']
+    rollup_doc = {
+        '_id': '|'.join(str(key.get(field)) for field in [bucket_field, 'asset_name', 'contract_hash_version']),
+        bucket_field: key.get(bucket_field),
+        'asset_name': key.get('asset_name'),
+        'contract_hash_version': key.get('contract_hash_version')
+    }
+    for field in rollup_fields:
+        rollup_doc[field] = row[field]
+    return rollup_doc
+
+
+def write_rollup_rows(mongo_db, rows, bucket='day', batch_size=1000):
+    collection = rollup_buckets[bucket][0]
+    written = 0
+    batch = []
+    for row in rows:
+        rollup_doc = rollup_document(row, bucket)
+        batch.append(ReplaceOne({'_id': rollup_doc['_id']}, rollup_doc, upsert=True))
+        if len(batch) >= batch_size:
+            mongo_db[collection].bulk_write(batch, ordered=False)
+            written += len(batch)
+            batch = []
+    if batch:
+        mongo_db[collection].bulk_write(batch, ordered=False)
+        written += len(batch)
+    return written
+
+
+def acquire_lease(mongo_db, name, seconds=lease_seconds):
+    """ True if this process now holds name's update lease in rollup_state """
+    now = time.time()
+    try:
+        # matches only an expired or missing lease; upserting over a held one hits the _id
+        mongo_db[state_collection].find_one_and_update(
+            {'_id': name, '$or': [{'lease_until': {'$lt': now}}, {'lease_until': {'$exists': False}}]},
+            {'$set': {'lease_until': now + seconds}}, upsert=True)
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+def release_lease(mongo_db, name, updates=None, maximums=None):
+    """ give up name's lease, setting updates and raising fields to maximums in the same write """
+    update = {'$set': dict(updates or {}, lease_until=0)}
+    if maximums:
+        update['$max'] = maximums
+    mongo_db[state_collection].update_one({'_id': name}, update, upsert=True)
+
+
+def update_fee_rollup(mongo_db, bucket='day', backfill=False):
+    """ recompute every rollup bucket from the high-water mark onward; returns the number of rows written
+
+    Returns None while the rollup has no high-water mark, unless backfill is set,
+    and 0 while another process holds the update lease, which is logged and counted
+    in switcheolytics_rollup_update_skipped_total so a stuck lease does not go unnoticed.
+    """
+    collection, _, bucket_seconds = rollup_buckets[bucket]
+    state = mongo_db[state_collection].find_one({'_id': collection}) or {}
+    high_water = state.get('block_time')
+    if high_water is None and not backfill:
+        return None
+    latest = mongo_db['fees'].find_one({'block_time': {'$ne': None}},
+                                       projection={'block_time': True},
+                                       sort=[('block_time', -1)])
+    if latest is None or latest['block_time'] == high_water:
+        return 0
+    if not acquire_lease(mongo_db, collection):
+        logger.warning(collection + ' update skipped, the lease is held elsewhere; behind by ' +
+                       str(latest['block_time'] - (high_water or 0)) + 's')
+        metrics.inc('switcheolytics_rollup_update_skipped_total', bucket=bucket, reason='lease')
+        return 0
+
+    from_epoch = None if high_water is None else high_water - high_water % bucket_seconds
+    try:
+        rows = mongo_db['fees'].aggregate(rollup_pipeline(from_epoch, bucket), allowDiskUse=True)
+        written = write_rollup_rows(mongo_db, rows, bucket)
+    except BaseException:
+        release_lease(mongo_db, collection)
+        raise
+    release_lease(mongo_db, collection, updates={'updated': int(time.time())},
+                  maximums={'block_time': latest['block_time']})
+    return written
+
+
+def update_fee_rollups(mongo_db):
+    """ bring both rollups up to date; the catch-up the builder runs in the background """
+    for bucket in sorted(rollup_buckets):
+        update_fee_rollup(mongo_db, bucket)
+
+
+def rollup_built(mongo_db, bucket='day'):
+    """ whether the rollup has a high-water mark, so requests can read it instead of rolling up raw fees """
+    state = mongo_db[state_collection].find_one({'_id': rollup_buckets[bucket][0]}, projection=['block_time'],
+                                                max_time_ms=max_time_ms())
+    return state is not None and state.get('block_time') is not None
+
+
+def rebuild_fee_rollup(mongo_db, bucket='day'):
+    collection, bucket_field, _ = rollup_buckets[bucket]
+    # forget the mark first, so requests roll up raw fees instead of reading the emptied collection
+    mongo_db[state_collection].delete_one({'_id': collection})
+    mongo_db[collection].drop()
+    mongo_db[collection].create_index(bucket_field)
+    return update_fee_rollup(mongo_db, bucket, backfill=True)
+
+
+def raw_rollup_stages(from_epoch=None, bucket='day'):
+    """ rollup_pipeline over fees with its rows shaped like stored rollup rows, for use before the rollup is built """
+    bucket_field = rollup_buckets[bucket][1]
+    shape = {'_id': 0, bucket_field: '$_id.' + bucket_field, 'asset_name': '$_id.asset_name',
+             'contract_hash_version': '$_id.contract_hash_version'}
+    shape.update((field, 1) for field in rollup_fields)
+    return rollup_pipeline(from_epoch, bucket) + [{'$project': shape}]
+
+
+def rollup_rows(mongo_db, query, projection, bucket='day', from_epoch=None):
+    """ stored rollup rows matching query, or the same rows rolled up from fees while the rollup is not built """
+    if rollup_built(mongo_db, bucket):
+        return mongo_db[rollup_buckets[bucket][0]].find(query, projection=projection, max_time_ms=max_time_ms())
+    return mongo_db['fees'].aggregate(raw_rollup_stages(from_epoch, bucket) + [{'$match': query}],
+                                      allowDiskUse=True, **mongo_options())
+
+
+def window_edges(time_dict):
+    """ split each window into a partial first day read from fees and whole days read from the rollup """
+    edges = {}
+    for key in time_dict:
+        start = time_dict[key]
+        first_full_day = start if start % day_seconds == 0 else day_start(start) + day_seconds
+        edges[key] = (start, first_full_day)
+    return edges
+
+
+def add_window_rows(windows, rows, keys):
+    for row in rows:
+        asset_version = (row['_id'].get('asset_name'), row['_id'].get('contract_hash_version'))
+        for key in keys:
+            sums = windows[key].setdefault(asset_version, dict.fromkeys(rollup_fields, 0))
+            for field in rollup_fields:
+                sums[field] += row[key + '_' + field]
+
+
+def add_raw_windows(mongo_db, windows, bounds):
+    """ add the sums over fees in each key's [start, end) bounds, end None for open-ended, in one aggregation """
+    def in_bounds(start, end):
+        if end is None:
+            return {'block_time': {'$gte': start}}, {'$gte': ['$block_time', start]}
+        return {'block_time': {'$gte': start, '$lt': end}}, \
+            {'$and': [{'$gte': ['$block_time', start]}, {'$lt': ['$block_time', end]}]}
+
+    group = {'_id': {'asset_name': '$entries.asset_name', 'contract_hash_version': '$contract_hash_version'}}
+    for key, (start, end) in bounds.items():
+        in_window = in_bounds(start, end)[1]
+        for amount_field, count_field in rollup_sums:
+            group[key + '_' + amount_field], group[key + '_' + count_field] = sum_entries(amount_field, in_window)
+    match = {'$or': [in_bounds(start, end)[0] for start, end in bounds.values()]}
+    add_window_rows(windows, mongo_db['fees'].aggregate(
+        [{'$match': match}] + fee_entry_stages() + [{'$group': group}], **mongo_options()
+    ), list(bounds))
+
+
+def fee_rollup_windows(mongo_db, time_dict):
+    """ per-window sums keyed by (asset_name, contract_hash_version), read from the rollup plus each window's partial first day """
+    windows = {key: {} for key in time_dict}
+    if not rollup_built(mongo_db):
+        add_raw_windows(mongo_db, windows, dict((key, (time_dict[key], None)) for key in time_dict))
+        return windows
+    edges = window_edges(time_dict)
+
+    group = {'_id': {'asset_name': '$asset_name', 'contract_hash_version': '$contract_hash_version'}}
+    for key in time_dict:
+        in_window = {'$gte': ['$block_date', epoch_date(edges[key][1])]}
+        for field in rollup_fields:
+            group[key + '_' + field] = {'$sum': {'$cond': [in_window, '$' + field, 0]}}
+    first_date = epoch_date(min(edge[1] for edge in edges.values()))
+    add_window_rows(windows, mongo_db[rollup_collection].aggregate([
+        {'$match': {'block_date': {'$gte': first_date}}},
+        {'$group': group}
+    ], **mongo_options()), time_dict)
+
+    partial_keys = [key for key in time_dict if edges[key][0] < edges[key][1]]
+    if partial_keys:
+        add_raw_windows(mongo_db, windows, dict((key, edges[key]) for key in partial_keys))
+
+    return windows
+
+
+def fee_amount_windows(mongo_db, time_dict):
+    """ per-window, per-asset fee amounts and counts across contract versions """
+    windows_dict = {
+        'amount': {key: {} for key in time_dict},
+        'count': {key: {} for key in time_dict},
+    }
+    windows = fee_rollup_windows(mongo_db, time_dict)
+    for key in time_dict:
+        for (asset_name, _), sums in windows[key].items():
+            if sums['fee_count'] > 0:
+                windows_dict['amount'][key][asset_name] = windows_dict['amount'][key].get(asset_name, 0) + sums['fee_amount']
+                windows_dict['count'][key][asset_name] = windows_dict['count'][key].get(asset_name, 0) + sums['fee_count']
+    return windows_dict
+
+
+def fee_graph_pipeline(date_from=None, date_to=None, asset_name=None):
+    """ one row per (asset_name, block_date) combining V2 fee amounts with V3 taker burn amounts """
+    match = {'contract_hash_version': {'$in': ['V2', 'V3']}}
+    if date_from is not None or date_to is not None:
+        match['block_date'] = {}
+        if date_from is not None:
+            match['block_date']['$gte'] = date_from
+        if date_to is not None:
+            match['block_date']['$lte'] = date_to
+    if asset_name is not None:
+        match['asset_name'] = asset_name
+
+    is_v2 = {'$eq': ['$contract_hash_version', 'V2']}
+    return [
+        {
+            '$match': match
+        }, {
+            '$group': {
+                '_id': {
+                    'asset_name': '$asset_name',
+                    'block_date': '$block_date'
+                },
+                'fee_amount': {
+                    '$sum': {'$cond': [is_v2, '$fee_amount', '$taker_fee_burn_amount']}
+                },
+                'entries': {
+                    '$sum': {'$cond': [is_v2, '$fee_count', '$taker_fee_burn_count']}
+                }
+            }
+        }, {
+            '$match': {'entries': {'$gt': 0}}
+        }
+    ]
+
+
+def fee_graph_rows(mongo_db, date_from=None, date_to=None, asset_name=None):
+    """ (every asset name in the rollup when asset_name is None, fee_graph_pipeline rows)
+
+    Read from the rollup, or from fees rolled up on the fly, in one pass, while the rollup is not built.
+    """
+    pipeline = fee_graph_pipeline(date_from=date_from, date_to=date_to, asset_name=asset_name)
+    if rollup_built(mongo_db):
+        collection = mongo_db[rollup_collection]
+        asset_names = collection.distinct('asset_name', **mongo_options()) if asset_name is None else []
+        return asset_names, list(collection.aggregate(pipeline, **mongo_options()))
+
+    facets = {'rows': pipeline}
+    if asset_name is None:
+        facets['assets'] = [{'$group': {'_id': '$asset_name'}}]
+    result = next(mongo_db['fees'].aggregate(raw_rollup_stages() + [{'$facet': facets}], allowDiskUse=True,
+                                             **mongo_options()))
+    return [row['_id'] for row in result.get('assets', [])], result['rows']
+
+
+def check_fee_rollup(mongo_db):
+    """ compare every rollup row and the fee windows against raw aggregations over fees; returns the mismatches """
+    mismatches = []
+    for bucket, (collection, _, _) in sorted(rollup_buckets.items()):
+        update_fee_rollup(mongo_db, bucket)
+        expected = {}
+        for row in mongo_db['fees'].aggregate(rollup_pipeline(bucket=bucket), allowDiskUse=True):
+            rollup_doc = rollup_document(row, bucket)
+            expected[rollup_doc['_id']] = rollup_doc
+        for rollup_doc in mongo_db[collection].find():
+            raw_doc = expected.pop(rollup_doc['_id'], None)
+            if raw_doc is None or any(raw_doc[field] != rollup_doc[field] for field in rollup_fields):
+                mismatches.append({'_id': collection + '.' + rollup_doc['_id'], 'rollup': rollup_doc, 'raw': raw_doc})
+        for raw_doc in expected.values():
+            mismatches.append({'_id': collection + '.' + raw_doc['_id'], 'rollup': None, 'raw': raw_doc})
+
+    time_dict = get_time_dict()
+    raw_windows = aggregate_fee_windows(mongo_db, time_dict)
+    rollup_windows = fee_amount_windows(mongo_db, time_dict)
+    for metric in raw_windows:
+        if raw_windows[metric] != rollup_windows[metric]:
+            mismatches.append({'_id': 'windows.' + metric, 'rollup': rollup_windows[metric], 'raw': raw_windows[metric]})
+
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain the daily and hourly fee rollup collections.')
+    parser.add_argument('command', choices=['rebuild', 'update', 'check'])
+    args = parser.parse_args(argv)
+
+    from app.wsgi import connections
+    mongo_db = connections.mongo_db()
+    if args.command == 'rebuild':
+        for bucket, (collection, _, _) in sorted(rollup_buckets.items()):
+            print('rebuilt ' + str(rebuild_fee_rollup(mongo_db, bucket)) + ' ' + collection + ' rows')
+    elif args.command == 'update':
+        for bucket, (collection, _, _) in sorted(rollup_buckets.items()):
+            written = update_fee_rollup(mongo_db, bucket)
+            if written is None:
+                print(collection + ' has not been built; run rebuild')
+            else:
+                print('updated ' + str(written) + ' ' + collection + ' rows')
+    else:
+        mismatches = check_fee_rollup(mongo_db)
+        for mismatch in mismatches:
+            print(json.dumps(mismatch, default=str))
+        print(str(len(mismatches)) + ' mismatches')
+        return 1 if mismatches else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
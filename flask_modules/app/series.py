@@ -0,0 +1,119 @@
+""" fee and burn time series over any UTC range, summed from the hourly and daily rollups """
+import os
+import datetime
+from datetime import timezone
+
+from app.rollup import day_seconds, epoch_date, hour_seconds, rollup_fields, rollup_rows
+
+granularities = ['hour', 'day', 'week', 'month']
+max_series_buckets = int(os.environ.get('FEE_SERIES_MAX_BUCKETS', 1000))
+time_formats = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H', '%Y-%m-%d', '%Y-%m']
+
+
+def parse_time(value):
+    """ UTC epoch from an epoch number or an ISO date or datetime (YYYY-MM, YYYY-MM-DD, YYYY-MM-DDTHH[:MM[:SS]]) """
+    if value.isdigit():
+        return int(value)
+    value = value.rstrip('Z')
+    for time_format in time_formats:
+        try:
+            return int(datetime.datetime.strptime(value, time_format).replace(tzinfo=timezone.utc).timestamp())
+        except ValueError:
+            continue
+    raise ValueError('unrecognised time ' + repr(value))
+
+
+def bucket_start(epoch, granularity):
+    """ the UTC start of the hour, day, ISO week (Monday) or month containing epoch """
+    if granularity == 'hour':
+        return epoch - epoch % hour_seconds
+    moment = datetime.datetime.fromtimestamp(epoch - epoch % day_seconds, tz=timezone.utc)
+    if granularity == 'week':
+        moment -= datetime.timedelta(days=moment.weekday())
+    elif granularity == 'month':
+        moment = moment.replace(day=1)
+    return int(moment.timestamp())
+
+
+def next_bucket(epoch, granularity):
+    if granularity == 'hour':
+        return epoch + hour_seconds
+    if granularity == 'day':
+        return epoch + day_seconds
+    if granularity == 'week':
+        return epoch + 7 * day_seconds
+    moment = datetime.datetime.fromtimestamp(epoch, tz=timezone.utc)
+    return int(moment.replace(year=moment.year + moment.month // 12, month=moment.month % 12 + 1).timestamp())
+
+
+def bucket_label(epoch, granularity):
+    moment = datetime.datetime.fromtimestamp(epoch, tz=timezone.utc)
+    if granularity == 'hour':
+        return moment.strftime('%Y-%m-%dT%H:00:00Z')
+    if granularity == 'month':
+        return moment.strftime('%Y-%m')
+    return moment.strftime('%Y-%m-%d')
+
+
+def series_range(start, end, granularity):
+    """ [first bucket start, end bucket start) covering start..end inclusive, and its bucket count """
+    first = bucket_start(start, granularity)
+    last = next_bucket(bucket_start(end, granularity), granularity)
+    if granularity == 'month':
+        first_moment = datetime.datetime.fromtimestamp(first, tz=timezone.utc)
+        last_moment = datetime.datetime.fromtimestamp(last, tz=timezone.utc)
+        buckets = (last_moment.year - first_moment.year) * 12 + last_moment.month - first_moment.month
+    else:
+        buckets = (last - first) // {'hour': hour_seconds, 'day': day_seconds, 'week': 7 * day_seconds}[granularity]
+    return first, last, buckets
+
+
+def fee_series(mongo_db, start, end, granularity='day', asset_name=None, contract_hash_version=None):
+    """ {asset: {version: [bucket sums]}} for every bucket in start..end with fees or burns, oldest first
+
+    Hourly buckets read fees_hourly; daily, weekly and monthly buckets sum fees_daily rows.
+    Raises ValueError for an unknown granularity, an empty range or more than FEE_SERIES_MAX_BUCKETS buckets.
+    """
+    if granularity not in granularities:
+        raise ValueError('granularity must be one of ' + ', '.join(granularities))
+    if end < start:
+        raise ValueError('to is before from')
+    first, last, buckets = series_range(start, end, granularity)
+    if buckets > max_series_buckets:
+        raise ValueError('range spans ' + str(buckets) + ' ' + granularity + ' buckets, at most ' +
+                         str(max_series_buckets) + ' are allowed')
+
+    if granularity == 'hour':
+        bucket = 'hour'
+        query = {'block_hour': {'$gte': first, '$lt': last}}
+    else:
+        bucket = 'day'
+        query = {'block_date': {'$gte': epoch_date(first), '$lt': epoch_date(last)}}
+    if asset_name is not None:
+        query['asset_name'] = asset_name
+    if contract_hash_version is not None:
+        query['contract_hash_version'] = contract_hash_version
+
+    sums = {}
+    projection = ['block_hour' if granularity == 'hour' else 'block_date', 'asset_name', 'contract_hash_version']
+    for row in rollup_rows(mongo_db, query, projection + rollup_fields, bucket=bucket, from_epoch=first):
+        if granularity == 'hour':
+            row_epoch = row['block_hour']
+        else:
+            row_epoch = parse_time(row['block_date'])
+        key = (row['asset_name'], row['contract_hash_version'], bucket_start(row_epoch, granularity))
+        bucket_sums = sums.setdefault(key, dict.fromkeys(rollup_fields, 0))
+        for field in rollup_fields:
+            bucket_sums[field] += row[field]
+
+    series = {}
+    for asset, version, epoch in sorted(sums, key=lambda key: (str(key[0]), str(key[1]), key[2])):
+        point = {'bucket': bucket_label(epoch, granularity), 'epoch': epoch}
+        point.update(sums[(asset, version, epoch)])
+        series.setdefault(asset, {}).setdefault(version, []).append(point)
+    return {
+        'granularity': granularity,
+        'from': bucket_label(first, granularity),
+        'to': bucket_label(bucket_start(end, granularity), granularity),
+        'series': series
+    }
@@ -0,0 +1,190 @@
+""" single-flight coalescing of identical computations, within a worker and across gunicorn workers
+
+Meant for small, expensive results: they are materialized so waiting callers
+can share them.  The first caller of a key computes it; concurrent callers in
+the same worker wait on its result.  Across workers the computing one holds an
+flock lease on one of a fixed set of lock files.  Workers blocked on the lease
+record themselves in a sqlite table, and only then is the result published
+there for a few seconds, for them to pick up instead of computing again.  Keys
+include the ingested block count, so a new block always starts a new
+computation.  Waiting is bounded by SINGLEFLIGHT_TIMEOUT, after which the
+caller computes on its own.
+"""
+import os
+import json
+import time
+import fcntl
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from functools import wraps
+
+from app.deadlines import check, current
+from app.metrics import metrics
+from app.responses import dumps, materialize
+from logger.logger import get_root_logger
+
+logger = get_root_logger('singleflight')
+
+lock_stripes = 256
+poll_interval = 0.05
+
+
+class Call(object):
+    """ one in-process computation that other threads can wait on """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """ coalesces concurrent calls of the same function and arguments at the same version """
+
+    def __init__(self, version, directory=None, timeout=None, result_ttl=None):
+        self.version = version
+        self.directory = directory or os.environ.get('SINGLEFLIGHT_DIR',
+                                                     os.path.join(tempfile.gettempdir(), 'switcheolytics_singleflight'))
+        self.timeout = timeout or float(os.environ.get('SINGLEFLIGHT_TIMEOUT', 30))
+        # how long a finished result stays visible to workers that were waiting on the lease
+        self.result_ttl = result_ttl or float(os.environ.get('SINGLEFLIGHT_RESULT_TTL', 5))
+        self.enabled = os.environ.get('SINGLEFLIGHT_ENABLED', 'true').lower() != 'false'
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def connection(self):
+        # sqlite connections must not cross threads or forked workers
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(os.path.join(self.directory, 'results.sqlite'), timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, body BLOB, created REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS waiting (key TEXT PRIMARY KEY, until REAL)')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def shared_result(self, key):
+        try:
+            row = self.connection().execute('SELECT body FROM results WHERE key = ? AND created >= ?',
+                                            (key, time.time() - self.result_ttl)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('single-flight results unavailable: ' + str(e))
+            return None
+        return None if row is None else json.loads(bytes(row[0]).decode('utf-8'))
+
+    def wait_for(self, key, deadline):
+        """ note that this worker is blocked on key's lease, so its holder publishes the result """
+        try:
+            self.connection().execute('INSERT OR REPLACE INTO waiting (key, until) VALUES (?, ?)',
+                                      (key, min(deadline, time.time() + self.timeout)))
+        except sqlite3.Error as e:
+            logger.warning('single-flight results unavailable: ' + str(e))
+
+    def awaited(self, key):
+        row = self.connection().execute('SELECT 1 FROM waiting WHERE key = ? AND until >= ?',
+                                        (key, time.time())).fetchone()
+        return row is not None
+
+    def share_result(self, key, result):
+        conn = self.connection()
+        now = time.time()
+        conn.execute('INSERT OR REPLACE INTO results (key, body, created) VALUES (?, ?, ?)',
+                     (key, dumps(result), now))
+        conn.execute('DELETE FROM results WHERE created < ?', (now - self.result_ttl,))
+        conn.execute('DELETE FROM waiting WHERE key = ? OR until < ?', (key, now))
+
+    def lease(self, key, deadline):
+        """ the open lock file once this worker holds key's lease, or None if the deadline passed first """
+        stripe = int(key[:8], 16) % lock_stripes
+        lock_file = open(os.path.join(self.directory, 'lock-' + str(stripe)), 'w')
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    lock_file.close()
+                    return None
+                if not waiting:
+                    self.wait_for(key, deadline)
+                    waiting = True
+                time.sleep(poll_interval)
+
+    def compute_shared(self, name, key, compute, deadline):
+        """ compute under the cross-worker lease, or reuse what the lease holder published """
+        shared = self.shared_result(key)
+        if shared is not None:
+            return shared, 'shared'
+
+        lock_file = self.lease(key, deadline)
+        if lock_file is None:
+            check()
+        try:
+            if lock_file is not None:
+                shared = self.shared_result(key)
+                if shared is not None:
+                    return shared, 'shared'
+            result = materialize(compute())
+            try:
+                # nothing is written unless another worker is blocked on the lease
+                if self.awaited(key):
+                    self.share_result(key, result)
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                logger.warning('could not share ' + name + ' result: ' + str(e))
+            return result, 'computed' if lock_file is not None else 'timeout'
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+    def do(self, name, args, compute):
+        """ compute() once for concurrent callers with the same name and args; the result is materialized """
+        try:
+            version = self.version()
+        except Exception:
+            # let the computation surface whatever is wrong
+            return compute()
+        key = hashlib.sha1(json.dumps([name, args, version], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        # nobody waits past their own request's deadline
+        deadline = min(time.time() + self.timeout, current() or float('inf'))
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            if call.done.wait(max(deadline - time.time(), 0)):
+                metrics.inc('switcheolytics_singleflight_total', function=name, outcome='coalesced')
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            metrics.inc('switcheolytics_singleflight_total', function=name, outcome='timeout')
+            check()
+            return materialize(compute())
+
+        try:
+            call.result, outcome = self.compute_shared(name, key, compute, deadline)
+            metrics.inc('switcheolytics_singleflight_total', function=name, outcome=outcome)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def coalesced(self, function):
+        """ decorator for get_* functions called with keyword arguments that return small results """
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return function(*args, **kwargs)
+            return self.do(function.__name__, [args, kwargs], lambda: function(*args, **kwargs))
+        return wrapper
@@ -0,0 +1,458 @@
+""" versioned analytics snapshot files, memory-mapped by every worker and served in slices
+
+A snapshot holds the pre-serialized JSON of one group of heavy endpoints (a job)
+for one ingested block count.  Row lists (leaderboards, richlist) are stored as
+comma separated rows with a table of row offsets, so any offset/limit page is a
+single slice of the mapped file, shared by every worker through the page cache.
+Layout:
+
+    magic (8 bytes) | index offset (8) | index length (8) | sections ... | index (JSON)
+
+Each job has its own schedule: one worker at a time (the holder of an flock)
+rebuilds a job once the block count has moved and the job's interval has
+passed, or once its snapshot is older than the job's max_age, on a bounded pool
+of build threads.  A new version is written to a temporary file, renamed into
+place, and published by atomically replacing the job's CURRENT pointer; readers
+pick it up on their next check and keep serving the mapping they have until
+then, so requests always get the latest completed build straight away.
+
+    python -m app.snapshot build   # build every job for the current block count
+    python -m app.snapshot info    # describe the current snapshots
+"""
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import fcntl
+import array
+import struct
+import argparse
+import tempfile
+import threading
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, g
+from pymongo.errors import PyMongoError
+
+from app.metrics import metrics
+from app.responses import StreamedObject, dumps, iter_json, json_key
+from logger.logger import get_root_logger
+
+logger = get_root_logger('snapshot')
+
+magic = b'SWSNAP1\n'
+header = struct.Struct('<8sQQ')
+pointer_prefix = 'CURRENT-'
+# <job>-<block count>-<build time in ms>.bin
+file_name = re.compile(r'^(.+)-(\d+)-(\d+)\.bin$')
+
+
+class Snapshot(object):
+    """ one memory-mapped snapshot file """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        file_magic, index_offset, index_length = header.unpack_from(self.mm, 0)
+        if file_magic != magic:
+            raise ValueError('not a snapshot file: ' + path)
+        index = json.loads(bytes(self.view[index_offset:index_offset + index_length]).decode('utf-8'))
+        self.version = index['version']
+        self.created = index['created']
+        self.sections = index['sections']
+        self.meta = index['meta']
+
+    def body(self, key):
+        section = self.sections.get(key)
+        if section is None:
+            return None
+        return self.view[section['offset']:section['offset'] + section['length']]
+
+    def row_count(self, key):
+        section = self.sections.get(key)
+        return None if section is None else section['rows']
+
+    def rows(self, key, offset=0, limit=None):
+        """ rows offset..offset+limit as a slice of the file, without brackets; None if key is not in the snapshot """
+        section = self.sections.get(key)
+        if section is None:
+            return None
+        count = section['rows']
+        start = min(offset, count)
+        end = count if limit is None else min(start + limit, count)
+        if start >= end:
+            return self.view[0:0]
+        row_offsets = self.view[section['row_offsets']:section['row_offsets'] + 8 * (count + 1)].cast('Q')
+        # each row is followed by a comma except the last, whose end offset includes a virtual one
+        return self.view[section['offset'] + row_offsets[start]:section['offset'] + row_offsets[end] - 1]
+
+
+class SnapshotWriter(object):
+    """ streams sections into a temporary file; commit() publishes it as the job's current snapshot """
+
+    def __init__(self, store, job, version):
+        self.store = store
+        self.job = job
+        self.version = version
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.snapshot-', dir=store.directory)
+        self.f = os.fdopen(fd, 'wb')
+        self.f.write(header.pack(magic, 0, 0))
+        self.sections = {}
+        self.meta = {}
+
+    def add_body(self, key, obj):
+        offset = self.f.tell()
+        for chunk in iter_json(obj):
+            self.f.write(chunk)
+        self.sections[key] = {'offset': offset, 'length': self.f.tell() - offset}
+
+    def add_rows(self, key, rows):
+        offset = self.f.tell()
+        row_offsets = array.array('Q')
+        position = 0
+        for row in rows:
+            encoded = dumps(row)
+            if row_offsets:
+                self.f.write(b',')
+                position += 1
+            row_offsets.append(position)
+            self.f.write(encoded)
+            position += len(encoded)
+        length = position
+        row_offsets.append(position + 1)
+        self.f.write(b'\0' * (-self.f.tell() % 8))
+        table_offset = self.f.tell()
+        row_offsets.tofile(self.f)
+        self.sections[key] = {'offset': offset, 'length': length, 'rows': len(row_offsets) - 1,
+                              'row_offsets': table_offset}
+
+    def set_meta(self, key, value):
+        self.meta[key] = value
+
+    def commit(self):
+        created = time.time()
+        index = dumps({'job': self.job.name, 'version': self.version, 'created': created,
+                       'sections': self.sections, 'meta': self.meta})
+        index_offset = self.f.tell()
+        self.f.write(index)
+        self.f.seek(0)
+        self.f.write(header.pack(magic, index_offset, len(index)))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        # a job may be rebuilt at the same block count (max_age), so the build time keeps names unique
+        name = self.job.name + '-' + str(self.version) + '-' + str(int(created * 1000)) + '.bin'
+        path = os.path.join(self.store.directory, name)
+        os.replace(self.tmp_path, path)
+        self.store.publish(self.job, name)
+        return path
+
+    def abort(self):
+        self.f.close()
+        os.unlink(self.tmp_path)
+
+
+class SnapshotJob(object):
+    """ one group of sections, written by sections(writer), with its own schedule and mapping """
+
+    def __init__(self, name, sections, interval, max_age):
+        self.name = name
+        self.sections = sections
+        self.interval = interval
+        self.max_age = max_age
+        self.snapshot = None
+        self.checked = 0
+        self.last_build = 0
+        self.running = False
+
+    def due(self, version, now):
+        """ whether the leader should rebuild now: never within interval of the last attempt, failed ones included """
+        if self.running or now - self.last_build < self.interval:
+            return False
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.version < version:
+            return True
+        return self.max_age is not None and now - snapshot.created >= self.max_age
+
+    def run(self, store, version):
+        store.build(self.name, version)
+
+
+class BuilderTask(object):
+    """ a maintenance step the builder's leader runs on the same pool, every interval seconds """
+
+    def __init__(self, name, target, interval):
+        self.name = name
+        self.target = target
+        self.interval = interval
+        self.last_build = 0
+        self.running = False
+
+    def due(self, version, now):
+        return not self.running and now - self.last_build >= self.interval
+
+    def run(self, store, version):
+        self.target()
+
+
+class SnapshotStore(object):
+    """ the snapshot directory: builds new versions of each job and maps the current ones in each worker """
+
+    def __init__(self, directory=None, keep=None, max_stale=None, workers=None, check_interval=1.0):
+        self.directory = directory or os.environ.get('SNAPSHOT_DIR',
+                                                     os.path.join(tempfile.gettempdir(), 'switcheolytics_snapshots'))
+        self.keep = keep or int(os.environ.get('SNAPSHOT_KEEP', 2))
+        # snapshots older than this are not served while Mongo is up, in case the builder has stopped
+        self.max_stale = max_stale or float(os.environ.get('SNAPSHOT_MAX_STALE', 3600))
+        self.workers = workers or int(os.environ.get('SNAPSHOT_WORKERS', 2))
+        self.check_interval = check_interval
+        self.jobs = {}
+        self.tasks = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def register(self, name, sections, interval=None, max_age=None):
+        """ keep sections(writer) built as job name
+
+        SNAPSHOT_INTERVAL_<NAME> and SNAPSHOT_MAX_AGE_<NAME> override interval and max_age; interval
+        defaults to SNAPSHOT_INTERVAL (60 seconds), and without a max_age a job is only rebuilt when the
+        block count moves.
+        """
+        suffix = '_' + name.upper()
+        interval = float(os.environ.get('SNAPSHOT_INTERVAL' + suffix,
+                                        interval or os.environ.get('SNAPSHOT_INTERVAL', 60)))
+        max_age = float(os.environ.get('SNAPSHOT_MAX_AGE' + suffix, max_age or 0)) or None
+        self.jobs[name] = SnapshotJob(name, sections, interval, max_age)
+
+    def add_task(self, name, target, interval=None):
+        """ have the leader call target() every interval seconds (SNAPSHOT_INTERVAL_<NAME> overrides it) """
+        interval = float(os.environ.get('SNAPSHOT_INTERVAL_' + name.upper(),
+                                        interval or os.environ.get('SNAPSHOT_INTERVAL', 60)))
+        self.tasks[name] = BuilderTask(name, target, interval)
+
+    def current(self, name):
+        """ job name's latest published snapshot, re-checking its pointer at most once per check_interval """
+        job = self.jobs[name]
+        now = time.time()
+        if now - job.checked < self.check_interval:
+            return job.snapshot
+        with self.lock:
+            # threads that queued here while another one checked get its result
+            if now - job.checked < self.check_interval:
+                return job.snapshot
+            try:
+                with open(os.path.join(self.directory, pointer_prefix + name)) as f:
+                    file = f.read().strip()
+            except OSError:
+                job.checked = now
+                return job.snapshot
+            if job.snapshot is None or os.path.basename(job.snapshot.path) != file:
+                try:
+                    job.snapshot = Snapshot(os.path.join(self.directory, file))
+                except (OSError, ValueError) as e:
+                    logger.warning('could not map snapshot ' + file + ': ' + str(e))
+            job.checked = now
+        return job.snapshot
+
+    def latest(self):
+        """ the most recent snapshot of any job, or None """
+        snapshots = [snapshot for snapshot in (self.current(name) for name in self.jobs) if snapshot is not None]
+        return max(snapshots, key=lambda snapshot: snapshot.version) if snapshots else None
+
+    def publish(self, job, name):
+        pointer = os.path.join(self.directory, pointer_prefix + job.name)
+        with open(pointer + '.' + str(os.getpid()), 'w') as f:
+            f.write(name)
+        os.replace(pointer + '.' + str(os.getpid()), pointer)
+        builds = []
+        for filename in os.listdir(self.directory):
+            match = file_name.match(filename)
+            if match is not None and match.group(1) == job.name:
+                builds.append((int(match.group(2)), int(match.group(3)), filename))
+        # unlinking a mapped file is safe, workers keep their mapping until they swap
+        for _, _, filename in sorted(builds)[:-self.keep]:
+            if filename != name:
+                os.unlink(os.path.join(self.directory, filename))
+
+    def build(self, name, version):
+        """ write job name's sections into a new snapshot for version and publish it """
+        job = self.jobs[name]
+        started = time.time()
+        writer = SnapshotWriter(self, job, version)
+        try:
+            job.sections(writer)
+            path = writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        logger.info('built snapshot ' + name + ' ' + str(version) + ' (' + str(os.path.getsize(path)) + ' bytes) in ' +
+                    str(round(time.time() - started, 1)) + 's')
+        return path
+
+    def run_job(self, job, version):
+        started = time.time()
+        status = 'error'
+        try:
+            job.run(self, version)
+            status = 'ok'
+        except Exception as e:
+            logger.warning('snapshot ' + job.name + ' failed: ' + str(e))
+        finally:
+            metrics.observe('switcheolytics_snapshot_build_seconds', time.time() - started, job=job.name,
+                            status=status)
+            job.running = False
+
+    def schedule(self, executor, version):
+        """ submit every due job and task; each runs once at a time, and the pool bounds how many run together """
+        now = time.time()
+        for job in list(self.jobs.values()) + list(self.tasks.values()):
+            if job.name in self.jobs:
+                self.current(job.name)
+            if job.due(version, now):
+                job.running = True
+                job.last_build = now
+                executor.submit(self.run_job, job, version)
+
+    def start_builder(self, block_count, poll_interval=None):
+        """ poll block_count() and rebuild due jobs and run due tasks, from one worker at a time
+
+        Every worker runs the loop, but only the one holding the directory's flock builds; when it
+        exits the lock is released and another worker takes over.
+        """
+        poll_interval = poll_interval or float(os.environ.get('SNAPSHOT_POLL_INTERVAL', 1))
+
+        def run():
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+            lock_file = open(os.path.join(self.directory, 'build.lock'), 'w')
+            leader = False
+            while True:
+                try:
+                    if not leader:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        leader = True
+                    self.schedule(executor, block_count())
+                except BlockingIOError:
+                    pass
+                except Exception as e:
+                    logger.warning('snapshot scheduling failed: ' + str(e))
+                time.sleep(poll_interval)
+
+        thread = threading.Thread(target=run, name='snapshot-builder', daemon=True)
+        thread.start()
+        return thread
+
+    def served(self, name, render):
+        """ serve render(snapshot) from job name's latest build, however far it trails, up to max_stale seconds old
+
+        render returns the body chunks, or None when the request is not covered by the snapshot.
+        While the view cannot reach Mongo the snapshot is served at any age.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                snapshot = self.current(name)
+                if snapshot is not None and time.time() - snapshot.created < self.max_stale:
+                    chunks = render(snapshot)
+                    if chunks is not None:
+                        return snapshot_response(snapshot, chunks)
+                try:
+                    return view(*args, **kwargs)
+                except PyMongoError as e:
+                    chunks = render(snapshot) if snapshot is not None else None
+                    if chunks is None:
+                        raise
+                    logger.warning('serving snapshot ' + name + ' ' + str(snapshot.version) +
+                                   ' while Mongo fails: ' + str(e))
+                    g.snapshot_fallback = True
+                    return snapshot_response(snapshot, chunks)
+            return wrapper
+        return decorator
+
+
+def snapshot_response(snapshot, chunks):
+    # slices stay views of the mapping up to here; WSGI servers only accept bytes, so each is copied once on the way out
+    response = Response((bytes(chunk) for chunk in chunks), mimetype='application/json')
+    response.headers['Content-Length'] = str(sum(len(chunk) for chunk in chunks))
+    response.headers['X-Snapshot'] = str(snapshot.version) + ('; fallback' if g.get('snapshot_fallback') else '')
+    response.headers['Age'] = str(int(max(time.time() - snapshot.created, 0)))
+    # the body is as of the snapshot's block count, which validators must reflect
+    g.served_version = snapshot.version
+    return response
+
+
+def leaderboard_chunks(snapshot, name, asset=None, limit=None, offset=0):
+    """ the same body iter_leaderboard produces, as slices of the snapshot """
+    assets = snapshot.meta.get(name)
+    if assets is None:
+        return None
+    if limit is not None and limit <= 0:
+        limit = None
+    offset = max(offset or 0, 0)
+
+    if asset is not None:
+        page = snapshot.rows(name + '|' + asset, offset, limit) if asset in assets else None
+        if not page:
+            return [b'{}']
+        return [b'{' + dumps(asset) + b':[', page, b']}']
+
+    chunks = [b'{']
+    for i, row_asset in enumerate(assets):
+        chunks.append((b',' if i else b'') + dumps(row_asset) + b':[')
+        chunks.append(snapshot.rows(name + '|' + row_asset, offset, limit))
+        chunks.append(b']')
+    chunks.append(b'}')
+    return chunks
+
+
+def richlist_chunks(snapshot, limit=None, offset=0):
+    """ the same body get_switcheo_richlist produces, as a slice of the snapshot """
+    page = snapshot.rows('richlist', max(offset or 0, 0), limit if limit is not None and limit > 0 else None)
+    if page is None:
+        return None
+    if not page:
+        return [b'{}']
+    return [b'{"SWTH":[', page, b']}']
+
+
+def add_leaderboard(writer, name, leaderboard):
+    """ write a leaderboard, streamed or materialized, as one row section per asset, remembering the asset order """
+    assets = []
+    items = leaderboard.items if isinstance(leaderboard, StreamedObject) else leaderboard.items()
+    for asset, rows in items:
+        assets.append(json_key(asset))
+        writer.add_rows(name + '|' + json_key(asset), rows)
+    writer.set_meta(name, assets)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build or describe the analytics snapshots.')
+    parser.add_argument('command', choices=['build', 'info'])
+    args = parser.parse_args(argv)
+
+    from app.wsgi import current_block_count, snapshots
+    if args.command == 'build':
+        version = current_block_count()
+        for name in sorted(snapshots.jobs):
+            print(snapshots.build(name, version))
+        return 0
+    described = {}
+    for name in sorted(snapshots.jobs):
+        snapshot = snapshots.current(name)
+        if snapshot is not None:
+            described[name] = {'path': snapshot.path, 'version': snapshot.version, 'created': snapshot.created,
+                               'bytes': len(snapshot.mm),
+                               'sections': dict((key, section.get('rows', section['length']))
+                                                for key, section in snapshot.sections.items())}
+    if not described:
+        print('no snapshot in ' + snapshots.directory)
+        return 1
+    print(json.dumps(described, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
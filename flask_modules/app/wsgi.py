@@ -1,66 +1,171 @@
 """ index file for REST APIs using Flask """
+import os
 import json
 import time
-import datetime
-import os
-import requests
-from datetime import timezone
-from flask import Flask, jsonify, make_response, send_from_directory, request
+import threading
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, g, jsonify, make_response, send_from_directory, request
 from flask_cors import CORS, cross_origin
-from switcheo.switcheo_client import SwitcheoClient
-from blockchain.neo.switcheo import SwitcheoSmartContract
+from pymongo.errors import PyMongoError
+from app.balances import BalanceLookup, SwitcheoClientPool
+from app.batch import BatchRunner
+from app.cache import ResponseCache
+from app.conditional import conditional
+from app.connections import ConnectionProvider, ContractProxy
+from app.deadlines import bounded_call, current
+from app.fees import get_time_dict
+from app.indexes import query_profiler, startup_indexes
+from app.ingestion import IngestionCounters
+from app.leaderboard import iter_leaderboard
+from app.limits import RouteLimits
+from app.live import LiveState
+from app.metrics import metrics
+from app.neoscan import NeoscanClient
+from app.offers import iter_open_offers, trade_pair_lookup
+from app.ranks import address_profile, update_address_ranks
+from app.responses import StreamedObject, compress_response, json_response
+from app.richlist import iter_richlist, richlist_rank
+from app.series import fee_series, parse_time
+from app.singleflight import SingleFlight
+from app.snapshot import SnapshotStore, add_leaderboard, leaderboard_chunks, richlist_chunks
+from app.rollup import day_seconds, epoch_date, fee_amount_windows, fee_graph_rows, fee_rollup_windows, update_fee_rollups
 
 app = Flask(__name__)
 app.config.from_object(__name__)
 cors = CORS(app, resources={r'/*': {"origins": '*'}})
 CORS(app)
+metrics.init_app(app)
+app.after_request(compress_response)
+# every request gets a deadline; analytics also share a few slots across workers, so cheap routes keep a worker
+limits = RouteLimits()
+limits.init_app(app)
+limits.add_class('analytics', slots=2, queue=1, queue_timeout=1.0, deadline=25)
+# each open stream holds a thread for up to LIVE_MAX_SECONDS, so streams beyond the cap are shed rather than queued
+limits.add_class('live', slots=16, queue=0, deadline=float(os.environ.get('LIVE_MAX_SECONDS', 300)) + 60)
 
 url_dict = {
     'main': 'https://api.switcheo.network',
     'test': 'https://test-api.switcheo.network',
 }
 
-rpc_hostname = os.environ['NEO_RPC_HOSTNAME']
-rpc_port = os.environ['NEO_RPC_PORT']
+rpc_hostname = os.environ.get('NEO_RPC_HOSTNAME', 'localhost')
+rpc_port = os.environ.get('NEO_RPC_PORT', '10332')
 rpc_tls = False
 mongodb_protocol = 'mongodb'
-mongodb_user = os.environ['MONGODB_USER']
-mongodb_password = os.environ['MONGODB_PASSWORD']
-mongodb_hostname = os.environ['MONGODB_HOSTNAME']
-mongodb_port = os.environ['MONGODB_PORT']
-mongodb_db = os.environ['MONGODB_DB']
-
-ssc = SwitcheoSmartContract(rpc_hostname=rpc_hostname,
-                            rpc_port=rpc_port,
-                            rpc_tls=rpc_tls,
-                            mongodb_protocol=mongodb_protocol,
-                            mongodb_user=mongodb_user,
-                            mongodb_password=mongodb_password,
-                            mongodb_hostname=mongodb_hostname,
-                            mongodb_port=mongodb_port,
-                            mongodb_db=mongodb_db)
-
-
-def sort_dicts(collection, key_name, sort_key, exclude_keys=[]):
-    collection_dict = {}
-    collection_rows = ssc.ni.mongo_db[collection].find({key_name: {'$ne': None}})
-
-    for row in collection_rows:
-        for asset in row[key_name].keys():
-            if asset in exclude_keys:
-                continue
-            asset_dict = {
-                'address': row['_id'],
-                sort_key: row[key_name][asset]
-            }
-            if asset not in collection_dict:
-                collection_dict[asset] = []
-            collection_dict[asset].append(asset_dict)
+mongodb_user = os.environ.get('MONGODB_USER', '')
+mongodb_password = os.environ.get('MONGODB_PASSWORD', '')
+mongodb_hostname = os.environ.get('MONGODB_HOSTNAME', 'localhost')
+mongodb_port = os.environ.get('MONGODB_PORT', '27017')
+mongodb_db = os.environ.get('MONGODB_DB', 'neo')
+
+# nothing connects until the first request that needs Mongo or the contract
+connections = ConnectionProvider(rpc_hostname=rpc_hostname,
+                                 rpc_port=rpc_port,
+                                 rpc_tls=rpc_tls,
+                                 mongodb_protocol=mongodb_protocol,
+                                 mongodb_user=mongodb_user,
+                                 mongodb_password=mongodb_password,
+                                 mongodb_hostname=mongodb_hostname,
+                                 mongodb_port=mongodb_port,
+                                 mongodb_db=mongodb_db)
+ssc = ContractProxy(connections)
+
+
+def on_mongo_connect(mongo_db):
+    query_profiler.mongo_db = mongo_db
+    # off the request path, so the first request in a worker does not wait on listIndexes
+    threading.Thread(target=startup_indexes, args=(mongo_db,), daemon=True).start()
+
+
+connections.on_connect(on_mongo_connect)
+ingestion_counters = IngestionCounters()
+
+
+def current_block_count():
+    return ingestion_counters.count(connections.mongo_db(), 'blocks')
+
+
+def ingested_block_count():
+    # memoized per request so the validator and the response cache share one count
+    if 'ingested_block_count' not in g:
+        try:
+            g.ingested_block_count = current_block_count()
+        except PyMongoError:
+            # while Mongo is unreachable, routes with a snapshot keep answering from it
+            snapshot = snapshots.latest()
+            if snapshot is None:
+                raise
+            g.snapshot_fallback = True
+            g.ingested_block_count = snapshot.version
+    return g.ingested_block_count
+
+
+# rolling fee windows move with the clock and burnt includes the Neoscan balance, so they expire sooner
+cache_ttl_short = int(os.environ.get('RESPONSE_CACHE_TTL_SHORT', 60))
+cache_ttl_long = int(os.environ.get('RESPONSE_CACHE_TTL_LONG', 900))
+cache_max_age_short = int(os.environ.get('CACHE_CONTROL_MAX_AGE_SHORT', 15))
+cache_max_age_long = int(os.environ.get('CACHE_CONTROL_MAX_AGE_LONG', 60))
+response_cache = ResponseCache(version=ingested_block_count)
+snapshots = SnapshotStore()
+# identical computations running at once in any worker share one result
+single_flight = SingleFlight(version=current_block_count)
+neoscan_client = NeoscanClient()
+balance_lookup = BalanceLookup(SwitcheoClientPool())
+trade_pair_lookups = {}
+
+
+# SWTH burns made outside the contracts, in whole SWTH by block_date
+manual_swth_burns = {
+    '2018-07-24': 646747,
+    '2019-01-01': 161052,
+    '2019-04-01': 293815,
+    '2019-07-01': 2184273,
+}
+
+
+# the RPC client takes no timeout (and retries a failed block count forever), so calls are waited on from a pool
+neo_rpc_timeout = float(os.environ.get('NEO_RPC_TIMEOUT', 5))
+neo_rpc_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('NEO_RPC_WORKERS', 4)))
+
+
+def neo_rpc_call(method):
+    with metrics.timed('neo_rpc', method):
+        return bounded_call(neo_rpc_executor, lambda: getattr(ssc, method)(), neo_rpc_timeout)
+
+
+def leaderboard_args():
+    return {
+        'asset': request.args.get('asset', default=None, type=str),
+        'limit': request.args.get('limit', default=None, type=int),
+        'offset': request.args.get('offset', default=0, type=int)
+    }
 
-    for asset in collection_dict.keys():
-        collection_dict[asset] = sorted(collection_dict[asset], key=lambda coin: coin[sort_key], reverse=True)
 
-    return collection_dict
+def snapshot_body(key, **args):
+    """ render a stored body, only for requests with exactly these query arguments """
+    def render(snapshot):
+        if request.args.to_dict() != args:
+            return None
+        body = snapshot.body(key)
+        return None if body is None else [body]
+    return render
+
+
+def snapshot_leaderboard(name):
+    return lambda snapshot: leaderboard_chunks(snapshot, name, **leaderboard_args())
+
+
+def snapshot_richlist(snapshot):
+    return richlist_chunks(snapshot,
+                           limit=request.args.get('limit', default=None, type=int),
+                           offset=request.args.get('offset', default=0, type=int))
+
+
+@app.before_first_request
+def start_snapshot_builder():
+    if os.environ.get('SNAPSHOT_BUILD', 'true').lower() == 'true':
+        snapshots.start_builder(current_block_count)
 
 
 @app.errorhandler(404)
@@ -77,152 +182,190 @@ def index():
     return send_from_directory('dist', 'index.html')
 
 
+@app.route('/cache/stats')
+@cross_origin()
+def cache_stats():
+    return json_response(response_cache.stats())
+
+
+@app.route('/ready')
+def ready():
+    status = connections.ready()
+    return json_response(status, status=200 if status['ready'] else 503)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/batch', methods=['GET', 'POST'])
+@cross_origin()
+def batch():
+    # no slot for the batch itself: each heavy item takes one through its route, like a direct request
+    if request.method == 'POST':
+        body = request.get_json(force=True, silent=True) or {}
+        items = body.get('metrics', [])
+    else:
+        items = request.args.get('metrics', default='', type=str).split(',')
+    if not isinstance(items, list):
+        return make_response(jsonify({'error': 'metrics must be a list'}), 400)
+    return json_response(get_batch(items=[item for item in items if item]))
+
+
+def get_batch(items):
+    return batch_runner.run(items)
+
+
+@app.route('/live')
+@cross_origin()
+@limits.limited('live')
+def live():
+    """ block heights and trading status as Server-Sent Events """
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    response = Response(live_state.stream(last_event_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @app.route('/switcheo/balance')
 @cross_origin()
 def switcheo_balance():
     address = request.args.get('address', default=None, type=str)
     network = request.args.get('network', default='main', type=str)
-    return get_switcheo_balance(network=network, address=address)
+    if address is None:
+        return send_from_directory('dist', 'index.html')
+    return json_response(get_switcheo_balance(network=network, address=address))
 
 
 def get_switcheo_balance(network, address):
-    sc = SwitcheoClient(switcheo_network=network)
-    if address is None:
-        return send_from_directory('dist', 'index.html')
+    return balance_lookup.get_balance(network, address)
+
+
+@app.route('/switcheo/balances', methods=['GET', 'POST'])
+@cross_origin()
+def switcheo_balances():
+    if request.method == 'POST':
+        body = request.get_json(force=True, silent=True) or {}
+        addresses = body.get('addresses', [])
+        network = body.get('network', 'main')
     else:
-        return str(json.dumps(sc.balance_by_contract(address)))
+        addresses = request.args.get('addresses', default='', type=str).split(',')
+        network = request.args.get('network', default='main', type=str)
+    return json_response(get_switcheo_balances(network=network, addresses=[address for address in addresses if address]))
+
+
+def get_switcheo_balances(network, addresses):
+    return balance_lookup.get_balances(network, addresses)
 
 
 def get_neoscan_balance(address):
-    url = 'https://api.neoscan.io/api/main_net/v1/get_balance/' + address
-    params = None
-    r = requests.get(url=url, params=params, timeout=30)
-    r.raise_for_status()
-    return r.json()
+    return neoscan_client.get_balance(address)
 
 
 @app.route('/switcheo/status')
 @cross_origin()
 def switcheo_status():
-    return get_switcheo_status()
+    return json_response(get_switcheo_status())
 
 
 def get_switcheo_status():
     status_dict = {
-        'switcheo_status': ssc.is_trading_active()
+        'switcheo_status': neo_rpc_call('is_trading_active')
     }
-    return str(json.dumps(status_dict))
+    return status_dict
 
 
 @app.route('/neo/blockheight')
 @cross_origin()
 def neo_block_height():
-    return get_neo_height()
+    return json_response(get_neo_height())
 
 
 def get_neo_height():
     height_dict = {
-        'neo_blockheight': ssc.get_neo_block_height()
+        'neo_blockheight': neo_rpc_call('get_neo_block_height')
     }
-    return str(json.dumps(height_dict))
+    return height_dict
+
+
+@app.route('/switcheo/ingested')
+@cross_origin()
+def switcheo_ingested():
+    return json_response(get_switcheo_ingested())
+
+
+def get_switcheo_ingested():
+    return ingestion_counters.summary(connections.mongo_db(), neo_block_height=neo_rpc_call('get_neo_block_height'))
 
 
 @app.route('/switcheo/ingested/blockheight')
 @cross_origin()
 def switcheo_block_height():
-    return get_switcheo_height()
+    return json_response(get_switcheo_height())
 
 
 def get_switcheo_height():
     height_dict = {
-        'switcheo_blockheight': ssc.ni.get_collection_count(collection='blocks') + 2000000
+        'switcheo_blockheight': ingestion_counters.block_height(connections.mongo_db())
     }
-    return str(json.dumps(height_dict))
+    return height_dict
 
 
 @app.route('/switcheo/ingested/transactions')
 @cross_origin()
 def switcheo_transaction_height():
-    return get_switcheo_transaction_height()
+    return json_response(get_switcheo_transaction_height())
 
 
 def get_switcheo_transaction_height():
     height_dict = {
-        'switcheo_txn_height': ssc.ni.get_collection_count(collection='transactions')
+        'switcheo_txn_height': ingestion_counters.count(connections.mongo_db(), 'transactions')
     }
-    return str(json.dumps(height_dict))
+    return height_dict
 
 
 @app.route('/switcheo/ingested/fills')
 @cross_origin()
 def switcheo_fills_height():
-    return get_switcheo_fills_height()
+    return json_response(get_switcheo_fills_height())
 
 
 def get_switcheo_fills_height():
     height_dict = {
-        'switcheo_fee_height': ssc.ni.get_collection_count(collection='fees')
+        'switcheo_fee_height': ingestion_counters.count(connections.mongo_db(), 'fees')
     }
-    return str(json.dumps(height_dict))
+    return height_dict
 
 
 @app.route('/switcheo/fee/amount')
 @cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_short)
+@snapshots.served('fee_windows', snapshot_body('fee_amount'))
+@response_cache.cached(ttl=cache_ttl_short)
+@limits.limited('analytics')
 def switcheo_fee_amount():
-    return get_switcheo_fee_amount()
+    return json_response(get_switcheo_fee_amount())
 
 
+@single_flight.coalesced
 def get_switcheo_fee_amount():
-    fees_dict = {}
-    time_dict = {}
-    now_epoch = int(time.time())
-    day_epoch = int((datetime.datetime.now() + datetime.timedelta(-1)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['day_epoch'] = day_epoch
-    week_epoch = int((datetime.datetime.now() + datetime.timedelta(-7)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['week_epoch'] = week_epoch
-    thirty_epoch = int((datetime.datetime.now() + datetime.timedelta(-30)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['thirty_epoch'] = thirty_epoch
-    sixty_epoch = int((datetime.datetime.now() + datetime.timedelta(-60)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['sixty_epoch'] = sixty_epoch
-    ninety_epoch = int((datetime.datetime.now() + datetime.timedelta(-90)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['ninety_epoch'] = ninety_epoch
-    august_epoch = int(datetime.datetime(2018, 8, 1).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['august_epoch'] = august_epoch
-    january_epoch = int(datetime.datetime(2018, 1, 1).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['january_epoch'] = january_epoch
-
-    for key in time_dict:
-        fee_asset_dict = {}
-        for fee_asset in ssc.ni.mongo_db['fees'].aggregate([
-            {
-                '$match': {
-                    '$and': [
-                        {'fee_amount': {'$ne': None}},
-                        {'block_time': {'$gte': time_dict[key], '$lte': now_epoch}}
-                    ]
-                }
-            }, {
-                '$group': {
-                    '_id': {'fee_asset_name': '$fee_asset_name'},
-                    'total_fees': {
-                        '$sum': '$fee_amount'
-                    }
-                }
-            }
-        ]):
-            fee_asset_dict[fee_asset['_id']['fee_asset_name']] = fee_asset['total_fees']
-
-        fees_dict[key] = fee_asset_dict
-
-    return str(json.dumps(fees_dict))
+    fees_dict = fee_amount_windows(connections.mongo_db(), get_time_dict())['amount']
+    return fees_dict
 
 
 @app.route('/switcheo/burnt')
 @cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_short)
+@snapshots.served('burnt', snapshot_body('burnt'))
+@response_cache.cached(ttl=cache_ttl_short)
+@limits.limited('analytics')
 def switcheo_burnt():
-    return get_switcheo_burnt()
+    return json_response(get_switcheo_burnt())
 
 
+@single_flight.coalesced
 def get_switcheo_burnt():
     switcheo_burned = 0
     fees_dict = {}
@@ -238,70 +381,25 @@ def get_switcheo_burnt():
     fees_dict['burn_address'] = switcheo_burn_address_amount
     switcheo_burned += fees_dict['burn_address']
 
-    time_dict = {}
-    now_epoch = int(time.time())
-    day_epoch = int((datetime.datetime.now() + datetime.timedelta(-1)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['day_epoch'] = day_epoch
-    week_epoch = int((datetime.datetime.now() + datetime.timedelta(-7)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['week_epoch'] = week_epoch
-    thirty_epoch = int((datetime.datetime.now() + datetime.timedelta(-30)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['thirty_epoch'] = thirty_epoch
-    sixty_epoch = int((datetime.datetime.now() + datetime.timedelta(-60)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['sixty_epoch'] = sixty_epoch
-    ninety_epoch = int((datetime.datetime.now() + datetime.timedelta(-90)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['ninety_epoch'] = ninety_epoch
-    all_epoch = int(datetime.datetime(2018, 1, 1).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['all_epoch'] = all_epoch
+    time_dict = get_time_dict()
+    del time_dict['august_epoch']
+    time_dict['all_epoch'] = time_dict.pop('january_epoch')
+    windows = fee_rollup_windows(connections.mongo_db(), time_dict)
 
     fees_dict['V2'] = {}
     fees_dict['V3'] = {}
     for key in time_dict:
-        for fee_aggregate in ssc.ni.mongo_db['fees'].aggregate([
-            {
-                '$match': {
-                    '$and': [
-                        {'contract_hash_version': 'V2'},
-                        {'fee_asset_name': 'SWTH'},
-                        {'fee_amount': {'$ne': None}},
-                        {'block_time': {'$gte': time_dict[key], '$lte': now_epoch}}
-                    ]
-                }
-            }, {
-                '$group': {
-                    '_id': {'fee_asset_name': '$fee_asset_name'},
-                    'total_fees': {
-                        '$sum': '$fee_amount'
-                    }
-                }
-            }
-        ]):
-            fees_dict['V2'][key] = fee_aggregate['total_fees']
+        v2_sums = windows[key].get(('SWTH', 'V2'))
+        if v2_sums is not None and v2_sums['fee_count'] > 0:
+            fees_dict['V2'][key] = v2_sums['fee_amount']
             if key == 'all_epoch':
-                switcheo_burned += fee_aggregate['total_fees']
-
-        for fee_aggregate in ssc.ni.mongo_db['fees'].aggregate([
-            {
-                '$match': {
-                    '$and': [
-                        {'contract_hash_version': 'V3'},
-                        {'taker_fee_burn': True},
-                        {'taker_fee_asset_name': 'SWTH'},
-                        {'taker_fee_burn_amount': {'$ne': None}},
-                        {'block_time': {'$gte': time_dict[key], '$lte': now_epoch}}
-                    ]
-                }
-            }, {
-                '$group': {
-                    '_id': {'taker_fee_asset_name': '$taker_fee_asset_name'},
-                    'total_fees': {
-                        '$sum': '$taker_fee_burn_amount'
-                    }
-                }
-            }
-        ]):
-            fees_dict['V3'][key] = fee_aggregate['total_fees']
+                switcheo_burned += v2_sums['fee_amount']
+
+        v3_sums = windows[key].get(('SWTH', 'V3'))
+        if v3_sums is not None and v3_sums['taker_fee_burn_count'] > 0:
+            fees_dict['V3'][key] = v3_sums['taker_fee_burn_amount']
             if key == 'all_epoch':
-                switcheo_burned += fee_aggregate['total_fees']
+                switcheo_burned += v3_sums['taker_fee_burn_amount']
 
     day_amount = 0
     week_amount = 0
@@ -330,298 +428,397 @@ def get_switcheo_burnt():
     fees_dict['all_burnt']['ninety_epoch'] = ninety_amount
     fees_dict['all_burnt']['all_epoch'] = switcheo_burned
 
-    return str(json.dumps(fees_dict))
+    return fees_dict
 
 
 @app.route('/switcheo/fee/count')
 @cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_short)
+@snapshots.served('fee_windows', snapshot_body('fee_count'))
+@response_cache.cached(ttl=cache_ttl_short)
+@limits.limited('analytics')
 def switcheo_fee_count():
-    return get_switcheo_fee_count()
+    return json_response(get_switcheo_fee_count())
 
 
+@single_flight.coalesced
 def get_switcheo_fee_count():
-    fees_dict = {}
-    time_dict = {}
-    now_epoch = int(time.time())
-    day_epoch = int((datetime.datetime.now() + datetime.timedelta(-1)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['day_epoch'] = day_epoch
-    week_epoch = int((datetime.datetime.now() + datetime.timedelta(-7)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['week_epoch'] = week_epoch
-    thirty_epoch = int((datetime.datetime.now() + datetime.timedelta(-30)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['thirty_epoch'] = thirty_epoch
-    sixty_epoch = int((datetime.datetime.now() + datetime.timedelta(-60)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['sixty_epoch'] = sixty_epoch
-    ninety_epoch = int((datetime.datetime.now() + datetime.timedelta(-90)).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['ninety_epoch'] = ninety_epoch
-    august_epoch = int(datetime.datetime(2018, 8, 1).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['august_epoch'] = august_epoch
-    january_epoch = int(datetime.datetime(2018, 1, 1).replace(tzinfo=timezone.utc).timestamp())
-    time_dict['january_epoch'] = january_epoch
-
-    for key in time_dict:
-        fee_asset_dict = {}
-        for fee_asset in ssc.ni.mongo_db['fees'].aggregate([
-            {
-                '$match': {
-                    '$and': [
-                        {'fee_amount': {'$ne': None}},
-                        {'block_time': {'$gte': time_dict[key], '$lte': now_epoch}}
-                    ]
-                }
-            }, {
-                '$group': {
-                    '_id': {'fee_asset_name': '$fee_asset_name'},
-                    'total_fee_count': {
-                        '$sum': 1
-                    }
-                }
-            }
-        ]):
-            fee_asset_dict[fee_asset['_id']['fee_asset_name']] = fee_asset['total_fee_count']
-
-        fees_dict[key] = fee_asset_dict
-
-    return str(json.dumps(fees_dict))
+    fees_dict = fee_amount_windows(connections.mongo_db(), get_time_dict())['count']
+    return fees_dict
 
 
 @app.route('/switcheo/fee/amount/graph')
 @cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_long)
+@snapshots.served('fee_graph', snapshot_body('fee_graph'))
+@snapshots.served('fee_graph', snapshot_body('fee_graph_columnar', format='columnar'))
+@response_cache.cached(ttl=cache_ttl_long)
+@limits.limited('analytics')
 def switcheo_fee_amount_graph():
-    return get_switcheo_fee_amount_graph()
-
+    date_from = request.args.get('from', default=None, type=str)
+    date_to = request.args.get('to', default=None, type=str)
+    asset = request.args.get('asset', default=None, type=str)
+    columnar = request.args.get('format', default=None, type=str) == 'columnar'
+    try:
+        graph_dict = get_switcheo_fee_amount_graph(date_from=date_from, date_to=date_to, asset=asset, columnar=columnar)
+    except ValueError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+    return json_response(graph_dict)
+
+
+@single_flight.coalesced
+def get_switcheo_fee_amount_graph(date_from=None, date_to=None, asset=None, columnar=False):
+    graph_dict = {}
+    # block dates compare as YYYY-MM-DD strings, so any time parse_time accepts is reduced to its date
+    date_from = epoch_date(parse_time(date_from)) if date_from is not None else None
+    date_to = epoch_date(parse_time(date_to)) if date_to is not None else None
+
+    asset_names, graph_rows = fee_graph_rows(connections.mongo_db(), date_from=date_from, date_to=date_to,
+                                             asset_name=asset)
+    for fee_asset_name in asset_names:
+        graph_dict[fee_asset_name] = {}
+
+    for fee_asset in graph_rows:
+        asset_dates = graph_dict.setdefault(fee_asset['_id']['asset_name'], {})
+        asset_dates[fee_asset['_id']['block_date']] = fee_asset['fee_amount'] / 100000000
+
+    if asset in [None, 'SWTH']:
+        swth_dates = graph_dict.setdefault('SWTH', {})
+        for block_date, fee_amount in manual_swth_burns.items():
+            if (date_from is None or block_date >= date_from) and (date_to is None or block_date <= date_to):
+                swth_dates[block_date] = swth_dates.get(block_date, 0) + fee_amount
 
-def get_switcheo_fee_amount_graph():
     fees_dict = {}
-    fees_v3_dict = {}
-
-    for fee_asset_name in ssc.ni.mongo_db['fees'].distinct("fee_asset_name"):
-        fees_dict[fee_asset_name] = []
-
-    for fee_asset_name in ssc.ni.mongo_db['fees'].distinct("taker_fee_asset_name"):
-        fees_dict[fee_asset_name] = []
-        fees_v3_dict[fee_asset_name] = []
-
-    for fee_asset in ssc.ni.mongo_db['fees'].aggregate([
-        {
-            '$match': {
-                '$and': [
-                    {'contract_hash_version': 'V2'},
-                    {'fee_amount': {'$ne': None}},
-                ]
-            }
-        }, {
-            '$group': {
-                '_id': {
-                    'fee_asset_name': '$fee_asset_name',
-                    'block_date': '$block_date'
-                },
-                'total_fee_amount': {
-                    '$sum': '$fee_amount'
-                }
-            }
-        }
-    ]):
-        fee_asset_dict = {
-            'block_date': fee_asset['_id']['block_date'],
-            'fee_amount': fee_asset['total_fee_amount'] / 100000000
-        }
-        fees_dict[fee_asset['_id']['fee_asset_name']].append(fee_asset_dict)
-
-    for fee_asset in ssc.ni.mongo_db['fees'].aggregate([
-        {
-            '$match': {
-                '$and': [
-                    {'contract_hash_version': 'V3'},
-                    {'taker_fee_burn_amount': {'$ne': None}},
-                ]
-            }
-        }, {
-            '$group': {
-                '_id': {
-                    'taker_fee_asset_name': '$taker_fee_asset_name',
-                    'block_date': '$block_date'
-                },
-                'total_fee_amount': {
-                    '$sum': '$taker_fee_burn_amount'
-                }
+    for fee_asset_name, asset_dates in graph_dict.items():
+        block_dates = sorted(asset_dates)
+        if columnar:
+            fees_dict[fee_asset_name] = {
+                'block_date': block_dates,
+                'fee_amount': [asset_dates[block_date] for block_date in block_dates]
             }
-        }
-    ]):
-        fee_asset_dict = {
-            'block_date': fee_asset['_id']['block_date'],
-            'fee_amount': fee_asset['total_fee_amount'] / 100000000
-        }
-        fees_v3_dict[fee_asset['_id']['taker_fee_asset_name']].append(fee_asset_dict)
-
-    for asset in fees_v3_dict:
-        for block_date in fees_v3_dict[asset]:
-            date_check = block_date['block_date']
-            fee_for_date = block_date['fee_amount']
-            i = 0
-            date_match = False
-            date_match_location = 0
-            for fees_date in fees_dict[asset]:
-                check_date = fees_date['block_date']
-                if date_check == check_date:
-                    date_match = True
-                    date_match_location = i
-                i += 1
-            if date_match:
-                fees_dict[asset][date_match_location]['fee_amount'] = fees_dict[asset][date_match_location]['fee_amount'] + fee_for_date
-            else:
-                fee_asset_dict = {
-                    'block_date': date_check,
-                    'fee_amount': fee_for_date
-                }
-                fees_dict[asset].append(fee_asset_dict)
-
-    fee_asset_dict = {
-        'block_date': '2018-07-24',
-        'fee_amount': 646747
-    }
-    fees_dict['SWTH'].append(fee_asset_dict)
-
-    fee_asset_dict = {
-        'block_date': '2019-01-01',
-        'fee_amount': 161052
-    }
-    fees_dict['SWTH'].append(fee_asset_dict)
+        else:
+            fees_dict[fee_asset_name] = [
+                {'block_date': block_date, 'fee_amount': asset_dates[block_date]} for block_date in block_dates
+            ]
 
-    fee_asset_dict = {
-        'block_date': '2019-04-01',
-        'fee_amount': 293815
-    }
-    fees_dict['SWTH'].append(fee_asset_dict)
-
-    fee_asset_dict = {
-        'block_date': '2019-07-01',
-        'fee_amount': 2184273
-    }
-    fees_dict['SWTH'].append(fee_asset_dict)
+    return fees_dict
 
-    for key in fees_dict.keys():
-        fees_dict[key] = sorted(fees_dict[key], key=lambda coin: coin['block_date'])
-        # if key is not None:
-        #     fees_dict[key].sort(key=lambda coin: coin['block_date'])
 
-    return str(json.dumps(fees_dict))
+@app.route('/switcheo/fee/series')
+@cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_long)
+@response_cache.cached(ttl=cache_ttl_long)
+@limits.limited('analytics')
+def switcheo_fee_series():
+    try:
+        series_dict = get_switcheo_fee_series(date_from=request.args.get('from', default=None, type=str),
+                                              date_to=request.args.get('to', default=None, type=str),
+                                              granularity=request.args.get('granularity', default='day', type=str),
+                                              asset=request.args.get('asset', default=None, type=str),
+                                              version=request.args.get('version', default=None, type=str))
+    except ValueError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+    return json_response(series_dict)
+
+
+@single_flight.coalesced
+def get_switcheo_fee_series(date_from=None, date_to=None, granularity='day', asset=None, version=None):
+    end = parse_time(date_to) if date_to is not None else int(time.time())
+    start = parse_time(date_from) if date_from is not None else end - 30 * day_seconds
+    return fee_series(connections.mongo_db(), start, end, granularity=granularity, asset_name=asset,
+                      contract_hash_version=version)
 
 
 @app.route('/switcheo/addresses/fees')
 @cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_long)
+@snapshots.served('addresses_fees', snapshot_leaderboard('addresses_fees'))
+@response_cache.cached(ttl=cache_ttl_long)
+@limits.limited('analytics')
 def switcheo_addresses_fees():
-    return get_switcheo_addresses_fees()
+    return json_response(get_switcheo_addresses_fees(**leaderboard_args()))
 
 
-def get_switcheo_addresses_fees():
-    return str(json.dumps(sort_dicts(collection='addresses',
-                                     key_name='fees_paid',
-                                     sort_key='fee_amount')))
+def get_switcheo_addresses_fees(asset=None, limit=None, offset=0):
+    return StreamedObject(iter_leaderboard(connections.mongo_db(),
+                                           collection='addresses',
+                                           key_name='fees_paid',
+                                           sort_key='fee_amount',
+                                           asset=asset,
+                                           limit=limit,
+                                           offset=offset))
 
 
 @app.route('/switcheo/addresses/takes')
 @cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_long)
+@snapshots.served('addresses_takes', snapshot_leaderboard('addresses_takes'))
+@response_cache.cached(ttl=cache_ttl_long)
+@limits.limited('analytics')
 def switcheo_addresses_takes():
-    return get_switcheo_addresses_takes()
+    return json_response(get_switcheo_addresses_takes(**leaderboard_args()))
 
 
-def get_switcheo_addresses_takes():
-    return str(json.dumps(sort_dicts(collection='addresses',
-                                     key_name='takes',
-                                     sort_key='trades',
-                                     exclude_keys=['wants', 'offers'])))
+def get_switcheo_addresses_takes(asset=None, limit=None, offset=0):
+    return StreamedObject(iter_leaderboard(connections.mongo_db(),
+                                           collection='addresses',
+                                           key_name='takes',
+                                           sort_key='trades',
+                                           exclude_keys=['wants', 'offers'],
+                                           asset=asset,
+                                           limit=limit,
+                                           offset=offset))
 
 
 @app.route('/switcheo/addresses/makes')
 @cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_long)
+@snapshots.served('addresses_makes', snapshot_leaderboard('addresses_makes'))
+@response_cache.cached(ttl=cache_ttl_long)
+@limits.limited('analytics')
 def switcheo_addresses_makes():
-    return get_switcheo_addresses_makes()
+    return json_response(get_switcheo_addresses_makes(**leaderboard_args()))
 
 
-def get_switcheo_addresses_makes():
-    return str(json.dumps(sort_dicts(collection='addresses',
-                                     key_name='makes',
-                                     sort_key='trades',
-                                     exclude_keys=['wants', 'offers'])))
+def get_switcheo_addresses_makes(asset=None, limit=None, offset=0):
+    return StreamedObject(iter_leaderboard(connections.mongo_db(),
+                                           collection='addresses',
+                                           key_name='makes',
+                                           sort_key='trades',
+                                           exclude_keys=['wants', 'offers'],
+                                           asset=asset,
+                                           limit=limit,
+                                           offset=offset))
 
 @app.route('/switcheo/addresses/trades/count')
 @cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_long)
+@snapshots.served('addresses_trades_count', snapshot_leaderboard('addresses_trades_count'))
+@response_cache.cached(ttl=cache_ttl_long)
+@limits.limited('analytics')
 def switcheo_addresses_trades_count():
-    return get_switcheo_addresses_trades_count()
+    return json_response(get_switcheo_addresses_trades_count(**leaderboard_args()))
 
 
-def get_switcheo_addresses_trades_count():
-    return str(json.dumps(sort_dicts(collection='addresses',
-                                     key_name='trade_count',
-                                     sort_key='trades')))
+def get_switcheo_addresses_trades_count(asset=None, limit=None, offset=0):
+    return StreamedObject(iter_leaderboard(connections.mongo_db(),
+                                           collection='addresses',
+                                           key_name='trade_count',
+                                           sort_key='trades',
+                                           asset=asset,
+                                           limit=limit,
+                                           offset=offset))
 
 
 @app.route('/switcheo/addresses/trades/amount')
 @cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_long)
+@snapshots.served('addresses_trades_amount', snapshot_leaderboard('addresses_trades_amount'))
+@response_cache.cached(ttl=cache_ttl_long)
+@limits.limited('analytics')
 def switcheo_addresses_trades_amount():
-    return get_switcheo_addresses_trades_amount()
+    return json_response(get_switcheo_addresses_trades_amount(**leaderboard_args()))
 
 
-def get_switcheo_addresses_trades_amount():
-    return str(json.dumps(sort_dicts(collection='addresses',
-                                     key_name='total_amount_traded',
-                                     sort_key='trade_amount')))
+def get_switcheo_addresses_trades_amount(asset=None, limit=None, offset=0):
+    return StreamedObject(iter_leaderboard(connections.mongo_db(),
+                                           collection='addresses',
+                                           key_name='total_amount_traded',
+                                           sort_key='trade_amount',
+                                           asset=asset,
+                                           limit=limit,
+                                           offset=offset))
 
 
 @app.route('/switcheo/offers/open')
 @cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_long)
+@response_cache.cached(ttl=cache_ttl_long)
+@limits.limited('analytics')
 def switcheo_offers_open():
-    return get_switcheo_offers_open()
-
-
-def get_switcheo_offers_open():
-    offer_list = []
-    for offer in ssc.ni.mongo_db['offer_hash'].find({'status': 'open'}):
-        if offer['_id'] is not None:
-            trade_pair = offer['offer_asset_name'] + "_" + offer['want_asset_name']
-            if trade_pair not in ssc.neo_trade_pair_list:
-                trade_pair = offer['want_asset_name'] + "_" + offer['offer_asset_name']
-                if trade_pair not in ssc.neo_trade_pair_list:
-                    exit("Incorrect trade pair - " + trade_pair)
-            offer_dict = {
-                'address': offer['maker_address'],
-                'amount_filled': offer['amount_filled'],
-                'trade_pair': trade_pair,
-                'offer_amount': offer['offer_amount_fixed8'],
-                'offer_asset_name': offer['offer_asset_name'],
-                'want_amount': offer['want_amount_fixed8'],
-                'want_asset_name': offer['want_asset_name']
-            }
-            offer_list.append(offer_dict)
-    return str(json.dumps(offer_list))
+    trade_pair = request.args.get('trade_pair', default=None, type=str)
+    address = request.args.get('address', default=None, type=str)
+    return json_response(get_switcheo_offers_open(trade_pair=trade_pair, address=address))
+
+
+def get_trade_pair_lookup():
+    if trade_pair_lookups.get('pairs') != ssc.neo_trade_pair_list:
+        trade_pair_lookups['pairs'] = list(ssc.neo_trade_pair_list)
+        trade_pair_lookups['lookup'] = trade_pair_lookup(ssc.neo_trade_pair_list)
+    return trade_pair_lookups['lookup']
+
+
+def get_switcheo_offers_open(trade_pair=None, address=None):
+    return iter_open_offers(connections.mongo_db(),
+                            trade_pair_list=list(ssc.neo_trade_pair_list),
+                            pair_lookup=get_trade_pair_lookup(),
+                            trade_pair=trade_pair,
+                            address=address)
 
 
 @app.route('/switcheo/richlist')
 @cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_long)
+@snapshots.served('richlist', snapshot_richlist)
+@response_cache.cached(ttl=cache_ttl_long)
+@limits.limited('analytics')
 def switcheo_richlist():
-    return get_switcheo_richlist()
+    limit = request.args.get('limit', default=None, type=int)
+    offset = request.args.get('offset', default=0, type=int)
+    return json_response(get_switcheo_richlist(limit=limit, offset=offset))
 
 
-def get_switcheo_richlist():
-    richlist_dict = {}
-    addresses = ssc.ni.mongo_db['addresses'].find()
+def get_switcheo_richlist(limit=None, offset=0):
+    richlist_rows = iter_richlist(connections.mongo_db(), limit=limit, offset=offset)
+    first_row = next(richlist_rows, None)
+    if first_row is None:
+        return {}
+    return StreamedObject([('SWTH', chain([first_row], richlist_rows))])
 
-    for address in addresses:
-        if 'rich_list' in address:
-            asset_dict = {
-                'address': address['_id'],
-                'smart_contract': address['rich_list']['smart_contract'],
-                'on_chain': address['rich_list']['on_chain'],
-                'total': address['rich_list']['total']
-            }
-            if 'SWTH' not in richlist_dict:
-                richlist_dict['SWTH'] = []
-            richlist_dict['SWTH'].append(asset_dict)
 
-    for asset in richlist_dict.keys():
-        richlist_dict[asset] = sorted(richlist_dict[asset], key=lambda coin: coin['total'], reverse=True)
+@app.route('/switcheo/richlist/rank')
+@cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_long)
+@response_cache.cached(ttl=cache_ttl_long)
+@limits.limited('analytics')
+def switcheo_richlist_rank():
+    address = request.args.get('address', default=None, type=str)
+    rank_dict = get_switcheo_richlist_rank(address=address) if address is not None else None
+    if rank_dict is None:
+        return make_response(jsonify({'error': 'Not found'}), 404)
+    return json_response(rank_dict)
+
 
-    return str(json.dumps(richlist_dict))
+def get_switcheo_richlist_rank(address):
+    return richlist_rank(connections.mongo_db(), address)
+
+
+@app.route('/switcheo/address/profile')
+@cross_origin()
+@conditional(version=ingested_block_count, max_age=cache_max_age_long)
+@response_cache.cached(ttl=cache_ttl_long)
+@limits.limited('analytics')
+def switcheo_address_profile():
+    address = request.args.get('address', default=None, type=str)
+    profile_dict = get_switcheo_address_profile(address=address) if address is not None else None
+    if profile_dict is None:
+        return make_response(jsonify({'error': 'Not found'}), 404)
+    return json_response(profile_dict)
+
+
+def get_switcheo_address_profile(address):
+    return address_profile(connections.mongo_db(), address)
+
+
+snapshot_leaderboards = [
+    ('addresses_fees', get_switcheo_addresses_fees),
+    ('addresses_takes', get_switcheo_addresses_takes),
+    ('addresses_makes', get_switcheo_addresses_makes),
+    ('addresses_trades_count', get_switcheo_addresses_trades_count),
+    ('addresses_trades_amount', get_switcheo_addresses_trades_amount),
+]
+
+
+def add_snapshot_leaderboard(name, getter):
+    snapshots.register(name, lambda writer: add_leaderboard(writer, name, getter()))
+
+
+def add_fee_windows(writer):
+    writer.add_body('fee_amount', get_switcheo_fee_amount())
+    writer.add_body('fee_count', get_switcheo_fee_count())
+
+
+def add_fee_graph(writer):
+    writer.add_body('fee_graph', get_switcheo_fee_amount_graph())
+    writer.add_body('fee_graph_columnar', get_switcheo_fee_amount_graph(columnar=True))
+
+
+# the full, unpaginated bodies of the routes served from snapshots, each group rebuilt on its own schedule
+for snapshot_name, snapshot_getter in snapshot_leaderboards:
+    add_snapshot_leaderboard(snapshot_name, snapshot_getter)
+snapshots.register('richlist', lambda writer: writer.add_rows('richlist', iter_richlist(connections.mongo_db())))
+# the rolling fee windows move with the clock, and burnt with the Neoscan balance too, so they are
+# rebuilt once they are cache_ttl_short old even without new blocks
+snapshots.register('fee_windows', add_fee_windows, max_age=cache_ttl_short)
+snapshots.register('fee_graph', add_fee_graph, interval=cache_ttl_long)
+snapshots.register('burnt', lambda writer: writer.add_body('burnt', get_switcheo_burnt()), max_age=cache_ttl_short)
+# fee routes and profiles only read the rollups and ranks; the leader brings them up to date
+snapshots.add_task('fee_rollup', lambda: update_fee_rollups(connections.mongo_db()),
+                   interval=float(os.environ.get('FEE_ROLLUP_INTERVAL', 10)))
+snapshots.add_task('address_ranks', lambda: update_address_ranks(connections.mongo_db()),
+                   interval=float(os.environ.get('ADDRESS_RANKS_INTERVAL', 60)))
+
+
+def route_metric(path, query_args=None):
+    """ a /batch metric answered by the route at path, through its snapshot, response cache and limits
+
+    query_args maps the metric's keyword arguments to the route's query arguments; by default they are the same.
+    """
+    def get(**kwargs):
+        args = query_args(**kwargs) if query_args is not None else kwargs
+        with app.test_request_context(path, query_string=dict((name, value) for name, value in args.items()
+                                                              if value is not None)):
+            # limited routes keep the item's deadline when it is sooner than their class's
+            g.outer_deadline = current()
+            response = app.view_functions[request.url_rule.endpoint](**request.view_args)
+            if not isinstance(response, Response):
+                response = make_response(response)
+            try:
+                if response.mimetype != 'application/json':
+                    # routes answer the web app's index page when their required arguments are missing
+                    raise ValueError('missing parameters')
+                body = response.get_data()
+            finally:
+                response.close()
+        if response.status_code != 200:
+            raise ValueError(json.loads(body.decode('utf-8')).get('error', str(response.status_code)))
+        return json.loads(body.decode('utf-8'))
+    return get
+
+
+def date_range_args(date_from=None, date_to=None, **kwargs):
+    kwargs.update({'from': date_from, 'to': date_to})
+    return kwargs
+
+
+def fee_graph_args(columnar=False, **kwargs):
+    return date_range_args(format='columnar' if columnar else None, **kwargs)
+
+
+leaderboard_params = {'asset': str, 'limit': int, 'offset': int}
+batch_metrics = {
+    'status': (route_metric('/switcheo/status'), {}),
+    'blockheight': (route_metric('/neo/blockheight'), {}),
+    'ingested': (route_metric('/switcheo/ingested'), {}),
+    'ingested_blockheight': (route_metric('/switcheo/ingested/blockheight'), {}),
+    'ingested_transactions': (route_metric('/switcheo/ingested/transactions'), {}),
+    'ingested_fills': (route_metric('/switcheo/ingested/fills'), {}),
+    'balance': (route_metric('/switcheo/balance'), {'network': str, 'address': str}),
+    'fee_amount': (route_metric('/switcheo/fee/amount'), {}),
+    'fee_count': (route_metric('/switcheo/fee/count'), {}),
+    'burnt': (route_metric('/switcheo/burnt'), {}),
+    'fee_graph': (route_metric('/switcheo/fee/amount/graph', fee_graph_args),
+                  {'date_from': str, 'date_to': str, 'asset': str, 'columnar': bool}),
+    'fee_series': (route_metric('/switcheo/fee/series', date_range_args),
+                   {'date_from': str, 'date_to': str, 'granularity': str, 'asset': str, 'version': str}),
+    'addresses_fees': (route_metric('/switcheo/addresses/fees'), leaderboard_params),
+    'addresses_takes': (route_metric('/switcheo/addresses/takes'), leaderboard_params),
+    'addresses_makes': (route_metric('/switcheo/addresses/makes'), leaderboard_params),
+    'addresses_trades_count': (route_metric('/switcheo/addresses/trades/count'), leaderboard_params),
+    'addresses_trades_amount': (route_metric('/switcheo/addresses/trades/amount'), leaderboard_params),
+    'offers_open': (route_metric('/switcheo/offers/open'), {'trade_pair': str, 'address': str}),
+    'richlist': (route_metric('/switcheo/richlist'), {'limit': int, 'offset': int}),
+    'richlist_rank': (route_metric('/switcheo/richlist/rank'), {'address': str}),
+    'address_profile': (route_metric('/switcheo/address/profile'), {'address': str}),
+}
+batch_runner = BatchRunner(batch_metrics)
+
+# polled once per interval per process, however many clients are streaming
+live_state = LiveState({
+    'neo_blockheight': lambda: neo_rpc_call('get_neo_block_height'),
+    'switcheo_status': lambda: neo_rpc_call('is_trading_active'),
+    'switcheo_blockheight': lambda: ingestion_counters.block_height(connections.mongo_db()),
+})
 
 
 @app.route('/<path:path>')
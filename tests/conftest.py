@@ -0,0 +1,14 @@
+""" put flask_modules on the path and keep the app's state directories under a temporary root """
+import os
+import sys
+import tempfile
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root_dir, 'flask_modules'))
+
+state_dir = tempfile.mkdtemp(prefix='switcheolytics-tests-')
+for name in ['METRICS_DIR', 'LIMITS_DIR', 'SNAPSHOT_DIR', 'SINGLEFLIGHT_DIR']:
+    os.environ.setdefault(name, os.path.join(state_dir, name.lower()))
+    os.makedirs(os.environ[name], exist_ok=True)
+os.environ.setdefault('RESPONSE_CACHE_PATH', os.path.join(state_dir, 'response_cache.sqlite'))
+os.environ.setdefault('SNAPSHOT_BUILD', 'false')
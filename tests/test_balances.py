@@ -0,0 +1,99 @@
+""" BalanceLookup against a local stub where one address hangs: per-call timeouts, the batch deadline and the TTL cache """
+import json
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+from switcheo.utils import Request
+
+from app import deadlines
+from app.balances import BalanceLookup
+
+hung = 'AHungAddress'
+hang_seconds = 2
+call_timeout = 0.3
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def upstream():
+    state = {'calls': 0}
+
+    class BalanceHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            state['calls'] += 1
+            address = self.path.rsplit('/', 1)[-1]
+            if address == hung:
+                time.sleep(hang_seconds)
+            payload = json.dumps({'confirmed': {'NEO': address}}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BalanceHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state['url'] = 'http://127.0.0.1:' + str(server.server_address[1])
+    yield state
+    server.shutdown()
+
+
+class StubClient(object):
+    """ balance_by_contract over the Switcheo client's own Request, so its timeout applies as in SwitcheoClient """
+
+    def __init__(self, url):
+        self.request = Request(api_url=url, api_version='')
+
+    def balance_by_contract(self, address):
+        return self.request.get('/balances/' + address)
+
+
+class StubPool(object):
+    def __init__(self, url):
+        self.url = url
+
+    @contextmanager
+    def client(self, network):
+        yield StubClient(self.url)
+
+
+@pytest.fixture
+def lookup(upstream):
+    return BalanceLookup(StubPool(upstream['url']), max_workers=1, timeout=call_timeout, ttl=60)
+
+
+def test_hung_call_times_out_and_frees_its_thread_for_the_rest_of_the_batch(lookup):
+    started = time.time()
+    balances = lookup.get_balances('main', [hung, 'A1', 'A2'])
+    # one worker: the hung call must give its thread back before A1 and A2 can be looked up
+    assert time.time() - started < hang_seconds
+    assert balances['balances'] == {'A1': {'confirmed': {'NEO': 'A1'}}, 'A2': {'confirmed': {'NEO': 'A2'}}}
+    assert balances['errors'] == {hung: 'timed out after ' + str(call_timeout) + 's'}
+
+
+def test_batch_stops_waiting_at_the_request_deadline(lookup):
+    lookup.timeout = hang_seconds * 2
+    started = time.time()
+    with deadlines.deadline(0.3):
+        balances = lookup.get_balances('main', ['A1', hung, 'A2'])
+    assert time.time() - started < hang_seconds
+    assert balances['balances'] == {'A1': {'confirmed': {'NEO': 'A1'}}}
+    assert balances['errors'] == {hung: 'deadline exceeded', 'A2': 'deadline exceeded'}
+
+
+def test_cached_balances_are_not_looked_up_again(lookup, upstream):
+    lookup.get_balances('main', ['A1', 'A2'])
+    calls = upstream['calls']
+    assert lookup.get_balances('main', ['A1', 'A2', 'A1'])['balances'] == {
+        'A1': {'confirmed': {'NEO': 'A1'}}, 'A2': {'confirmed': {'NEO': 'A2'}}}
+    assert upstream['calls'] == calls
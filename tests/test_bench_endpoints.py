@@ -0,0 +1,57 @@
+""" the endpoint benchmark's seed data, stubs and request list, driven against mongomock """
+import mongomock
+import pytest
+from pymongo.errors import OperationFailure
+
+from app import wsgi
+from benchmarks import bench_endpoints
+
+
+def seeded_db(seed_value=42):
+    mongo_db = mongomock.MongoClient().db
+    bench_endpoints.seed(mongo_db, fills=300, addresses=50, offers=30, blocks=60, seed_value=seed_value)
+    return mongo_db
+
+
+def contents(mongo_db, collection):
+    return list(mongo_db[collection].find({}, projection={'_id': False}).sort([('block_time', 1)]))
+
+
+def test_every_route_has_a_benchmark_request():
+    assert bench_endpoints.uncovered_routes(wsgi, bench_endpoints.bench_requests()) == []
+
+
+def test_seed_is_reproducible():
+    first, second, other = seeded_db(), seeded_db(), seeded_db(seed_value=7)
+    for collection in ['fees', 'addresses', 'offer_hash']:
+        assert contents(first, collection) == contents(second, collection)
+    assert contents(first, 'fees') != contents(other, 'fees')
+    assert first['fees'].count_documents({}) == 300
+    assert first['addresses'].count_documents({'rich_list': {'$exists': True}}) > 0
+    assert first['offer_hash'].count_documents({'status': 'open'}) > 0
+
+
+@pytest.fixture(scope='module')
+def client():
+    stubbed = dict((name, getattr(wsgi.connections, name)) for name in ['mongo_db', 'contract'])
+    cache_enabled = wsgi.response_cache.enabled
+    wsgi.response_cache.enabled = False
+    bench_endpoints.stub_dependencies(wsgi, seeded_db())
+    yield wsgi.app.test_client()
+    wsgi.response_cache.enabled = cache_enabled
+    for name, original in stubbed.items():
+        setattr(wsgi.connections, name, original)
+
+
+@pytest.mark.parametrize('path', bench_endpoints.bench_requests())
+def test_benchmark_request_succeeds_on_the_seed(client, path):
+    try:
+        response = client.get(path)
+        body = response.get_data()
+    except OperationFailure as e:
+        # the address leaderboards unwind each address's per-asset map, which mongomock does not implement
+        if '$objectToArray' in str(e):
+            pytest.skip(str(e))
+        raise
+    assert response.status_code == 200, body
+    assert body
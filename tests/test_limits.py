@@ -0,0 +1,104 @@
+""" RouteLimits on a small app: shedding with Retry-After, the queue, class deadlines and slots held by streamed bodies """
+import json
+import time
+import threading
+
+import pytest
+from flask import Flask, Response
+
+from app import deadlines
+from app.limits import RouteLimits
+
+
+@pytest.fixture
+def limits(tmp_path):
+    limits = RouteLimits(directory=str(tmp_path), deadline=5, retry_after=7)
+    limits.add_class('analytics', slots=1, queue=1, queue_timeout=0.5, deadline=0.3)
+    return limits
+
+
+@pytest.fixture
+def client(limits):
+    # Flask(__name__) trips over pytest's import hook on Flask 1.0
+    app = Flask('app')
+    limits.init_app(app)
+
+    @app.route('/heavy')
+    @limits.limited('analytics')
+    def heavy():
+        return 'done'
+
+    @app.route('/runaway')
+    @limits.limited('analytics')
+    def runaway():
+        while True:
+            time.sleep(0.02)
+            deadlines.check()
+
+    @app.route('/stream')
+    @limits.limited('analytics')
+    def stream():
+        return Response(chunk for chunk in ['a', 'b', 'c'])
+
+    return app.test_client()
+
+
+def hold_slot(limits):
+    slot = limits.classes['analytics'].try_lock('slot', 1)
+    assert slot is not None
+    return slot
+
+
+def assert_shed(response, error):
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '7'
+    assert json.loads(response.get_data(as_text=True)) == {'error': error}
+
+
+def test_request_with_every_slot_and_the_queue_taken_is_shed(limits, client):
+    slot = hold_slot(limits)
+    place = limits.classes['analytics'].try_lock('queue', 1)
+    started = time.time()
+    assert_shed(client.get('/heavy'), 'Too busy, retry later')
+    assert time.time() - started < 0.25
+    place.close()
+    slot.close()
+    assert client.get('/heavy').status_code == 200
+
+
+def test_queued_request_is_shed_when_no_slot_frees_in_time(limits, client):
+    slot = hold_slot(limits)
+    started = time.time()
+    assert_shed(client.get('/heavy'), 'Too busy, retry later')
+    assert time.time() - started >= 0.5
+    slot.close()
+
+
+def test_queued_request_takes_a_slot_freed_while_it_waits(limits, client):
+    slot = hold_slot(limits)
+    threading.Timer(0.1, slot.close).start()
+    response = client.get('/heavy')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == 'done'
+
+
+def test_view_running_past_the_class_deadline_gets_503_and_frees_its_slot(limits, client):
+    started = time.time()
+    assert_shed(client.get('/runaway'), 'Deadline exceeded')
+    assert time.time() - started < 1
+    hold_slot(limits).close()
+
+
+def test_streamed_body_holds_its_slot_until_it_is_sent(limits, client):
+    response = client.get('/stream')
+    assert response.status_code == 200
+    assert limits.classes['analytics'].try_lock('slot', 1) is None
+    assert response.get_data(as_text=True) == 'abc'
+    hold_slot(limits).close()
+
+
+def test_disabled_limits_take_no_slot(limits, client):
+    limits.enabled = False
+    slot = hold_slot(limits)
+    assert client.get('/heavy').status_code == 200
+    slot.close()
@@ -0,0 +1,115 @@
+""" the /live poller, its streams and the stream cap """
+import json
+import time
+import threading
+
+import pytest
+
+from app import wsgi
+from app.live import LiveState
+
+interval = 0.1
+
+
+def events(chunks):
+    """ (id, event, data) per event in the SSE chunks; heartbeats as ('', 'heartbeat', None) """
+    parsed = []
+    for chunk in chunks:
+        text = chunk.decode('utf-8')
+        if text.startswith(':'):
+            parsed.append(('', 'heartbeat', None))
+            continue
+        fields = dict(line.split(': ', 1) for line in text.strip().split('\n') if ': ' in line)
+        if 'event' in fields:
+            parsed.append((fields.get('id', ''), fields['event'], json.loads(fields['data'])))
+    return parsed
+
+
+def wait_until(condition, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+@pytest.fixture
+def chain():
+    return {'height': 5000000, 'calls': 0}
+
+
+@pytest.fixture
+def live_state(chain):
+    def height():
+        chain['calls'] += 1
+        return chain['height']
+    return LiveState({'neo_blockheight': height, 'switcheo_status': lambda: True},
+                     interval=interval, heartbeat=interval * 3, max_seconds=interval * 15)
+
+
+def read_stream(live_state, received, last_event_id=None):
+    for chunk in live_state.stream(last_event_id):
+        received.append(chunk)
+
+
+def open_streams(live_state, count):
+    streams = [[] for _ in range(count)]
+    for received in streams:
+        threading.Thread(target=read_stream, args=(live_state, received), daemon=True).start()
+    assert wait_until(lambda: all(any(event == 'state' for _, event, _ in events(received))
+                                  for received in streams), 2)
+    return streams
+
+
+def test_every_stream_gets_a_change_from_one_poller(live_state, chain):
+    streams = open_streams(live_state, 20)
+    calls, started = chain['calls'], time.time()
+    chain['height'] += 1
+
+    def delivered(received):
+        return any(event == 'neo_blockheight' and data == {'neo_blockheight': chain['height']}
+                   for _, event, data in events(received))
+    assert wait_until(lambda: all(delivered(received) for received in streams), interval * 5)
+    polls = (time.time() - started) / interval
+    assert chain['calls'] - calls <= polls + 2
+
+
+def test_quiet_streams_get_heartbeats(live_state):
+    received = open_streams(live_state, 1)[0]
+    assert wait_until(lambda: events(received)[-1][1] == 'heartbeat', interval * 6)
+
+
+def test_reconnect_with_last_event_id_resumes_with_the_missed_events(live_state, chain):
+    received = open_streams(live_state, 1)[0]
+    last_id = [event_id for event_id, _, _ in events(received) if event_id][-1]
+    chain['height'] += 1
+    assert wait_until(lambda: events(received)[-1][1] == 'neo_blockheight', interval * 5)
+
+    chunks, _ = live_state.opening(int(last_id))
+    assert [(event, data) for _, event, data in events(chunks)] == [
+        ('neo_blockheight', {'neo_blockheight': chain['height']})]
+    chunks, _ = live_state.opening(12345)
+    assert [event for _, event, _ in events(chunks)] == ['state']
+
+
+def test_streams_beyond_the_cap_are_shed(live_state):
+    live_class = wsgi.limits.classes['live']
+    original = wsgi.live_state, live_class.slots
+    wsgi.live_state, live_class.slots = live_state, 1
+    try:
+        client = wsgi.app.test_client()
+        first = client.get('/live', buffered=False)
+        assert first.status_code == 200
+        assert next(iter(first.response)).startswith(b'retry: ')
+
+        shed = client.get('/live')
+        assert shed.status_code == 503
+        assert shed.headers['Retry-After']
+        first.close()
+
+        reopened = client.get('/live', buffered=False)
+        assert reopened.status_code == 200
+        reopened.close()
+    finally:
+        wsgi.live_state, live_class.slots = original
@@ -0,0 +1,121 @@
+""" NeoscanClient against a local get_balance stub: TTL cache, stale-while-revalidate and the circuit breaker """
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from app.neoscan import NeoscanClient
+
+address = 'AKJQMHma9MA8KK5M8iQg8ASeg3KZLsjwvB'
+ttl = 0.2
+latency = 0.3
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def upstream():
+    state = {'amount': 100, 'latency': latency, 'failing': False, 'calls': 0}
+
+    class NeoscanHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            state['calls'] += 1
+            time.sleep(state['latency'])
+            if state['failing']:
+                self.send_response(502)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            payload = json.dumps({'address': self.path.rsplit('/', 1)[-1],
+                                  'balance': [{'asset': 'NEO', 'amount': state['amount']}]}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), NeoscanHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state['url'] = 'http://127.0.0.1:' + str(server.server_address[1]) + '/'
+    yield state
+    server.shutdown()
+
+
+@pytest.fixture
+def client(upstream):
+    client = NeoscanClient(base_url=upstream['url'], ttl=ttl, max_stale=ttl * 3, timeout=(1, latency * 4))
+    client.breaker.reset_timeout = ttl * 3
+    return client
+
+
+def amount(client):
+    return client.get_balance(address)['balance'][0]['amount']
+
+
+def wait_until(condition, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_lookup_within_ttl_is_not_sent_upstream(client, upstream):
+    assert amount(client) == 100
+    calls = upstream['calls']
+    started = time.time()
+    assert amount(client) == 100
+    assert time.time() - started < latency / 2
+    assert upstream['calls'] == calls
+
+
+def test_expired_balance_is_served_while_it_refreshes(client, upstream):
+    amount(client)
+    upstream['amount'] = 200
+    time.sleep(ttl)
+    started = time.time()
+    assert amount(client) == 100
+    assert time.time() - started < latency / 2
+    assert wait_until(lambda: amount(client) == 200, latency * 4)
+
+
+def test_failures_open_the_breaker_and_serve_the_last_balance(client, upstream):
+    amount(client)
+    upstream['failing'] = True
+    served = []
+    while not client.breaker.is_open() and len(served) < 10:
+        time.sleep(ttl * 3)
+        served.append(amount(client))
+    assert client.breaker.is_open()
+    assert set(served) == {100}
+
+    calls = upstream['calls']
+    started = time.time()
+    assert amount(client) == 100
+    assert time.time() - started < latency / 2
+    time.sleep(latency)
+    assert upstream['calls'] == calls
+
+
+def test_breaker_closes_once_the_upstream_recovers(client, upstream):
+    amount(client)
+    upstream['failing'] = True
+    for _ in range(10):
+        if client.breaker.is_open():
+            break
+        time.sleep(ttl * 3)
+        amount(client)
+    upstream['failing'] = False
+    upstream['amount'] = 300
+    time.sleep(ttl * 3)
+    assert wait_until(lambda: amount(client) == 300, latency * 4 + ttl * 3)
+    assert not client.breaker.is_open()
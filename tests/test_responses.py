@@ -0,0 +1,99 @@
+""" streamed JSON bodies and Accept-Encoding negotiation """
+import gzip
+import json
+import tracemalloc
+
+import pytest
+from flask import Flask, jsonify
+
+from app.responses import StreamedObject, accepted_encoding, brotli, compress_response, json_response
+
+assets = ['SWTH', 'NEO', 'GAS', 'ETH']
+
+
+def leaderboard_rows(asset, rows):
+    for rank in range(rows):
+        yield {'address': 'A' + asset + str(rank).zfill(32), 'asset': asset,
+               'fee_amount': float(rows - rank) * 1.25, 'fee_count': rows - rank, 'rank': rank + 1}
+
+
+def materialized(rows):
+    return dict((asset, list(leaderboard_rows(asset, rows))) for asset in assets)
+
+
+def create_app(rows):
+    # Flask 1.0 cannot locate a module loaded through pytest's import hook, so the app is named after the package
+    app = Flask('app')
+    app.after_request(compress_response)
+
+    @app.route('/streamed')
+    def streamed():
+        return json_response(StreamedObject((asset, leaderboard_rows(asset, rows)) for asset in assets))
+
+    @app.route('/small')
+    def small():
+        return jsonify({'ok': True})
+
+    return app
+
+
+def decode(response):
+    body = response.get_data()
+    encoding = response.headers.get('Content-Encoding')
+    if encoding == 'gzip':
+        body = gzip.decompress(body)
+    elif encoding == 'br':
+        body = brotli.decompress(body)
+    return json.loads(body.decode('utf-8'))
+
+
+def test_streamed_body_matches_the_materialized_json():
+    response = create_app(200).test_client().get('/streamed')
+    assert response.headers.get('Content-Encoding') is None
+    assert decode(response) == json.loads(json.dumps(materialized(200)))
+
+
+def test_streaming_holds_a_fraction_of_the_materialized_body():
+    rows = 20000
+    client = create_app(rows).test_client()
+    tracemalloc.start()
+    response = client.get('/streamed', buffered=False)
+    for _ in response.response:
+        pass
+    response.close()
+    streamed_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    body = json.dumps(materialized(rows)).encode('utf-8')
+    del body
+    dumps_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert streamed_peak < dumps_peak / 10
+
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    ('gzip', 'gzip'),
+    ('gzip, deflate, br', 'br' if brotli is not None else 'gzip'),
+    ('br;q=0, gzip', 'gzip'),
+    ('gzip;q=0.5, br;q=0.8', 'br' if brotli is not None else 'gzip'),
+    ('gzip;q=0', None),
+    ('br', 'br' if brotli is not None else None),
+    ('identity', None),
+    ('', None),
+])
+def test_encoding_follows_accept_encoding_weights(accept_encoding, expected):
+    app = create_app(200)
+    with app.test_request_context(headers={'Accept-Encoding': accept_encoding}):
+        assert accepted_encoding() == expected
+
+    response = app.test_client().get('/streamed', headers={'Accept-Encoding': accept_encoding})
+    assert response.headers.get('Content-Encoding') == expected
+    assert 'Accept-Encoding' in response.headers.get('Vary', '')
+    assert decode(response) == json.loads(json.dumps(materialized(200)))
+
+
+def test_small_bodies_are_not_compressed():
+    response = create_app(200).test_client().get('/small', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers.get('Content-Encoding') is None
+    assert json.loads(response.get_data().decode('utf-8')) == {'ok': True}